@@ -2,6 +2,8 @@
 import sys, subprocess, shlex
 from pathlib import Path
 
+from probs import open_corpus   # reads compressed files too
+
 # use existing fileprob.py to get log2 P_LM for a sentence
 def lm_log2prob(model: Path, sentence: str) -> float:
     tmp = Path(".__tmp_lm_sentence.txt")
@@ -33,7 +35,8 @@ def main():
     lm_model = Path(sys.argv[1])
     dev_file = Path(sys.argv[2])
 
-    lines = [l.rstrip("\n") for l in dev_file.read_text(encoding="utf-8").splitlines()]
+    with open_corpus(dev_file, encoding="utf-8") as f:
+        lines = [l.rstrip("\n") for l in f.read().splitlines()]
     assert len(lines) >= 10, "expect 10 lines: 1 ref + 9 candidates"
 
     ref = lines[0]  
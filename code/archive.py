@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Packs many small documents -- such as the files of a dev or test directory --
+into a single archive file, so that the scripts that read them (fileprob.py,
+textcat.py, speechrec.py) open one file rather than thousands.
+
+The archive holds the documents' bytes one after another (decompressed, if
+the files were compressed), followed by an index of where each one starts and what its original file name was.  It
+is memory-mapped when read, so a document costs no system call at all.
+Optionally (--vocab), it also holds every document's tokens already
+integerized against a vocabulary; a model with that same vocabulary can
+then score the documents without tokenizing them (see `token_ids`).
+
+In probs.py, `open_corpus` -- and so `read_tokens`, `read_trigrams`, and
+`num_tokens` -- accepts a document of an archive wherever it accepts a file.
+
+Example:
+    ./archive.py ../data/gen_spam/dev --vocab ../vocab-genspam.txt --output gen_spam-dev.pack
+    ./textcat.py gen.model spam.model 0.7 gen_spam-dev.pack
+"""
+import argparse
+import glob
+import hashlib
+import io
+import locale
+import logging
+import mmap
+import struct
+import sys
+from array import array
+from pathlib import Path
+from typing import IO, Iterable, List, Optional, Union
+import torch
+
+from probs import Vocab, expand_paths, is_pattern, open_corpus, read_token_ids, read_vocab
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+# The file starts with a header: the magic string, the number of documents,
+# where the index starts, where the token ids start (0 if there are none), and
+# a hash of the vocabulary they were integerized with.  Then come the
+# documents, and then the index: n+1 offsets of the documents (8-byte ints),
+# then their names in UTF-8, separated by NUL bytes (which can't occur in a
+# file name).  If there are token ids, they come last: n+1 offsets into the
+# ids (8-byte ints), then all the ids (4-byte ints).  All ints are little-endian.
+MAGIC = b"DOCPACK1"
+HEADER = struct.Struct("<8sQQQ32s")
+
+
+def vocab_digest(vocab: Vocab) -> bytes:
+    """A hash of the vocabulary's words, in order -- and thus of its word ids."""
+    return hashlib.sha256("\n".join(vocab).encode("utf-8")).digest()
+
+
+def is_archive(file: Path) -> bool:
+    try:
+        with open(file, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IsADirectoryError, FileNotFoundError):
+        return False
+
+
+def _little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def pack(files: List[Path], output: Path, vocab: Optional[Vocab] = None) -> None:
+    """Write the files, with their names as given, to an archive at output.
+    Compressed files are stored decompressed, so that their documents read as text."""
+    temp = output.with_name(output.name + ".tmp")
+    with open(temp, "wb") as f:
+        f.write(bytes(HEADER.size))   # a placeholder, filled in at the end
+        offsets = array("q", [f.tell()])
+        for file in files:
+            with open_corpus(file, "rb") as document:
+                f.write(document.read())
+            offsets.append(f.tell())
+        index_start = f.tell()
+        f.write(_little_endian(offsets))
+        f.write(b"\0".join(str(file).encode("utf-8") for file in files))
+
+        ids_start, digest = 0, bytes(32)
+        if vocab is not None:
+            word_ids = {word: i for i, word in enumerate(vocab)}
+            docs = [read_token_ids(file, word_ids) for file in files]
+            id_offsets = array("q", [0])
+            for tokens in docs:
+                id_offsets.append(id_offsets[-1] + len(tokens))
+            ids_start, digest = f.tell(), vocab_digest(vocab)
+            f.write(_little_endian(id_offsets))
+            for tokens in docs:
+                f.write(_little_endian(tokens))
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(files), index_start, ids_start, digest))
+    temp.replace(output)
+
+
+class Document:
+    """One document in an archive.  It prints as its original file name, and
+    `open` reads it like a file."""
+
+    def __init__(self, archive: "Archive", i: int):
+        self.archive = archive
+        self.i = i
+        self.path = archive.names[i]
+
+    @property
+    def name(self) -> str:
+        return Path(self.path).name
+
+    def __str__(self) -> str:
+        return self.path
+
+    def __repr__(self) -> str:
+        return f"Document({self.path!r} in {self.archive.file})"
+
+    def raw(self) -> memoryview:
+        return self.archive.data[self.archive.offsets[self.i]:self.archive.offsets[self.i + 1]]
+
+    def open(self, mode: str = "r", encoding: Optional[str] = None, errors: Optional[str] = None) -> IO:
+        binary = io.BytesIO(self.raw())
+        if "b" in mode:
+            return binary
+        return io.TextIOWrapper(binary, encoding=encoding or locale.getpreferredencoding(False), errors=errors)
+
+    def token_ids(self, vocab: Vocab) -> Optional[torch.Tensor]:
+        """The document's tokens as ids in vocab, if the archive has them for this
+        vocab (see `LanguageModel.log_prob_token_ids`); else None."""
+        return self.archive.token_ids(self.i, vocab)
+
+
+class Archive:
+    """An archive written by `pack`, memory-mapped for reading."""
+
+    def __init__(self, file: Path):
+        self.file = file
+        with open(file, "rb") as f:
+            self.data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, n, index_start, ids_start, self.digest = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{file} is not an archive made by archive.py")
+        names_start = index_start + 8 * (n + 1)
+        self.offsets = self._ints("q", index_start, n + 1)
+        names_end = ids_start or len(self.data)
+        self.names = bytes(self.data[names_start:names_end]).decode("utf-8").split("\0") if n else []
+        self.ids_start = ids_start
+        self._digests: dict = {}   # cache of vocab_digest by id(vocab)
+        if ids_start:
+            self.id_offsets = self._ints("q", ids_start, n + 1)
+            self.ids_base = ids_start + 8 * (n + 1)
+
+    def _ints(self, typecode: str, start: int, count: int) -> array:
+        values = array(typecode)
+        values.frombytes(self.data[start:start + values.itemsize * count])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, i: int) -> Document:
+        return Document(self, i)
+
+    def __iter__(self):
+        return (Document(self, i) for i in range(len(self)))
+
+    def token_ids(self, i: int, vocab: Vocab) -> Optional[torch.Tensor]:
+        if not self.ids_start:
+            return None
+        cached = self._digests.get(id(vocab))
+        if cached is None or cached[0] is not vocab:
+            cached = self._digests[id(vocab)] = (vocab, vocab_digest(vocab))
+        if cached[1] != self.digest:
+            return None
+        start, end = self.id_offsets[i], self.id_offsets[i + 1]
+        return torch.tensor(self._ints("i", self.ids_base + 4 * start, end - start), dtype=torch.int32)
+
+
+Documents = List[Union[Path, Document]]
+
+
+def expand_documents(inputs: Iterable[Union[str, Path]]) -> Documents:
+    """The documents named by the inputs: each input may be a file, a directory
+    (all the files under it), a glob pattern, or an archive (all its documents).
+    Only a file named by an input or matched by a pattern may be an archive;
+    the files under a directory are documents, so we needn't open them here."""
+    docs: Documents = []
+    for name in inputs:
+        path = Path(name)
+        if path.is_dir():
+            docs.extend(expand_paths([path]))
+        elif not path.exists() and is_pattern(path):
+            docs.extend(expand_documents(sorted(glob.glob(str(path), recursive=True))))
+        elif is_archive(path):
+            docs.extend(Archive(path))
+        else:
+            docs.append(path)
+    return docs
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", type=Path, nargs="+", help="Files, directories, or glob patterns to pack")
+    parser.add_argument("--output", type=Path, required=True, help="The archive file to write")
+    parser.add_argument("--vocab", type=Path, default=None,
+                        help="Also store the documents' tokens integerized against this vocabulary")
+    parser.set_defaults(logging_level=logging.INFO)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", dest="logging_level", action="store_const", const=logging.DEBUG)
+    verbosity.add_argument("-q", "--quiet", dest="logging_level", action="store_const", const=logging.WARNING)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.logging_level)
+    files = [doc for doc in expand_documents(args.inputs) if isinstance(doc, Path)]
+    vocab = None if args.vocab is None else read_vocab(args.vocab)
+    pack(files, args.output, vocab)
+    log.info(f"Packed {len(files)} documents into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmarks iterate averaging for a log-linear language model: how many
+epochs of training does it take to reach a target dev cross-entropy, with
+and without averaging the parameters (see `train`'s average_start)?
+
+Both runs use the same data, optimizer and random seed.  Training proceeds
+one epoch at a time, resuming from a checkpoint in between, so that the dev
+cross-entropy can be measured after each epoch.  If no --target is given,
+the target is the final dev cross-entropy of the run without averaging.
+
+Example:
+    ./bench_averaging.py ../vocab-genspam.txt log_linear ../data/gen_spam/train/gen \\
+        ../data/gen_spam/dev/gen/* --lexicon ../lexicons/words-gs-only-10.txt \\
+        --l2_regularization 1 --batch_size 32 --epochs 10
+"""
+import argparse
+import logging
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+import torch
+
+from probs import read_vocab, TrigramRows, EmbeddingLogLinearLanguageModel, ImprovedLogLinearLanguageModel, \
+    ClassFactoredLogLinearLanguageModel
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+MODELS = {"log_linear": EmbeddingLogLinearLanguageModel,
+          "log_linear_improved": ImprovedLogLinearLanguageModel,
+          "log_linear_classes": ClassFactoredLogLinearLanguageModel}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("vocab_file", type=Path, help="Vocabulary file")
+    parser.add_argument("smoother", type=str, choices=MODELS.keys(), help="Log-linear model to benchmark")
+    parser.add_argument("train_file", type=Path, help="Training corpus (as a single file)")
+    parser.add_argument("dev_files", type=Path, nargs="+", help="Held-out files")
+    parser.add_argument("--lexicon", type=Path, required=True, help="File of word embeddings")
+    parser.add_argument("--l2_regularization", type=float, default=0.0, help="Strength of L2 regularization (default 0)")
+    parser.add_argument("--epochs", type=int, default=10, help="Most epochs to train (default 10)")
+    parser.add_argument("--batch_size", type=int, default=None, help="Minibatch size (default: the model's)")
+    parser.add_argument("--learning_rate", type=float, default=None, help="Initial learning rate (default: the model's)")
+    parser.add_argument("--optimizer", type=str, default=None, choices=EmbeddingLogLinearLanguageModel.OPTIMIZERS)
+    parser.add_argument("--average_start", type=float, default=1.0,
+                        help="Epochs of training before averaging starts (default 1)")
+    parser.add_argument("--target", type=float, default=None, help="Target dev cross-entropy in bits per token")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for both runs (default 0)")
+    parser.set_defaults(logging_level=logging.WARNING)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", dest="logging_level", action="store_const", const=logging.INFO)
+    verbosity.add_argument("-q", "--quiet", dest="logging_level", action="store_const", const=logging.ERROR)
+    return parser.parse_args()
+
+
+def dev_curve(args: argparse.Namespace, average_start: Optional[float]) -> List[float]:
+    """Dev cross-entropy after each epoch of training."""
+    torch.manual_seed(args.seed)
+    lm = MODELS[args.smoother](read_vocab(args.vocab_file), args.lexicon, args.l2_regularization, 0)
+    parts = [lm.training_data(file, by_type=True) for file in args.dev_files]
+    dev = TrigramRows(torch.cat([part.trigrams for part in parts]), torch.cat([part.weights for part in parts]))
+    options = {"batch_size": args.batch_size, "learning_rate": args.learning_rate, "optimizer": args.optimizer}
+    options = {key: value for key, value in options.items() if value is not None}
+
+    curve = []
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = Path(tmp) / "bench.ckpt"
+        for epochs in range(1, args.epochs + 1):
+            lm.epochs = epochs
+            lm.train(args.train_file, checkpoint=checkpoint, resume=True, average_start=average_start, **options)
+            curve.append(lm.cross_entropy(dev))
+            log.info(f"average_start={average_start}, epoch {epochs}: {curve[-1]:.5f} bits per token")
+    return curve
+
+
+def epochs_to(curve: List[float], target: float) -> Optional[int]:
+    """The first epoch whose dev cross-entropy is at most target."""
+    return next((epoch for epoch, H in enumerate(curve, start=1) if H <= target), None)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.logging_level)
+
+    plain = dev_curve(args, None)
+    averaged = dev_curve(args, args.average_start)
+    target = plain[-1] if args.target is None else args.target
+
+    print("epoch\tplain\taveraged")
+    for epoch, (H_plain, H_averaged) in enumerate(zip(plain, averaged), start=1):
+        print(f"{epoch}\t{H_plain:.5f}\t{H_averaged:.5f}")
+    for name, curve in (("plain", plain), ("averaged", averaged)):
+        epochs = epochs_to(curve, target)
+        print(f"{name}:\t{'not reached' if epochs is None else f'{epochs} epochs'} "
+              f"to reach {target:.5f} bits per token")
+
+
+if __name__ == "__main__":
+    main()
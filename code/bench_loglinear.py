@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the training step of a log-linear language model, comparing the
+gradient computed by PyTorch autograd with the closed-form gradient of
+`analytic_backward` at the same batch size.
+
+Example:
+    ./bench_loglinear.py ../vocab-genspam.txt log_linear ../data/gen_spam/train/gen \\
+        --lexicon ../lexicons/words-gs-only-10.txt --batch_size 32
+"""
+import argparse
+import copy
+import logging
+import math
+import time
+from pathlib import Path
+import torch
+from torch import optim
+
+from probs import read_vocab, minibatches, EmbeddingLogLinearLanguageModel, ImprovedLogLinearLanguageModel
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+MODELS = {"log_linear": EmbeddingLogLinearLanguageModel,
+          "log_linear_improved": ImprovedLogLinearLanguageModel}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("vocab_file", type=Path, help="Vocabulary file")
+    parser.add_argument("smoother", type=str, choices=MODELS.keys(), help="Log-linear model to benchmark")
+    parser.add_argument("train_file", type=Path, help="Training corpus (as a single file)")
+    parser.add_argument("--lexicon", type=Path, required=True, help="File of word embeddings")
+    parser.add_argument("--l2_regularization", type=float, default=0.0, help="Strength of L2 regularization (default 0)")
+    parser.add_argument("--batch_size", type=int, default=32, help="Minibatch size (default 32)")
+    parser.add_argument("--steps", type=int, default=200, help="Number of training steps to time (default 200)")
+    parser.add_argument("--by_type", action="store_true", help="Minibatches of weighted trigram types")
+    parser.add_argument("--by_context", action="store_true", help="Minibatches of contexts with outcome histograms")
+    parser.set_defaults(logging_level=logging.INFO)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", dest="logging_level", action="store_const", const=logging.DEBUG)
+    verbosity.add_argument("-q", "--quiet", dest="logging_level", action="store_const", const=logging.WARNING)
+    return parser.parse_args()
+
+
+def time_steps(lm: EmbeddingLogLinearLanguageModel, batches, tokens_per_batch: float, N: int,
+               analytic: bool) -> float:
+    """Return the number of seconds taken by SGD steps on the given minibatches."""
+    optimizer = optim.SGD(lm.parameters(), lr=1e-2)
+    start = time.perf_counter()
+    for batch in batches:
+        lm.train_step(optimizer, batch, tokens_per_batch, N, analytic)
+    return time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.logging_level)
+
+    vocab = read_vocab(args.vocab_file)
+    lm = MODELS[args.smoother](vocab, args.lexicon, args.l2_regularization, epochs=1)
+    data = lm.training_data(args.train_file, args.by_type, args.by_context)
+    N = data.num_tokens()
+    if isinstance(lm, ImprovedLogLinearLanguageModel):
+        counts = data.outcome_counts(len(vocab))
+        lm.unigram_counts = counts / counts.sum()
+
+    # Build the minibatches up front, so that only the training steps are timed.
+    rows = [rows for _, rows in zip(range(args.steps), minibatches(len(data), args.batch_size, shuffle=True))]
+    batches = list(lm.prefetch_minibatches(data, rows, depth=0))
+    tokens_per_batch = N / math.ceil(len(data) / args.batch_size)
+    lm.check_gradient(batches[0], N)
+
+    # Warm up both paths once, then time them from identical starting parameters.
+    seconds = {}
+    for analytic in (False, True):
+        time_steps(copy.deepcopy(lm), batches[:1], tokens_per_batch, N, analytic)
+        seconds[analytic] = time_steps(copy.deepcopy(lm), batches, tokens_per_batch, N, analytic)
+    for analytic, name in ((False, "autograd"), (True, "analytic")):
+        print(f"{name}:\t{len(batches) / seconds[analytic]:.1f} steps/sec\t"
+              f"({seconds[analytic]:.3f} sec for {len(batches)} steps of batch size {args.batch_size})")
+    print(f"Speedup:\t{seconds[False] / seconds[True]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmarks tokenization: the token-at-a-time generator `read_tokens` against
+the chunked byte tokenizer `read_token_id_chunks`, which splits and
+integerizes a large block of the file at a time.  Reports tokens per second
+for each, and checks that they give the same tokens.
+
+Example:
+    ./bench_tokenize.py ../vocab-genspam.txt ../data/gen_spam/train/gen ../data/gen_spam/train/spam
+"""
+import argparse
+import logging
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, List
+
+from probs import read_vocab, read_tokens, read_token_id_chunks, BOS
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("vocab_file", type=Path, help="Vocabulary file")
+    parser.add_argument("files", type=Path, nargs="+", help="Files to tokenize")
+    parser.add_argument("--repeat", type=int, default=3, help="Time the best of this many runs (default 3)")
+    parser.set_defaults(logging_level=logging.WARNING)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", dest="logging_level", action="store_const", const=logging.INFO)
+    verbosity.add_argument("-q", "--quiet", dest="logging_level", action="store_const", const=logging.ERROR)
+    return parser.parse_args()
+
+
+def generator_ids(files: List[Path], ids: Dict[str, int]) -> array:
+    return array("i", (ids[token] for file in files for token in read_tokens(file, ids)))
+
+
+def chunked_ids(files: List[Path], ids: Dict[str, int]) -> array:
+    tokens = array("i")
+    for file in files:
+        for chunk in read_token_id_chunks(file, ids):
+            tokens.extend(chunk)
+    return tokens
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.logging_level)
+
+    ids = {word: i for i, word in enumerate(w for w in read_vocab(args.vocab_file) if w != BOS)}
+    results = {}
+    for name, tokenize in (("generator", generator_ids), ("chunked", chunked_ids)):
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            tokens = tokenize(args.files, ids)
+            best = min(best, time.perf_counter() - start)
+        results[name] = (tokens, best)
+        print(f"{name}:\t{len(tokens)} tokens in {best:.3f} sec\t{len(tokens) / best:,.0f} tokens/sec")
+
+    (slow, slow_seconds), (fast, fast_seconds) = results["generator"], results["chunked"]
+    if slow != fast:
+        mismatch = next((i for i, (a, b) in enumerate(zip(slow, fast)) if a != b), min(len(slow), len(fast)))
+        print(f"Warning: the tokenizers disagree, starting at token {mismatch}")
+    print(f"Speedup: {slow_seconds / fast_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmarks top-k next-word prediction with a log-linear model, comparing
+the MIPS index of `top_k` against brute force (computing all the logits and
+taking the top k), on the contexts of a test file.  Reports the recall of
+the index (the fraction of the true top k it finds) and the average latency
+per query of each method: `top_k` as callers get it by default (the
+ranking, with logits), and with normalize=True (log-probabilities).
+
+Example:
+    ./bench_topk.py en.model ../data/english_spanish/dev/english/length-10/* --k 10
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+from typing import List
+import torch
+
+from probs import LanguageModel, Bigram, EmbeddingLogLinearLanguageModel, read_trigrams
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", type=Path, help="Trained log-linear model")
+    parser.add_argument("test_files", type=Path, nargs="+", help="Files whose contexts to use as queries")
+    parser.add_argument("--k", type=int, default=10, help="Number of words to predict (default 10)")
+    parser.add_argument("--max_clusters", type=int, default=None,
+                        help="Visit at most this many clusters of the index (default: as many as needed to be exact)")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of distinct contexts to query (default 1000)")
+    parser.set_defaults(logging_level=logging.WARNING)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", dest="logging_level", action="store_const", const=logging.INFO)
+    verbosity.add_argument("-q", "--quiet", dest="logging_level", action="store_const", const=logging.ERROR)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.logging_level)
+
+    lm = LanguageModel.load(args.model)
+    if not isinstance(lm, EmbeddingLogLinearLanguageModel):
+        raise ValueError(f"{args.model} is not a log-linear model")
+    contexts: List[Bigram] = []
+    for file in args.test_files:
+        for (x, y, _) in read_trigrams(file, lm.vocab):
+            contexts.append((x, y))
+    contexts = list(dict.fromkeys(contexts))[:args.queries]   # distinct contexts, in order
+
+    start = time.perf_counter()
+    lm.top_k(*contexts[0], k=args.k)   # builds the index
+    print(f"Built index in {time.perf_counter() - start:.3f} sec")
+
+    found, brute_seconds, index_seconds, normalized_seconds = 0, 0.0, 0.0, 0.0
+    with torch.no_grad():
+        for (x, y) in contexts:
+            start = time.perf_counter()
+            _, words = torch.topk(lm.logits(x, y), args.k)
+            brute_seconds += time.perf_counter() - start
+            truth = {lm.vocab[z] for z in words.tolist()}
+
+            start = time.perf_counter()
+            predicted = lm.top_k(x, y, args.k, args.max_clusters)
+            index_seconds += time.perf_counter() - start
+            found += len(truth & {z for z, _ in predicted})
+
+            start = time.perf_counter()
+            lm.top_k(x, y, args.k, args.max_clusters, normalize=True)
+            normalized_seconds += time.perf_counter() - start
+
+    n = len(contexts)
+    print(f"Recall@{args.k}:\t{found / (n * args.k):.4f} over {n} contexts")
+    print(f"Brute force:\t{1000 * brute_seconds / n:.3f} ms per query")
+    print(f"Index:\t{1000 * index_seconds / n:.3f} ms per query")
+    print(f"Index, normalized:\t{1000 * normalized_seconds / n:.3f} ms per query")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,19 +6,25 @@ The vocabulary is saved as a text file where each line is a word.
 Tokenization is handled by probs.py (currently tokenization at whitespace).
 """
 import argparse
+import functools
+import io
+import locale
 import sys
-from typing import Set, Counter
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Set, Counter, Tuple, TypeVar, Union
 from collections import Counter
 from pathlib import Path
 
-from probs import Wordtype, EOS, OOV, read_tokens
+from probs import Wordtype, EOS, OOV, CountedVocab, by_frequency, compression, expand_paths, open_corpus, \
+    read_tokens, read_vocab, write_binary_vocab
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
         "documents",
-        nargs="+",
+        nargs="*",
         type=Path,
         help="A list of text documents from which to extract the vocabulary")
     parser.add_argument(
@@ -29,20 +35,276 @@ def parse_args():
     )
     parser.add_argument(
         "--threshold",
+        nargs="+",
+        default=[],
+        type=int,
+        help="The minimum number of times a word has to appear for it to be included in the vocabulary (default 1); "
+             "give several to build several vocabularies")
+    parser.add_argument(
+        "--size",
+        nargs="+",
+        default=[],
+        type=int,
+        help="Instead, build a vocabulary of this many of the most frequent words (plus OOV and EOS)")
+    parser.add_argument(
+        "--counts",
+        type=Path,
+        default=None,
+        help="Save the word counts to this file -- or, if no documents are given, read them from it")
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="Save each vocabulary as a binary file in decreasing order of frequency, with the counts")
+    parser.add_argument(
+        "--max_words",
+        type=int,
+        default=None,
+        help="Count in bounded memory, keeping counters for at most this many words (a heavy-hitters summary)")
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="With --max_words, skip the second pass that counts the candidate words exactly; "
+             "the vocabulary may then include some words below the threshold")
+    parser.add_argument(
+        "--memory_report",
+        action="store_true",
+        help="With --max_words, also count every word and report the peak memory of both ways (use with --jobs 1)")
+    parser.add_argument(
+        "--jobs",
         default=1,
         type=int,
-        help="The minimum number of times a word has to appear for it to be included in the vocabulary (default 1)")
+        help="Number of processes to count words in (default 1)")
 
     return parser.parse_args()
 
-def build_vocab(*files: Path, threshold: int) -> Set[str]:
+
+# When counting in parallel, a file larger than this is split into several
+# shards, each a byte range that starts and ends on a line boundary.
+SHARD_BYTES = 64 * 1024 * 1024
+
+Shard = Tuple[Path, int, int]   # a file and a byte range [start, end) of it
+T = TypeVar("T")
+
+
+def shards(file: Path, shard_bytes: int = SHARD_BYTES) -> List[Shard]:
+    """Split file into byte ranges of about shard_bytes, each ending just after a newline.
+    (A compressed file can't be split, so it is one shard, with end -1.)"""
+    if compression(file) is not None:
+        return [(file, 0, -1)]
+    size = file.stat().st_size
+    bounds = [0]
+    with open(file, "rb") as f:
+        while bounds[-1] + shard_bytes < size:
+            f.seek(bounds[-1] + shard_bytes)
+            f.readline()   # move on to the end of the line
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(file, start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+def shard_lines(shard: Shard) -> Iterable[str]:
+    """The lines of text in one shard."""
+    file, start, end = shard
+    if end < 0:
+        with open_corpus(file) as f:
+            return f.readlines()
+    with open(file, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # Decode as `open` does by default, including its universal newlines.
+    return io.StringIO(data.decode(locale.getpreferredencoding(False)), newline=None)
+
+
+def count_shard(shard: Shard, only: Optional[Set[Wordtype]] = None) -> Counter[Wordtype]:
+    """Count the tokens of one shard, exactly as `read_tokens` would tokenize them
+    (each line of text split at whitespace and ended by EOS).  If `only` is
+    given, count just the words in it."""
+    counts: Counter[Wordtype] = Counter()
+    for line in shard_lines(shard):
+        counts.update(line.split() if only is None else (w for w in line.split() if w in only))
+        counts[EOS] += 1
+    return counts
+
+
+def parallel_shards(files: List[Path], jobs: int, work: Callable[[Shard], T]) -> Iterable[T]:
+    """Apply work to every shard of the files in a pool of processes."""
+    todo = [shard for file in files for shard in shards(file)]
+    # Many small files make many small shards, so hand them out a few at a time.
+    chunksize = max(1, len(todo) // (4 * jobs))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(work, todo, chunksize=chunksize)
+
+
+def count_words(files: List[Path], jobs: int = 1, only: Optional[Set[Wordtype]] = None) -> Counter[Wordtype]:
+    """The number of tokens of each word type in the files (or of each word in
+    `only`, if given).  With several jobs, the files are counted in shards by a
+    pool of processes (map), and their Counters are added up (reduce)."""
     word_counts: Counter[Wordtype] = Counter()  # count of each word
-    for file in files:
-        token: Wordtype   # type annotation for loop variable below
-        for token in read_tokens(file):
-            word_counts[token] += 1
+    if jobs <= 1:
+        for file in files:
+            token: Wordtype   # type annotation for loop variable below
+            for token in read_tokens(file):
+                if only is None or token in only or token == EOS:
+                    word_counts[token] += 1
+        return word_counts
+
+    for counts in parallel_shards(files, jobs, functools.partial(count_shard, only=only)):
+        word_counts.update(counts)
+    return word_counts
+
+
+##### HEAVY HITTERS
+# An exact Counter needs memory for every distinct token, and a large noisy
+# corpus (such as spam) can have more distinct tokens than fit in memory.
+# Since we only want the frequent words, we can instead keep a Misra-Gries
+# summary: at most `capacity` counters, where a word with no counter gets one
+# if there is room, and otherwise every counter is decremented (dropping the
+# ones that reach 0).  Every stored count is then an underestimate by at most
+# `error`, the total amount decremented, and a word that is not stored has
+# appeared at most `error` times.  So as long as error < threshold, every
+# word that appears threshold times is among the stored candidates.  A second
+# pass then counts just the candidates exactly.  (Without it, all we know
+# is an upper bound on each candidate's count.)
+
+class HeavyHitters:
+    """A Misra-Gries summary of a stream of words."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[Wordtype, int] = {}
+        self.error = 0   # how much any word's count may be underestimated
+        self.total = 0   # number of words seen
 
+    def update(self, words: Iterable[Wordtype]) -> None:
+        counts = self.counts
+        for word in words:
+            self.total += 1
+            c = counts.get(word)
+            if c is not None:
+                counts[word] = c + 1
+            elif len(counts) < self.capacity:
+                counts[word] = 1
+            else:
+                self.decrement()
+
+    def decrement(self) -> None:
+        """Decrement every counter, as well as a new word's implicit count of 1.
+        Each time removes capacity+1 from the total, so this takes O(total) time
+        overall.  It works in place, since the summary is full just now, and a
+        copy would double its memory."""
+        counts = self.counts
+        for word in counts:
+            counts[word] -= 1   # changing values (not keys) while iterating is allowed
+        for word in [word for word, c in counts.items() if c == 0]:
+            del counts[word]
+        self.error += 1
+
+    def merge(self, other: "HeavyHitters") -> None:
+        """Add in the summary of another stream, keeping at most capacity counters."""
+        for word, c in other.counts.items():
+            self.counts[word] = self.counts.get(word, 0) + c
+        self.error += other.error
+        self.total += other.total
+        if len(self.counts) > self.capacity:
+            cut = sorted(self.counts.values(), reverse=True)[self.capacity]   # subtract the (capacity+1)th largest
+            self.counts = {w: c - cut for w, c in self.counts.items() if c > cut}
+            self.error += cut
+
+    def candidates(self, threshold: Optional[int] = None, size: Optional[int] = None) -> Counter[Wordtype]:
+        """The words that might appear at least threshold times, with upper bounds on
+        their counts.  Warn if some word that appears threshold times, or is among
+        the size most frequent, might be missing."""
+        if threshold is not None and self.error >= threshold:
+            sys.stderr.write(f"Warning: a capacity of {self.capacity} words is too small to be sure of finding "
+                             f"every word that appears {threshold} times (some seen {self.error} times may be missed)\n")
+        if size is not None and self.error > 0:
+            lower = sorted(self.counts.values(), reverse=True)   # lower bounds on the counts
+            if len(lower) < size or lower[size - 1] <= self.error:
+                sys.stderr.write(f"Warning: a capacity of {self.capacity} words is too small to be sure of finding "
+                                 f"the {size} most frequent words (some seen {self.error} times may be missed)\n")
+        threshold = threshold or 1
+        return Counter({w: c + self.error for w, c in self.counts.items() if c + self.error >= threshold})
+
+
+def sketch_shard(shard: Shard, capacity: int) -> HeavyHitters:
+    sketch = HeavyHitters(capacity)
+    for line in shard_lines(shard):
+        sketch.update(line.split())
+        sketch.update((EOS,))
+    return sketch
+
+
+def sketch_words(files: List[Path], capacity: int, jobs: int = 1) -> HeavyHitters:
+    """One pass over the files that finds the frequent words, using memory for only
+    about `capacity` words."""
+    sketch = HeavyHitters(capacity)
+    if jobs <= 1:
+        for file in files:
+            sketch.update(read_tokens(file))
+    else:
+        for part in parallel_shards(files, jobs, functools.partial(sketch_shard, capacity=capacity)):
+            sketch.merge(part)   # Misra-Gries summaries can be merged
+    return sketch
+
+
+def heavy_hitter_counts(files: List[Path], capacity: int, threshold: Optional[int] = None,
+                        size: Optional[int] = None, approximate: bool = False, jobs: int = 1,
+                        memory_report: bool = False) -> Counter[Wordtype]:
+    """Counts of the words that appear at least threshold times (or might be among
+    the size most frequent), using memory for only about `capacity` words.
+
+    Normally a second pass counts those candidate words exactly, and all the
+    other tokens are counted together under OOV, so the counts add up to the
+    number of tokens.  With approximate=True, there is no second pass, and
+    the counts are only upper bounds.
+
+    With memory_report=True, we also count every word exactly, to compare
+    the peak memory of the two ways; that count then serves as the second pass."""
+    sketch, bounded = peak_memory(lambda: sketch_words(files, capacity, jobs), measure=memory_report)
+    candidates = sketch.candidates(threshold, size)
+    sys.stderr.write(f"Found {len(candidates)} candidate words among {sketch.total} tokens "
+                     f"(counts may be overestimated by up to {sketch.error})\n")
+    if memory_report:
+        every, exact = peak_memory(lambda: count_words(files, jobs), measure=True)
+        sys.stderr.write(f"Peak memory: {bounded} bytes with --max_words {capacity}, "
+                         f"{exact} bytes counting every word ({exact / max(bounded, 1):.1f}x)\n")
+        word_counts = Counter({w: every[w] for w in candidates})
+        word_counts[EOS] = every[EOS]
+    elif approximate:
+        sys.stderr.write("These counts are upper bounds, not exact counts\n")
+        return candidates
+    else:
+        word_counts = count_words(files, jobs, only=set(candidates))
+    word_counts[OOV] += sketch.total - sum(word_counts.values())   # the tokens of all the other words
+    return word_counts
+
+
+def peak_memory(work: Callable[[], T], measure: bool = True) -> Tuple[T, int]:
+    """The result of doing the work, and the peak bytes allocated by Python objects
+    while doing it (in this process).  If measure is False, the peak is just 0."""
+    if not measure:
+        return work(), 0
+    tracemalloc.start()
+    try:
+        result = work()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def build_vocab(*files: Path, threshold: int, jobs: int = 1) -> Set[str]:
+    return select_vocab(count_words(expand_paths(files), jobs), threshold=threshold)
+
+
+def select_vocab(word_counts: Counter[Wordtype], threshold: int = 1, size: Optional[int] = None) -> Set[str]:
+    """The words that appear at least threshold times -- or if size is given,
+    just the size most frequent of those (ties broken alphabetically)."""
     vocab = set(w for w in word_counts if word_counts[w] >= threshold)
+    if size is not None and len(vocab) > size:
+        # (Not counting OOV, which stands for the rare words, if the counts include it.)
+        vocab = set(by_frequency(Counter({w: word_counts[w] for w in vocab if w != OOV}))[:size])
     vocab |= {  # the |= operator modifies vocab by taking its union with this set of size 2
         OOV,
         EOS,
@@ -53,12 +315,39 @@ def build_vocab(*files: Path, threshold: int) -> Set[str]:
     return vocab
 
 
-def save_vocab(vocab: Set[str], output: Path):
+def save_vocab(vocab: Set[str], output: Path, word_counts: Optional[Counter[Wordtype]] = None):
+    """Save vocab as a text file with one word per line -- or, if the word counts
+    are given, as a binary vocab file that lists the words in decreasing order
+    of count, along with their counts (see `probs.read_vocab`)."""
+    if word_counts is not None:
+        counts = Counter({w: word_counts[w] for w in vocab})
+        counts[OOV] += sum(c for w, c in word_counts.items() if w not in vocab)   # the tokens that become OOV
+        write_binary_vocab(counts, output)
+        return
     with open(output, "wt") as f:
         for word in vocab:
             print(word, file=f)
 
 
+##### THE WORD-FREQUENCY TABLE
+# Counting is the slow part of building a vocabulary, so we can save the
+# counts once and then pick out vocabularies of any threshold or size from
+# them.  The table is saved as a binary vocab file of every word (see
+# `probs.write_binary_vocab`), so there is only one binary format to maintain.
+
+def load_counts(file: Path) -> Counter[Wordtype]:
+    vocab = read_vocab(file)
+    if not isinstance(vocab, CountedVocab):
+        raise ValueError(f"{file} is not a word-frequency table saved by build_vocab.py")
+    return Counter(dict(zip(vocab, vocab.counts.tolist())))
+
+
+def output_path(output: Path, label: str, many: bool) -> Path:
+    """Where to save one of the vocabularies: output itself if there is just one,
+    else output with the label added to its name (vocab.txt -> vocab-top5000.txt)."""
+    return output.with_name(f"{output.stem}-{label}{output.suffix}") if many else output
+
+
 def main():
     """
     A vocab file is just a list of words.
@@ -75,10 +364,56 @@ def main():
         After which you should see the following saved vocab file:
 
         vocab-genspam.txt
+
+        Directories and (quoted) glob patterns work too, and --jobs counts in parallel:
+
+        ./build_vocab.py '../data/english_spanish/train/*' --threshold 3 --jobs 4 --output vocab-ensp.txt
+
+        To sweep over vocabularies, count once and save the counts, then build
+        several vocabularies by threshold or by size (here vocab-t1.txt, vocab-t3.txt,
+        vocab-top1000.txt), now or in later runs that give no documents:
+
+        ./build_vocab.py ../data/gen_spam/train/* --counts genspam.counts --threshold 1 3 --size 1000 --output vocab.txt
+        ./build_vocab.py --counts genspam.counts --size 100 500 --output vocab.txt
+
+        With --binary, the vocab file lists the words from most to least frequent,
+        with their counts, so that frequent words get small ids:
+
+        ./build_vocab.py ../data/gen_spam/train/* --threshold 3 --binary --output vocab-genspam.vocab
+
+        For a corpus with more distinct tokens than fit in memory, --max_words keeps
+        only that many counters, and still finds every word above the threshold
+        (it warns if it can't be sure); a second pass then counts those words
+        exactly, unless --approximate skips it:
+
+        ./build_vocab.py ../data/gen_spam/train/spam --threshold 3 --max_words 20000 --memory_report
     """
     args = parse_args()
-    vocab = build_vocab(*args.documents, threshold=args.threshold)
-    save_vocab(vocab, args.output)
+    thresholds = args.threshold if args.threshold else ([] if args.size else [1])
+    if args.documents:
+        files = expand_paths(args.documents)
+        if args.max_words is None:
+            word_counts = count_words(files, args.jobs)
+        else:
+            if args.approximate and (args.binary or args.counts is not None):
+                raise ValueError("--approximate counts are only upper bounds, so they can't be saved "
+                                 "with --binary or --counts")
+            word_counts = heavy_hitter_counts(files, args.max_words, min(thresholds, default=None),
+                                              max(args.size, default=None), args.approximate, args.jobs,
+                                              args.memory_report)
+        if args.counts is not None:
+            write_binary_vocab(word_counts, args.counts)
+    elif args.counts is not None:
+        word_counts = load_counts(args.counts)
+    else:
+        raise ValueError("Give some documents to count, or a --counts file to read")
+
+    many = len(thresholds) + len(args.size) > 1
+    counts = word_counts if args.binary else None
+    for threshold in thresholds:
+        save_vocab(select_vocab(word_counts, threshold=threshold), output_path(args.output, f"t{threshold}", many), counts)
+    for size in args.size:
+        save_vocab(select_vocab(word_counts, size=size), output_path(args.output, f"top{size}", many), counts)
 
 if __name__ == '__main__':
     main()
@@ -6,10 +6,14 @@ according to a given smoothed trigram model.
 import argparse
 import logging
 import math
+from contextlib import nullcontext
 from pathlib import Path
+from typing import Tuple
 import torch
 
-from probs import Wordtype, LanguageModel, num_tokens, read_trigrams
+from probs import Wordtype, LanguageModel, TokenCache, read_token_ids, read_trigrams, read_vocab
+from archive import Document, expand_documents
+from score_cache import open_score_cache
 
 log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
 
@@ -23,7 +27,26 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "test_files",
         type=Path,
-        nargs="*"
+        nargs="*",
+        help="files to score (or directories, or archives made by archive.py)"
+    )
+    parser.add_argument(
+        "--token_cache",
+        type=Path,
+        default=None,
+        help="Directory in which to cache the tokenized test files (see train_lm.py)"
+    )
+    parser.add_argument(
+        "--master_vocab",
+        type=Path,
+        default=None,
+        help="With --token_cache, the vocabulary to cache the tokens against (default: the model's)"
+    )
+    parser.add_argument(
+        "--score_cache",
+        type=Path,
+        default=None,
+        help="Database of cached document scores to consult and update (default: $LM_SCORE_CACHE, if set)"
     )
     parser.add_argument(
         "--device",
@@ -46,22 +69,36 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def file_log_prob(file: Path, lm: LanguageModel) -> float:
+def file_log_prob_and_tokens(file: Path, lm: LanguageModel) -> Tuple[float, int]:
     """The file contains one sentence per line. Return the total
     log-probability of all these sentences, under the given language model.
     (This is a natural log, as for all our internal computations.)
+    Also return the number of tokens (including EOS), counted in the same
+    pass over the file.
     """
+    if isinstance(file, Document):
+        token_ids = file.token_ids(lm.vocab)   # already integerized in the archive?
+        if token_ids is not None:
+            return lm.log_prob_token_ids(token_ids), len(token_ids)
+    if lm.scores_in_batches:
+        # This model scores many tokens at once, so integerize the whole file
+        # and score it that way (see `LanguageModel.scores_in_batches`).
+        ids = read_token_ids(file, lm.word_ids())
+        return (lm.log_prob_token_ids(torch.frombuffer(ids, dtype=torch.int32)) if ids else 0.0), len(ids)
+
     log_prob = 0.0
+    tokens = 0
 
     x: Wordtype; y: Wordtype; z: Wordtype    # type annotation for loop variables below
     for (x, y, z) in read_trigrams(file, lm.vocab):
-        log_prob += lm.log_prob(x, y, z)  # log p(z | xy)
+        tokens += 1   # each trigram is one token z
 
-        # If the factor p(z | xy) = 0, then it will drive our cumulative file 
-        # probability to 0 abosnd our cumulative log_prob to -infinity.  In 
-        # this case we can stop early, since the file probability will stay 
-        # at 0 regardless of the remaining tokens.
-        if log_prob == -math.inf: break 
+        # If some factor p(z | xy) = 0, then it has driven our cumulative file 
+        # probability to 0 and our cumulative log_prob to -infinity.  In 
+        # this case we can stop computing probabilities, since the file
+        # probability will stay at 0 regardless of the remaining tokens.
+        # (We still have to count them.)
+        if log_prob == -math.inf: continue
 
         # Why did we bother stopping early?  It could occasionally
         # give a tiny speedup, but there is a more subtle reason -- it
@@ -73,7 +110,9 @@ def file_log_prob(file: Path, lm: LanguageModel) -> float:
         # have any value, and clearly its value doesn't matter here
         # since we'd just be multiplying it by 0.)
 
-    return log_prob
+        log_prob += lm.log_prob(x, y, z)  # log p(z | xy)
+
+    return log_prob, tokens
 
 
 def main():
@@ -99,15 +138,36 @@ def main():
     lm = LanguageModel.load(args.model, device=args.device)
     
     # We use natural log for our internal computations and that's
-    # the kind of log-probability that file_log_prob returns.
+    # the kind of log-probability that file_log_prob_and_tokens returns.
     # We'll print that first.
 
     log.info("Per-file log-probabilities:")
+    cache = None
+    if args.token_cache is not None:
+        cache = TokenCache(lm.vocab if args.master_vocab is None else read_vocab(args.master_vocab), args.token_cache)
+
+    def score(file) -> Tuple[float, int]:
+        """The file's log-probability and number of tokens."""
+        if cache is None or isinstance(file, Document):
+            return file_log_prob_and_tokens(file, lm)
+        # The cached tokens, converted to the model's vocabulary, without rereading the file.
+        token_ids = cache.remapped(file, lm.vocab)
+        return lm.log_prob_token_ids(token_ids), len(token_ids)
+
     total_log_prob = 0.0
-    for file in args.test_files:
-        log_prob: float = file_log_prob(file, lm)
-        print(f"{log_prob:g}\t{file}")
-        total_log_prob += log_prob
+    tokens = 0
+    with open_score_cache(args.score_cache) or nullcontext() as scores:   # (None if there is no cache)
+        model_key = None if scores is None else scores.model_key(args.model)
+        for file in expand_documents(args.test_files):
+            if scores is None:
+                log_prob, n = score(file)
+            else:
+                log_prob, n = scores.score(model_key, file, lambda: score(file))
+            tokens += n
+            print(f"{log_prob:g}\t{file}")
+            total_log_prob += log_prob
+        if scores is not None:
+            log.info(f"Score cache: {scores.stats()}")
 
     # But cross-entropy is conventionally measured in bits: so when it's
     # time to print cross-entropy, we convert log base e to log base 2, 
@@ -118,7 +178,6 @@ def main():
     # We also divide by the # of tokens (including EOS tokens) to get
     # bits per token.  (The division happens within the print statement.)
 
-    tokens = sum(num_tokens(test_file) for test_file in args.test_files)
     H = bits / tokens
     print(f"Overall cross-entropy:\t{H:.5f} bits per token")
     print(f"Perplexity:\t{math.pow(2, H)}")
@@ -30,8 +30,13 @@
 # name, then the feature's weight could be stored at theta[7], where
 # theta is the parameter vector in NumPy.
 
+import mmap
+import struct
+from pathlib import Path
 from typing import (Dict, Generic, Hashable, Iterable, Iterator, List, Optional, TypeVar, overload, Union)
 
+import numpy as np
+
 T = TypeVar('T', bound=Hashable)  # see https://mypy.readthedocs.io/en/stable/generics.html
 
 class Integerizer(Generic[T]):
@@ -159,6 +164,287 @@ class Integerizer(Generic[T]):
             self.add(obj)
 
 
+class CompactIntegerizer:
+    """
+    An Integerizer for strings that stores each string only once, compactly,
+    and converts many strings to ints at once with vectorized numpy code.
+
+    The strings are concatenated in one UTF-8 buffer, and string i is the bytes
+    from offsets[i] to offsets[i+1].  To look strings up, each has a 64-bit hash
+    (computed for all of them at once, see `_hashes`), and the hashes are kept
+    in sorted order along with the integer of each one's string.  So a batch of
+    strings is hashed, found with `np.searchsorted`, and checked byte for byte
+    against the strings found, all in numpy.  There is no Python object per
+    string: just a few bytes beyond the characters themselves.  The hash
+    doesn't change from run to run (unlike Python's `hash`), so `save` can
+    write the arrays to a file as they are, and `load` memory-maps that file.
+
+    The API is the same as Integerizer's, plus `index_many` and `decode_many`.
+    Adding strings rebuilds the arrays, so add many at once with `update`.
+
+    >>> vocab = CompactIntegerizer(['','hello','goodbye'])
+    >>> vocab.index('goodbye'), vocab[2], vocab.index('world')
+    (2, 'goodbye', None)
+    >>> sentence = ('hello','world','if','world','you','be')
+    >>> vocab.index_many(sentence).tolist()
+    [1, -1, -1, -1, -1, -1]
+    >>> ids = vocab.index_many(sentence, add=True)
+    >>> ids.tolist()
+    [1, 3, 4, 3, 5, 6]
+    >>> vocab.decode_many(ids)
+    ['hello', 'world', 'if', 'world', 'you', 'be']
+    >>> len(vocab), vocab[:]
+    (7, ['', 'hello', 'goodbye', 'world', 'if', 'you', 'be'])
+    >>> 'world' in vocab, 'mars' in vocab
+    (True, False)
+    """
+
+    def __init__(self, iterable: Iterable[str] = ()):
+        self._buffer = np.zeros(0, dtype=np.uint8)     # the UTF-8 bytes of all the strings
+        self._offsets = np.zeros(1, dtype=np.int64)    # where each string starts (and the last one ends)
+        self._hashes = np.zeros(0, dtype=np.uint64)    # the strings' hashes, sorted
+        self._order = np.zeros(0, dtype=np.int32)      # the integer of the string with each of those hashes
+        self._seed = 0                                 # changed in the unlikely event that two hashes collide
+        self.update(iterable)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, CompactIntegerizer):
+            return np.array_equal(self._offsets, other._offsets) and np.array_equal(self._buffer, other._buffer)
+        return False
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.decode_many(range(len(self))))
+
+    def __contains__(self, obj: str) -> bool:
+        return self.index(obj) is not None
+
+    @overload
+    def __getitem__(self, index: int) -> str: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[str]: ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(index, slice):
+            return self.decode_many(range(*index.indices(len(self))))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"{type(self).__name__} index out of range")
+        return self._buffer[self._offsets[index]:self._offsets[index + 1]].tobytes().decode("utf-8")
+
+    def index(self, obj: str, add: bool = False) -> Optional[int]:
+        # One string is quicker to look up in plain Python than with numpy's per-call overhead.
+        key = _encode(obj)
+        if len(self):
+            h = _hash(key, self._seed)
+            slot = int(np.searchsorted(self._hashes, h))
+            if slot < len(self) and int(self._hashes[slot]) == h:
+                i = int(self._order[slot])
+                if self._buffer[self._offsets[i]:self._offsets[i + 1]].tobytes() == key:
+                    return i
+        if not add:
+            return None
+        self.update([key])
+        return len(self) - 1
+
+    def add(self, obj: str) -> None:
+        self.index(obj, add=True)
+
+    def update(self, iterable: Iterable[str]) -> None:
+        """
+        Add all the strings that are not already in the collection, rebuilding the arrays once.
+        """
+        keys = [_encode(obj) for obj in iterable]
+        if len(self):
+            found = self.index_many(keys) >= 0
+            keys = [key for key, old in zip(keys, found.tolist()) if not old]
+        keys = list(dict.fromkeys(keys))   # the new strings, once each, in order of first occurrence
+        if not keys:
+            return
+        new = np.frombuffer(b"".join(keys), dtype=np.uint8)
+        lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+        self._buffer = np.concatenate([self._buffer, new])
+        self._offsets = np.concatenate([self._offsets, self._offsets[-1] + np.cumsum(lengths)])
+        while True:
+            hashes = _hashes(self._buffer, self._offsets, self._seed)
+            order = np.argsort(hashes, kind="stable")
+            hashes = hashes[order]
+            if not np.any(hashes[1:] == hashes[:-1]):
+                break
+            self._seed += 1   # two distinct strings have the same hash, so try another hash function
+        self._hashes, self._order = hashes, order.astype(np.int32)
+
+    def index_many(self, objs: Iterable[Union[str, bytes]], add: bool = False, default: int = -1) -> np.ndarray:
+        """
+        The integers of many strings (or their UTF-8 bytes) at once, as an array of
+        4-byte ints, with `default` for strings not in the collection (unless
+        `add=True` adds them).
+        """
+        keys = objs if isinstance(objs, list) else list(objs)
+        try:
+            joined = b"".join(keys)   # if the keys are all bytes already, as from `bytes.split`
+        except TypeError:
+            keys = [_encode(obj) for obj in keys]
+            joined = b"".join(keys)
+        if add:
+            self.update(keys)
+        buffer = np.frombuffer(joined, dtype=np.uint8)
+        lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        ids = np.full(len(keys), default, dtype=np.int32)
+        if not len(self) or not keys:
+            return ids
+
+        # Find each key's hash among the strings' hashes.
+        hashes = _hashes(buffer, offsets, self._seed)
+        slots = np.minimum(np.searchsorted(self._hashes, hashes), len(self) - 1)
+        found = np.flatnonzero(self._hashes[slots] == hashes)
+        candidates = self._order[slots[found]]
+
+        # Keep only the strings that really are equal to the key, not just equal in hash.
+        starts, ends = self._offsets[candidates], self._offsets[candidates + 1]
+        same = (ends - starts) == lengths[found]
+        found, candidates, starts = found[same], candidates[same], starts[same]
+        same = _equal_segments(buffer, offsets[found], self._buffer, starts, lengths[found])
+        ids[found[same]] = candidates[same]
+        return ids
+
+    def decode_many(self, indices: Iterable[int]) -> List[str]:
+        """
+        The strings with the given integers.
+        """
+        ids = np.asarray(indices if isinstance(indices, np.ndarray) else np.fromiter(indices, dtype=np.int64),
+                         dtype=np.int64)
+        if not len(ids):
+            return []
+        if ids.min() < 0 or ids.max() >= len(self):
+            raise IndexError(f"{type(self).__name__} index out of range")
+        starts, lengths = self._offsets[ids], self._offsets[ids + 1] - self._offsets[ids]
+        data = self._buffer[_segment_positions(starts, lengths)].tobytes()
+        ends = np.cumsum(lengths).tolist()
+        return [data[start:end].decode("utf-8") for start, end in zip([0] + ends[:-1], ends)]
+
+    # The file format: a header, then the offsets (8-byte ints), the sorted hashes
+    # (8-byte unsigned ints), the order (4-byte ints, padded to a multiple of 8
+    # bytes), and the buffer, all little-endian.
+
+    MAGIC = b"INTEGERIZER2"
+    HEADER = struct.Struct("<12sxxxxQQQ")   # magic, number of strings, buffer size, hash seed
+
+    def to_bytes(self) -> bytes:
+        """The contents of the file that `save` writes."""
+        n = len(self)
+        return b"".join([self.HEADER.pack(self.MAGIC, n, len(self._buffer), self._seed),
+                         self._offsets.astype("<i8").tobytes(),
+                         self._hashes.astype("<u8").tobytes(),
+                         self._order.astype("<i4").tobytes() + bytes(-4 * n % 8),
+                         self._buffer.tobytes()])
+
+    def save(self, path: Union[str, Path]) -> None:
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def from_buffer(cls, data, start: int = 0) -> "CompactIntegerizer":
+        """
+        The collection stored (by `to_bytes`) at position start of data, which may
+        be memory-mapped.  The arrays are read-only views of data, not copies.
+        """
+        magic, n, buffer_size, seed = cls.HEADER.unpack_from(data, start)
+        if magic != cls.MAGIC:
+            raise ValueError("Not the data of a CompactIntegerizer")
+        start += cls.HEADER.size
+        self = cls.__new__(cls)
+        self._offsets = np.frombuffer(data, dtype="<i8", count=n + 1, offset=start)
+        self._hashes = np.frombuffer(data, dtype="<u8", count=n, offset=start + 8 * (n + 1))
+        self._order = np.frombuffer(data, dtype="<i4", count=n, offset=start + 8 * (2 * n + 1))
+        self._buffer = np.frombuffer(data, dtype=np.uint8, count=buffer_size,
+                                     offset=start + 8 * (2 * n + 1) + 4 * n + (-4 * n % 8))
+        self._seed = seed
+        return self
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "CompactIntegerizer":
+        """
+        Open a file written by `save`.  The file is memory-mapped, so the strings
+        are paged in only as they are used.
+        """
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(data)
+
+    def __getstate__(self) -> Dict[str, object]:   # for pickling: copy any views of a file into memory
+        return {name: np.array(value) if isinstance(value, np.ndarray) else value
+                for name, value in self.__dict__.items()}
+
+
+def _encode(obj: Union[str, bytes]) -> bytes:
+    return obj.encode("utf-8") if isinstance(obj, str) else obj
+
+
+def _segment_positions(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """The positions starts[k], starts[k]+1, ..., starts[k]+lengths[k]-1 for each k, all concatenated."""
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - lengths), lengths)
+
+
+# The hash of a string of bytes b_0 ... b_{n-1} is the polynomial sum of (b_j+1) * M^j
+# mod 2^64 (numpy's uint64 arithmetic wraps around), mixed with n and scrambled by
+# the finalizer of MurmurHash3.  The multiplier M depends on the seed.
+
+_MULTIPLIER = 0x100000001B3   # the 64-bit FNV prime
+_MIX = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xFF51AFD7ED558CCD), np.uint64(0xC4CEB9FE1A85EC53))
+
+
+def _hash(key: bytes, seed: int) -> int:
+    """The hash of one string, the same as `_hashes` gives, computed in plain Python."""
+    mask = 2**64 - 1
+    multiplier = (_MULTIPLIER + 2 * seed) & mask
+    h, power = 0, 1
+    for byte in key:
+        h = (h + (byte + 1) * power) & mask
+        power = power * multiplier & mask
+    h ^= len(key) * int(_MIX[0]) & mask
+    for mix in (int(_MIX[1]), int(_MIX[2])):
+        h ^= h >> 33
+        h = h * mix & mask
+    return h ^ h >> 33
+
+
+def _hashes(buffer: np.ndarray, offsets: np.ndarray, seed: int) -> np.ndarray:
+    """The hashes of all the strings that offsets marks off in buffer."""
+    lengths = np.diff(offsets)
+    multiplier = np.uint64((_MULTIPLIER + 2 * seed) & (2**64 - 1))
+    with np.errstate(over="ignore"):
+        powers = np.cumprod(np.full(int(lengths.max(initial=0)), multiplier, dtype=np.uint64))
+        powers = np.concatenate([np.ones(1, dtype=np.uint64), powers[:-1]])   # M^0, M^1, ...
+        positions = np.arange(len(buffer)) - np.repeat(offsets[:-1], lengths)   # of each byte within its string
+        terms = (buffer.astype(np.uint64) + np.uint64(1)) * powers[positions]
+        sums = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(terms, dtype=np.uint64)])
+        h = (sums[offsets[1:]] - sums[offsets[:-1]]) ^ (lengths.astype(np.uint64) * _MIX[0])
+        h ^= h >> np.uint64(33)
+        h *= _MIX[1]
+        h ^= h >> np.uint64(33)
+        h *= _MIX[2]
+        h ^= h >> np.uint64(33)
+    return h
+
+
+def _equal_segments(a: np.ndarray, a_starts: np.ndarray, b: np.ndarray, b_starts: np.ndarray,
+                    lengths: np.ndarray) -> np.ndarray:
+    """For each k, whether a[a_starts[k]:][:lengths[k]] == b[b_starts[k]:][:lengths[k]]."""
+    if not len(lengths):
+        return np.zeros(0, dtype=bool)
+    differ = a[_segment_positions(a_starts, lengths)] != b[_segment_positions(b_starts, lengths)]
+    differences = np.concatenate([[0], np.cumsum(differ)])
+    ends = np.cumsum(lengths)
+    return differences[ends] == differences[ends - lengths]
+
+
 if __name__ == "__main__":
     import doctest
 
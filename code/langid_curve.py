@@ -11,6 +11,8 @@ from pathlib import Path
 from collections import defaultdict
 import matplotlib.pyplot as plt
 
+from probs import open_corpus   # reads compressed files too
+
 ROOT = Path(__file__).resolve().parent.parent
 CODE = ROOT / "code"
 OUTDIR = ROOT / "scan_out"; OUTDIR.mkdir(exist_ok=True)
@@ -78,7 +80,7 @@ def count_tokens_word(files):
     """Fallback token counter: words per line + EOS (for plain text)."""
     total = 0
     for fp in files:
-        with fp.open("r", encoding="utf-8", errors="ignore") as f:
+        with open_corpus(fp, encoding="utf-8", errors="ignore") as f:
             for line in f:
                 s = line.strip()
                 if not s: 
@@ -0,0 +1,79 @@
+"""
+Maximum inner product search (MIPS): given a query vector q, find the k
+columns a of a fixed matrix A with the largest q·a, without computing
+q·a for every column.
+
+The columns are partitioned into clusters by k-means.  For a cluster with
+centroid c whose columns are all within distance r of c, Cauchy-Schwarz
+gives  q·a = q·c + q·(a - c) <= q·c + ||q|| r.  We visit the clusters in
+decreasing order of this bound, scoring their columns exactly, and stop as
+soon as the bound of the next cluster can't beat the k-th best score so far.
+So the search is exact, but usually only visits a few clusters.  To trade
+accuracy for speed, you can also cap the number of clusters visited.
+(Clusters are visited in batches of 1, 2, 4, ... so that a search that has
+to visit many of them still takes only a few steps.)
+
+Used by `EmbeddingLogLinearLanguageModel.top_k` to find the most probable
+next words, whose logits are such inner products.
+"""
+import math
+from typing import Optional, Tuple
+
+import torch
+
+
+class MIPSIndex:
+    """An index over the columns of a [D, n] matrix for top-k inner product search."""
+
+    def __init__(self, columns: torch.Tensor, num_clusters: Optional[int] = None, iterations: int = 10):
+        self.columns = columns
+        n = columns.shape[1]
+        num_clusters = min(n, num_clusters or math.ceil(math.sqrt(n)))
+
+        # k-means, starting from evenly spaced columns in order of their norm.
+        # (Deterministic, so that rebuilding the index gives the same index.)
+        points = columns.T                                                  # [n, D]
+        by_norm = torch.argsort(points.norm(dim=1))
+        centroids = points[by_norm[torch.arange(num_clusters) * n // num_clusters]]
+        for _ in range(iterations):
+            cluster = torch.cdist(points, centroids).argmin(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, cluster, points)
+            sizes = torch.bincount(cluster, minlength=num_clusters)
+            nonempty = sizes > 0
+            centroids[nonempty] = sums[nonempty] / sizes[nonempty].unsqueeze(1)
+        cluster = torch.cdist(points, centroids).argmin(dim=1)
+
+        # Store the columns' ids grouped by cluster: cluster c's are at order[offsets[c]:offsets[c+1]].
+        self.order = torch.argsort(cluster, stable=True)
+        sizes = torch.bincount(cluster, minlength=num_clusters)
+        self.offsets = torch.cat((torch.zeros(1, dtype=torch.long), torch.cumsum(sizes, 0))).tolist()
+        self.members = [self.order[start:end] for start, end in zip(self.offsets, self.offsets[1:])]
+        self.centroids = centroids.T                                        # [D, num_clusters]
+        distances = (points - centroids[cluster]).norm(dim=1)
+        self.radius = torch.zeros(num_clusters).index_reduce_(0, cluster, distances, "amax")
+
+    def search(self, q: torch.Tensor, k: int, max_clusters: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the k largest scores q·a over the columns a (in decreasing order)
+        and the ids of their columns.  The result is exact unless max_clusters
+        stops the search early."""
+        k = min(k, self.columns.shape[1])
+        bounds, visit = torch.sort(q @ self.centroids + q.norm() * self.radius, descending=True)
+        bounds, visit = bounds.tolist(), visit.tolist()
+        limit = len(visit) if max_clusters is None else max_clusters
+        best_scores = torch.empty(0)
+        best_ids = torch.empty(0, dtype=torch.long)
+        visited, batch = 0, 1
+        while visited < len(visit):
+            if len(best_scores) >= k and (bounds[visited] <= best_scores[-1] or visited >= limit):
+                break   # no column in the remaining clusters can make it into the top k
+            end = min(visited + batch, len(visit), max(limit, visited + 1))
+            ids = torch.cat([best_ids] + [self.members[c] for c in visit[visited:end]])
+            scores = torch.cat((best_scores, q @ self.columns[:, ids[len(best_ids):]]))
+            best_scores, top = torch.topk(scores, min(k, len(scores)))
+            best_ids = ids[top]
+            visited, batch = end, 2 * batch
+        return best_scores, best_ids
+
+    def brute_force(self, q: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The same as `search`, by scoring every column."""
+        return torch.topk(q @ self.columns, min(k, self.columns.shape[1]))
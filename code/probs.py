@@ -19,13 +19,30 @@
 
 from __future__ import annotations
 
+import glob
+import hashlib
+import heapq
+import io
+import itertools
+import locale
 import logging
 import math
+import mmap
+import os
 import pickle
+import queue
+import random
+import struct
 import sys
+import threading
+import time
 
+from array import array
+
+from contextlib import closing
 from pathlib import Path
 import re
+import numpy as np
 import torch
 from torch import nn
 from torch import optim
@@ -35,10 +52,14 @@ from typing import Counter, Collection
 from collections import Counter
 from tqdm import tqdm
 
+from SGD_convergent import ConvergentSGD
+from integerize import CompactIntegerizer
+from mips import MIPSIndex
+
 log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
 
 ##### TYPE DEFINITIONS (USED FOR TYPE ANNOTATIONS)
-from typing import Iterable, List, Optional, Set, Tuple, Union
+from typing import BinaryIO, Callable, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar, Union
 
 Wordtype = str  # if you decide to integerize the word types, then change this to int
 Vocab    = Collection[Wordtype]   # and change this to Integerizer[str]
@@ -49,6 +70,9 @@ Trigram  = Tuple[Wordtype, Wordtype, Wordtype]
 Ngram    = Union[Zerogram, Unigram, Bigram, Trigram]
 Vector   = List[float]
 TorchScalar = Float[torch.Tensor, ""] # a torch.Tensor with no dimensions, i.e., a scalar
+# A minibatch of contexts: their word ids x and y, and the observed outcomes as
+# sparse entries (row, z, count), meaning that context `row` was followed by z `count` times.
+Minibatch = Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]
 
 
 ##### CONSTANTS
@@ -60,6 +84,150 @@ OOL: Wordtype = "OOL"  # special word type whose embedding is used for OOV and a
 
 ##### UTILITY FUNCTIONS FOR CORPUS TOKENIZATION
 
+def is_pattern(name: Union[str, Path]) -> bool:
+    """Whether name is a glob pattern such as data/gen_spam/train/*."""
+    return any(c in str(name) for c in "*?[")
+
+
+def expand_paths(inputs: Iterable[Union[str, Path]]) -> List[Path]:
+    """The files named by the inputs, where an input may also be a directory
+    (meaning every file under it) or a glob pattern, which is expanded in turn.
+    An existing file whose name looks like a pattern is taken literally."""
+    files: List[Path] = []
+    for name in inputs:
+        path = Path(name)
+        if path.is_dir():
+            files.extend(sorted(f for f in path.rglob("*") if f.is_file()))
+        elif not path.exists() and is_pattern(path):
+            files.extend(expand_paths(sorted(Path(f) for f in glob.glob(str(path), recursive=True))))
+        else:
+            files.append(path)
+    return files
+
+
+# Corpora may be stored compressed.  We recognize the format by the file's
+# first bytes, so the file name doesn't matter.  zstd needs the optional
+# `zstandard` package; the others are in the standard library.
+COMPRESSIONS = {b"\x1f\x8b": "gzip", b"BZh": "bz2", b"\xfd7zXZ\x00": "xz", b"\x28\xb5\x2f\xfd": "zstd"}
+DECOMPRESSED_BLOCK = 1 << 20
+
+
+def compression(file: Path) -> Optional[str]:
+    """The compression format of file, or None if it isn't compressed."""
+    with open(file, "rb") as f:
+        return _compression_of(f.read(6))
+
+
+def _compression_of(start: bytes) -> Optional[str]:
+    """The compression format of a file that starts with these bytes."""
+    return next((name for magic, name in COMPRESSIONS.items() if start.startswith(magic)), None)
+
+
+def _open_compressed(raw: BinaryIO, name: str, file: Path) -> BinaryIO:
+    """A stream that decompresses the stream raw, an open file in the given format.
+    (Closing it may not close raw.)"""
+    if name == "gzip":
+        import gzip
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if name == "bz2":
+        import bz2
+        return bz2.BZ2File(raw, "rb")
+    if name == "xz":
+        import lzma
+        return lzma.LZMAFile(raw, "rb")
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(f"Reading the zstd-compressed file {file} requires the zstandard package")
+    return zstandard.open(raw, "rb")
+
+
+class _DecompressingReader(io.RawIOBase):
+    """A read-only binary stream over a decompressing stream, whose blocks are
+    decompressed ahead of time by a background thread and held in a queue of up
+    to `depth` blocks.  An empty block marks the end of the stream.  Closing
+    the reader closes the stream and the file under it, raw."""
+
+    def __init__(self, stream: BinaryIO, raw: BinaryIO, depth: int = 4):
+        super().__init__()
+        self.stream = stream
+        self.raw = raw
+        self.blocks: queue.Queue[Union[bytes, Exception]] = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()   # set when the reader is closed
+        self.pending = memoryview(b"")
+        self.finished = False
+        self.thread = threading.Thread(target=self._decompress, daemon=True)
+        self.thread.start()
+
+    def _put(self, block: Union[bytes, Exception]) -> None:
+        while not self.stop.is_set():   # don't block forever on a reader that has been closed
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _decompress(self) -> None:
+        try:
+            while not self.stop.is_set():
+                block = self.stream.read(DECOMPRESSED_BLOCK)
+                self._put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self._put(e)                # re-raised in the reader's thread
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            if self.finished:
+                return 0
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                self.finished = True
+                raise block
+            if not block:
+                self.finished = True
+                return 0
+            self.pending = memoryview(block)
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+            self.stream.close()
+            self.raw.close()
+        super().close()
+
+
+def open_corpus(file: Path, mode: str = "r", encoding: Optional[str] = None,
+                errors: Optional[str] = None) -> IO:
+    """Open a corpus file for reading, in text mode ("r", like `open`, with the
+    same encoding and errors arguments) or binary mode ("rb").  If the file is compressed, it is decompressed as it is read,
+    in a background thread, so that decompression overlaps with whatever
+    the caller does with the text.  (The decompressors release Python's
+    global interpreter lock while they work.)
+
+    The file may also be a document in an archive (see archive.py), or any
+    other object, not a path, that has an `open(mode, encoding, errors)` method."""
+    if not isinstance(file, (str, os.PathLike)):
+        return file.open(mode, encoding, errors)
+    raw = open(file, "rb")
+    name = _compression_of(raw.peek(6)[:6])   # look at the first bytes without consuming them
+    if name is None:
+        binary: IO = raw
+    else:
+        binary = io.BufferedReader(_DecompressingReader(_open_compressed(raw, name, file), raw))
+    if "b" in mode:
+        return binary
+    return io.TextIOWrapper(binary, encoding=encoding or locale.getpreferredencoding(False), errors=errors)
+
 def read_tokens(file: Path, vocab: Optional[Vocab] = None) -> Iterable[Wordtype]:
     """Iterator over the tokens in file.  Tokens are whitespace-delimited.
     If vocab is given, then tokens that are not in vocab are replaced with OOV."""
@@ -82,7 +250,7 @@ def read_tokens(file: Path, vocab: Optional[Vocab] = None) -> Iterable[Wordtype]
     # Whenever the `for` loop needs another token, read_tokens magically picks up 
     # where it left off and continues running until the next `yield` statement.
 
-    with open(file) as f:
+    with open_corpus(file) as f:   # (which also reads compressed files)
         for line in f:
             for token in line.split():
                 if vocab is None or token in vocab:
@@ -109,31 +277,501 @@ def read_trigrams(file: Path, vocab: Vocab) -> Iterable[Trigram]:
             x, y = y, z  # shift over by one position.
 
 
+# `read_tokens` spends most of its time in Python code that runs once per
+# token.  For speed, we can instead read the file in large blocks of bytes,
+# and let C code split each block into tokens and look them up.  The trick
+# is to turn each newline into a token of its own -- a NUL byte, which isn't
+# whitespace -- so that one `bytes.split` call gives all the tokens of the
+# block, with the NULs marking where EOS goes.
+#
+# This gives the same tokens as `read_tokens` on UTF-8 text whose whitespace
+# is ASCII, as in all of our corpora.  (`str.split` also splits at non-ASCII
+# Unicode whitespace, and text mode treats a lone \r as a newline.)  Among
+# the ASCII control characters, `str.split` but not `bytes.split` counts the
+# separators \x1c-\x1f as whitespace -- the spam corpus has some -- so we
+# turn those into spaces first.  A NUL byte in the text itself would be taken
+# for a newline, so we refuse to read such a file this way.  (Checking for
+# one is a fast C scan of each block.)
+
+LINE_END = b"\0"   # stands for EOS among the byte tokens
+CHUNK_BYTES = 1 << 22
+_SEPARATORS = bytes.maketrans(b"\x1c\x1d\x1e\x1f", b"    ")
+
+
+def read_byte_token_chunks(file: Path, chunk_bytes: int = CHUNK_BYTES) -> Iterable[List[bytes]]:
+    """The tokens of file as bytes, a large chunk of lines at a time, with LINE_END
+    at the end of each line (including a last line with no newline).
+    Raises ValueError if the file contains a NUL byte; use `read_tokens` for such a file."""
+    leftover = b""
+    with open_corpus(file, "rb") as f:
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            if LINE_END in block:
+                raise ValueError(f"{file} contains a NUL byte, which can't be read as byte tokens")
+            block = leftover + block
+            end = block.rfind(b"\n") + 1   # the chunk ends with the last complete line
+            leftover = block[end:]
+            if end:
+                yield block[:end].translate(_SEPARATORS).replace(b"\n", b" \0 ").split()
+    if leftover.strip():
+        yield leftover.translate(_SEPARATORS).split() + [LINE_END]
+    elif leftover:
+        yield [LINE_END]   # a last line of just whitespace is still a line
+
+
+def read_token_id_chunks(file: Path, ids: Dict[Wordtype, int],
+                         chunk_bytes: int = CHUNK_BYTES) -> Iterable[array]:
+    """The tokens of file (as `read_tokens` gives them, using the keys of ids as the
+    vocab) integerized by ids, as an array of 4-byte ints per chunk of lines."""
+    lookup = {word.encode("utf-8"): i for word, i in ids.items()}
+    lookup[LINE_END] = ids[EOS]
+    oov = itertools.repeat(ids[OOV])
+    for tokens in read_byte_token_chunks(file, chunk_bytes):
+        yield array("i", map(lookup.get, tokens, oov))   # lookup.get(token, OOV id) for each token
+
+
+def read_tokens_chunked(file: Path, vocab: Optional[Vocab] = None) -> Iterable[Wordtype]:
+    """The same as `read_tokens`, but reading the file by chunks as above."""
+    for tokens in read_byte_token_chunks(file):
+        for token in tokens:
+            if token == LINE_END:
+                yield EOS
+            else:
+                word = token.decode("utf-8")
+                yield word if vocab is None or word in vocab else OOV
+
+
+def read_token_ids(file: Path, ids: Dict[Wordtype, int]) -> array:
+    """The tokens of file (as `read_tokens` returns them, using the keys of ids
+    as the vocab) integerized by ids, in a compact array of 4-byte ints.
+    This takes far less memory than a sequence of Python strings or tuples."""
+    tokens = array("i")
+    for chunk in read_token_id_chunks(file, ids):
+        tokens.extend(chunk)
+    return tokens
+
+
+class TokenCache:
+    """Corpora tokenized once and cached on disk as arrays of token ids against
+    a "master" vocabulary -- e.g., every word in the training data -- so
+    that models with smaller vocabularies can reuse them without
+    retokenizing.  `remapped` converts the cached ids to the ids of any
+    vocabulary through a lookup table, where the master words that aren't
+    in that vocabulary all become OOV.  The models' `train` and
+    `log_prob_token_ids` methods accept the remapped ids directly.
+
+    A cached file is named by the master vocabulary and by the corpus file's
+    path, size and modification time, so editing either one invalidates it."""
+
+    def __init__(self, master: Vocab, cache_dir: Path):
+        self.master = list(master)
+        if OOV not in self.master or EOS not in self.master:
+            raise ValueError("The master vocabulary must include OOV and EOS")
+        self.ids = {word: i for i, word in enumerate(self.master)}
+        digest = hashlib.sha256("\n".join(self.master).encode("utf-8")).hexdigest()[:16]
+        self.dir = Path(cache_dir) / digest
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._tables: Dict[int, Tuple[Vocab, torch.Tensor]] = {}
+
+    def path(self, file: Path) -> Path:
+        stat = file.stat()
+        name = hashlib.sha256(str(file.resolve()).encode("utf-8")).hexdigest()[:16]
+        return self.dir / f"{name}-{stat.st_size}-{stat.st_mtime_ns}.ids"
+
+    def token_ids(self, file: Path) -> torch.Tensor:
+        """The tokens of file as master ids (4-byte ints), tokenizing it only if it isn't cached."""
+        path = self.path(Path(file))
+        tokens = array("i")
+        if path.exists():
+            with open(path, "rb") as f:
+                tokens.frombytes(f.read())
+        else:
+            tokens = read_token_ids(file, self.ids)
+            temp = path.with_name(path.name + ".tmp")
+            with open(temp, "wb") as f:
+                tokens.tofile(f)
+            temp.replace(path)
+        return torch.frombuffer(tokens, dtype=torch.int32) if tokens else torch.zeros(0, dtype=torch.int32)
+
+    def remap_table(self, vocab: Vocab) -> torch.Tensor:
+        """table[i] is the id in vocab (its position, as in a model's word ids)
+        of master word i, or the id of OOV if vocab doesn't have that word.
+        Raises ValueError if vocab has words that the master vocabulary doesn't."""
+        cached = self._tables.get(id(vocab))
+        if cached is not None and cached[0] is vocab:
+            return cached[1]
+        missing = [word for word in vocab if word not in self.ids]
+        if missing:
+            # Those words' tokens were cached as master OOV, so they would all be scored as OOV.
+            raise ValueError(f"{len(missing)} words of the vocabulary, such as {missing[0]!r}, are not in "
+                             f"the token cache's master vocabulary: use a master vocabulary that includes them")
+        ids = {word: i for i, word in enumerate(vocab)}
+        table = torch.tensor([ids.get(word, ids[OOV]) for word in self.master], dtype=torch.int32)
+        self._tables[id(vocab)] = (vocab, table)
+        return table
+
+    def remapped(self, file: Path, vocab: Vocab) -> torch.Tensor:
+        """The tokens of file as ids in vocab."""
+        return self.remap_table(vocab)[self.token_ids(file).long()]
+
+
+def token_trigrams(tokens: torch.Tensor, eos: int, bos: int) -> torch.Tensor:
+    """Given a 1-dimensional tensor of token ids (as from `read_token_ids`), return 
+    the [n, 3] tensor of the trigrams that `read_trigrams` would give, with columns x, y, z."""
+    starts = torch.ones(len(tokens), dtype=torch.bool)   # does each token start a sequence?
+    starts[1:] = tokens[:-1] == eos
+    y = torch.full_like(tokens, bos)
+    y[1:] = tokens[:-1]
+    y[starts] = bos
+    x = torch.full_like(tokens, bos)
+    x[1:] = y[:-1]
+    x[starts] = bos
+    return torch.stack((x, y, tokens), dim=1)
+
+
+PERMUTATION_SLICE = 1 << 16   # positions of the shuffled corpus to convert to Python ints at a time
+
+
 def draw_trigrams_forever(file: Path, 
                           vocab: Vocab, 
-                          randomize: bool = False) -> Iterable[Trigram]:
+                          randomize: bool = False,
+                          buffer_size: Optional[int] = None) -> Iterable[Trigram]:
     """Infinite iterator over trigrams drawn from file.  We iterate over
     all the trigrams, then do it again ad infinitum.  This is useful for 
     SGD training.  
     
     If randomize is True, then randomize the order of the trigrams each time.  
-    This is more in the spirit of SGD, but the randomness makes the code harder to debug, 
-    and forces us to keep all the trigrams in memory at once.
+    This is more in the spirit of SGD, but the randomness makes the code harder to debug.
+    To shuffle, we keep the whole corpus in memory, but only as an array of 
+    integer word ids, plus a random permutation of the token positions.
+
+    For a corpus too big for even that, give a buffer_size: the file is then
+    streamed as usual, and each trigram is drawn at random from a buffer of
+    the next buffer_size trigrams.  This only shuffles locally.
+
+    An empty corpus raises ValueError, since there would be nothing to draw.
     """
-    trigrams = read_trigrams(file, vocab)
     if not randomize:
-        import itertools
-        return itertools.cycle(trigrams)  # repeat forever
-    else:
-        import random
-        pool = tuple(trigrams)   
-        while True:
-            for trigram in random.sample(pool, len(pool)):
+        while True:   # reread the file each time, rather than keeping it in memory
+            empty = True
+            for trigram in read_trigrams(file, vocab):
+                empty = False
                 yield trigram
+            if empty:
+                raise ValueError(f"No trigrams to draw from the empty corpus {file}")
+
+    if buffer_size is not None:
+        buffer: List[Trigram] = []
+        while True:
+            for trigram in read_trigrams(file, vocab):
+                if len(buffer) < buffer_size:
+                    buffer.append(trigram)
+                    continue
+                # Yield a random trigram from the buffer, and put the new one in its place.
+                i = random.randrange(buffer_size)
+                yield buffer[i]
+                buffer[i] = trigram
+            # At the end of each pass, there's no need to empty the buffer:
+            # the next pass will keep drawing from it.
+            if not buffer:
+                raise ValueError(f"No trigrams to draw from the empty corpus {file}")
+            buffer_size = min(buffer_size, len(buffer))   # a corpus smaller than the buffer fits in it
+
+    types = list(vocab)
+    ids = {w: i for i, w in enumerate(types)}
+    tokens = read_token_ids(file, ids)
+    if not tokens:
+        raise ValueError(f"No trigrams to draw from the empty corpus {file}")
+    eos = ids[EOS]
+    while True:
+        # A random permutation of the token positions.  Each position k is the z
+        # of a trigram; we recover x and y by looking back.  The permutation stays
+        # a tensor of 4-byte ints; we only turn a slice of it at a time into
+        # Python ints.
+        order = torch.randperm(len(tokens), dtype=torch.int32)
+        for start in range(0, len(order), PERMUTATION_SLICE):
+            for k in order[start:start + PERMUTATION_SLICE].tolist():
+                y = BOS if k < 1 or tokens[k-1] == eos else types[tokens[k-1]]
+                x = BOS if y == BOS or k < 2 or tokens[k-2] == eos else types[tokens[k-2]]
+                yield (x, y, types[tokens[k]])
+
+
+def read_trigram_types(file: Path, vocab: Vocab) -> Counter[Trigram]:
+    """Count the tokens of each distinct trigram type (x,y,z) in file.
+    Many triples repeat, and a corpus such as gen-times2 has exactly the
+    same types as gen, just with twice the counts."""
+    return Counter(read_trigrams(file, vocab))
+
+
+def minibatches(n: int, batch_size: int, shuffle: bool = False) -> Iterable[torch.Tensor]:
+    """Iterator over the row indices 0 ... n-1 of some training data, in chunks 
+    of batch_size (the last chunk may be smaller).  If shuffle is True, the rows
+    are visited in a fresh random order."""
+    order = torch.randperm(n) if shuffle else torch.arange(n)
+    for start in range(0, n, batch_size):
+        yield order[start:start + batch_size]
+
+
+T = TypeVar("T")
+
+def prefetch(make_batch: Callable[[T], Minibatch], items: Iterable[T],
+             depth: int = 2, workers: int = 1) -> Iterator[Minibatch]:
+    """Iterator over make_batch(item) for the given items, where the batches are
+    made ahead of time by `workers` background threads and held in a queue of
+    up to `depth` ready batches.  So building the next minibatch overlaps with
+    training on this one.  (Threads suffice because PyTorch releases Python's
+    global interpreter lock inside its tensor operations.)
+
+    With a single worker the batches come out in order; with more, they may not.
+    If depth is 0, the batches are simply made on demand in this thread."""
+    if depth <= 0:
+        yield from map(make_batch, items)
+        return
+
+    source = iter(items)
+    lock = threading.Lock()         # only one thread may advance `source` at a time
+    ready: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()        # set when the consumer goes away
+    finished = object()             # each worker's last message
+
+    def put(message) -> None:
+        while not stop.is_set():    # don't block forever on a consumer that has stopped
+            try:
+                ready.put(message, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def work() -> None:
+        try:
+            while not stop.is_set():
+                with lock:
+                    item = next(source, finished)
+                if item is finished:
+                    break
+                put(make_batch(item))   # type: ignore[arg-type]
+        except Exception as e:
+            put(e)                      # re-raised in the consumer's thread
+        finally:
+            put(finished)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            message = ready.get()
+            if message is finished:
+                running -= 1
+            elif isinstance(message, Exception):
+                raise message
+            else:
+                yield message
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def save_atomically(obj, path: Path) -> None:
+    """torch.save obj to path.  We write a temporary file first and then rename it,
+    so that a crash during saving can't leave a truncated file at path."""
+    temp = path.with_name(path.name + ".tmp")
+    torch.save(obj, temp, pickle_protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, path)
+
+
+def accumulate_grad(param: torch.Tensor, grad: torch.Tensor) -> None:
+    """Add grad into param.grad, as back-propagation would."""
+    if param.grad is None:
+        param.grad = grad.detach().clone()
+    else:
+        param.grad.add_(grad)
+
+
+##### INTEGERIZED TRAINING DATA FOR THE LOG-LINEAR MODELS
+# The log-linear models train on minibatches of "rows" of one of these two
+# kinds.  (See EmbeddingLogLinearLanguageModel.training_data.)
+
+class TrigramRows:
+    """Trigrams as a [n, 3] tensor of word ids (columns x, y, z), where each
+    row stands for `weights[i]` training tokens.  The rows are either the
+    tokens of the corpus (weight 1) or its distinct trigram types."""
+
+    def __init__(self, trigrams: torch.Tensor, weights: torch.Tensor):
+        self.trigrams = trigrams
+        self.weights = weights
+
+    def __len__(self) -> int:
+        return len(self.trigrams)
+
+    def num_tokens(self) -> int:
+        return int(self.weights.sum().item())
+
+    def outcome_counts(self, vocab_size: int) -> torch.Tensor:
+        """Count of each word type z in the z column."""
+        return torch.zeros(vocab_size).index_add_(0, self.trigrams[:, 2], self.weights)
+
+    def minibatch(self, rows: torch.Tensor) -> Minibatch:
+        """Return the word ids x and y of the given rows, and one observed
+        entry per row: its z, with its weight as the count."""
+        x, y, z = self.trigrams[rows].unbind(1)
+        return x, y, torch.arange(len(rows)), z, self.weights[rows]
+
+
+class ContextHistograms:
+    """The training trigrams grouped by their context (x,y).  Row c is a
+    context, and the outcomes z observed after it (with their counts) are
+    stored at positions offsets[c] ... offsets[c+1]-1 of `outcomes` and `counts`.
+    """
+
+    def __init__(self, types: TrigramRows):
+        """Group weighted trigram types by context."""
+        self.contexts, inverse = torch.unique(types.trigrams[:, :2], dim=0, return_inverse=True)
+        order = torch.argsort(inverse, stable=True)
+        self.outcomes = types.trigrams[order, 2]
+        self.counts = types.weights[order]
+        sizes = torch.bincount(inverse, minlength=len(self.contexts))
+        self.offsets = torch.cat((torch.zeros(1, dtype=torch.long), torch.cumsum(sizes, 0)))
+
+    def __len__(self) -> int:
+        return len(self.contexts)
+
+    def num_tokens(self) -> int:
+        return int(self.counts.sum().item())
+
+    def outcome_counts(self, vocab_size: int) -> torch.Tensor:
+        """Count of each word type z over all contexts."""
+        return torch.zeros(vocab_size).index_add_(0, self.outcomes, self.counts)
+
+    def minibatch(self, rows: torch.Tensor) -> Minibatch:
+        """Return the word ids x and y of the contexts in rows, and an observed
+        entry for each outcome z of each context, with its count."""
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        # For each outcome belonging to these contexts, find its minibatch row
+        # and its position in `outcomes`.
+        batch_row = torch.repeat_interleave(torch.arange(len(rows)), lengths)
+        first = torch.repeat_interleave(torch.cumsum(lengths, 0) - lengths, lengths)
+        entries = torch.repeat_interleave(starts, lengths) + torch.arange(len(batch_row)) - first
+        x, y = self.contexts[rows].unbind(1)
+        return x, y, batch_row, self.outcomes[entries], self.counts[entries]
+
+##### AVERAGED PARAMETERS
+
+class ParameterAverage:
+    """Running average of the parameters of a module over the SGD iterates
+    it has been updated with ("Polyak-Ruppert averaging").  The average of
+    noisy iterates that bounce around an optimum is closer to the optimum
+    than the last iterate, so it can reach a given dev perplexity sooner."""
+
+    def __init__(self, module: nn.Module):
+        """Start the average at the module's current parameters."""
+        self.count = 1
+        self.average = {name: p.detach().clone() for name, p in module.named_parameters()}
+
+    @torch.no_grad()
+    def update(self, module: nn.Module) -> None:
+        """Add the module's current parameters into the average."""
+        self.count += 1
+        for name, p in module.named_parameters():
+            self.average[name].add_(p - self.average[name], alpha=1 / self.count)
+
+    @torch.no_grad()
+    def swap(self, module: nn.Module) -> None:
+        """Exchange the module's parameters with the averaged ones.  (Calling
+        this again swaps them back.)"""
+        for name, p in module.named_parameters():
+            current = p.detach().clone()
+            p.copy_(self.average[name])
+            self.average[name] = current
+
+    def state_dict(self) -> Dict[str, object]:
+        return {"count": self.count, "average": self.average}
+
+    def load_state_dict(self, state: Dict[str, object]) -> None:
+        self.count, self.average = state["count"], state["average"]   # type: ignore
+
 
 ##### READ IN A VOCABULARY (e.g., from a file created by build_vocab.py)
 
+class CountedVocab(CompactIntegerizer):
+    """A vocabulary read from a binary vocab file: the words in decreasing
+    order of their training counts, so that frequent words get small ids,
+    which keeps the rows of count tables and the columns of E that are used
+    most often close together in memory.  The words are stored compactly,
+    and looked up without a Python dict (see `CompactIntegerizer`).  The
+    counts come along too, as does a hash of the file's contents."""
+
+    counts: np.ndarray
+    digest: str
+
+    def frequency(self, word: Wordtype) -> int:
+        """The training count of word (0 if it is not in the vocabulary)."""
+        i = self.index(word)
+        return 0 if i is None else int(self.counts[i])
+
+
+# A binary vocab file holds a header (magic, number of words, SHA-256 of the
+# rest), the counts as 8-byte little-endian ints, and the words as saved by
+# `CompactIntegerizer.to_bytes`, all in decreasing order of count.  It is
+# memory-mapped when read, so the words are never copied into Python objects.
+# build_vocab.py also saves its table of word counts in this format: that
+# table is just the binary vocab of every word in the corpus.
+VOCAB_MAGIC = b"BINVOCAB2\n"
+VOCAB_HEADER = struct.Struct("<Q32s")
+
+
+def by_frequency(word_counts: Counter[Wordtype]) -> List[Wordtype]:
+    """The words in decreasing order of count, ties broken alphabetically."""
+    return sorted(word_counts, key=lambda w: (-word_counts[w], w))
+
+
+def write_binary_vocab(word_counts: Counter[Wordtype], output: Path) -> None:
+    """Save a vocabulary, given as the counts of its words, in the binary format."""
+    words = by_frequency(word_counts)
+    counts = np.array([word_counts[w] for w in words], dtype="<u8")
+    body = counts.tobytes() + CompactIntegerizer(words).to_bytes()
+    digest = hashlib.sha256(body).digest()
+    temp = output.with_name(output.name + ".tmp")
+    with open(temp, "wb") as f:
+        f.write(VOCAB_MAGIC + VOCAB_HEADER.pack(len(words), digest) + body)
+    temp.replace(output)
+
+
+def parse_binary_vocab(data, vocab_file: Path) -> CountedVocab:
+    """The vocabulary in data, the contents of a binary vocab file (perhaps memory-mapped)."""
+    start = len(VOCAB_MAGIC) + VOCAB_HEADER.size
+    n, digest = VOCAB_HEADER.unpack_from(data, len(VOCAB_MAGIC))
+    try:
+        if hashlib.sha256(memoryview(data)[start:]).digest() != digest:
+            raise ValueError
+        vocab = CountedVocab.from_buffer(data, start + 8 * n)
+        if len(vocab) != n:
+            raise ValueError
+    except (ValueError, struct.error):
+        raise ValueError(f"Binary vocab file {vocab_file} is truncated or corrupted")
+    vocab.counts = np.frombuffer(data, dtype="<u8", count=n, offset=start)
+    vocab.digest = digest.hex()
+    return vocab
+
+
 def read_vocab(vocab_file: Path) -> Vocab:
+    """Read a vocab file made by build_vocab.py.  A binary file gives a
+    CountedVocab, in frequency order; a text file (one word per line) gives
+    a sorted list of its words."""
+    with open(vocab_file, "rb") as f:
+        magic = f.read(len(VOCAB_MAGIC))
+        if magic == VOCAB_MAGIC:
+            counted = parse_binary_vocab(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), vocab_file)
+            log.info(f"Read vocab of size {len(counted)} from {vocab_file}")
+            return counted
+    if magic.startswith(VOCAB_MAGIC[:8]):
+        raise ValueError(f"{vocab_file} is in an older binary vocab format: rebuild it with build_vocab.py --binary")
+
     vocab: Vocab = set()
     with open(vocab_file, "rt") as f:
         for line in f:
@@ -201,21 +839,21 @@ class LanguageModel:
     # careful to store those cases only once.  (How?)  That would make the
     # code slightly more complicated, but would be worth it in a real system.
 
-    def count_trigram_events(self, trigram: Trigram) -> None:
-        """Record one token of the trigram and also of its suffixes (for backoff)."""
+    def count_trigram_events(self, trigram: Trigram, count: int = 1) -> None:
+        """Record one token (or `count` tokens) of the trigram and also of its suffixes (for backoff)."""
         (x, y, z) = trigram
-        self.event_count[(x, y, z )] += 1
-        self.event_count[   (y, z )] += 1
-        self.event_count[      (z,)] += 1  # the comma is necessary to make this a tuple
-        self.event_count[        ()] += 1
+        self.event_count[(x, y, z )] += count
+        self.event_count[   (y, z )] += count
+        self.event_count[      (z,)] += count  # the comma is necessary to make this a tuple
+        self.event_count[        ()] += count
 
-    def count_trigram_contexts(self, trigram: Trigram) -> None:
-        """Record one token of the trigram's CONTEXT portion, 
+    def count_trigram_contexts(self, trigram: Trigram, count: int = 1) -> None:
+        """Record one token (or `count` tokens) of the trigram's CONTEXT portion, 
         and also the suffixes of that context (for backoff)."""
         (x, y, _) = trigram    # we don't care about z
-        self.context_count[(x, y )] += 1
-        self.context_count[   (y,)] += 1
-        self.context_count[     ()] += 1
+        self.context_count[(x, y )] += count
+        self.context_count[   (y,)] += count
+        self.context_count[     ()] += count
 
     def log_prob(self, x: Wordtype, y: Wordtype, z: Wordtype) -> float:
         """Computes an estimate of the trigram log probability log p(z | x,y)
@@ -230,9 +868,49 @@ class LanguageModel:
             f"{class_name}.log_prob is not implemented yet (you should override LanguageModel.log_prob)"
         )
 
+    def top_k(self, x: Wordtype, y: Wordtype, k: int = 10,
+              normalize: bool = False) -> List[Tuple[Wordtype, float]]:
+        """The k most probable words z after the context xy, best first, each with
+        a score.  With normalize=True, the score is the log-probability log p(z | xy)
+        (a natural log, as from `log_prob`), which can be compared across contexts
+        and models, or thresholded.  By default, a model whose normalizer is costly
+        may instead give log p(z | xy) plus a constant that depends only on xy,
+        which ranks the words just the same.  (The models here whose log-probabilities
+        cost no more than that give log-probabilities anyway.)  Subclasses override
+        this to avoid scoring the whole vocabulary, as it does here."""
+        scored = ((z, self.log_prob(x, y, z)) for z in self.vocab)
+        return heapq.nlargest(k, scored, key=lambda pair: pair[1])
+
+    # A model that can score many tokens at once says so here, and overrides
+    # `log_prob_token_ids` to do it.  Then fileprob.py and textcat.py integerize
+    # each whole file and score it that way, rather than token by token.
+    scores_in_batches = False
+
+    def word_ids(self) -> Dict[Wordtype, int]:
+        """Map each vocab word to its id, its position in the vocab.  (Built once,
+        since `self.vocab.index` is a linear search when the vocab is a sorted list.)"""
+        ids = getattr(self, "_word_ids", None)
+        if ids is None:
+            ids = {w: i for i, w in enumerate(self.vocab)}
+            self._word_ids = ids
+        return ids
+
+    def log_prob_token_ids(self, token_ids: torch.Tensor) -> float:
+        """The total log-probability of a corpus already integerized against the
+        vocab (as by `TokenCache.remapped`): the same as summing log_prob over
+        its trigrams, as fileprob.py does for a file."""
+        words = list(self.vocab) + [BOS]
+        trigrams = token_trigrams(token_ids.long(), eos=words.index(EOS), bos=len(words) - 1)
+        total = 0.0
+        for x, y, z in trigrams.tolist():
+            total += self.log_prob(words[x], words[y], words[z])
+            if total == -math.inf:
+                break
+        return total
+
     def save(self, model_path: Path) -> None:
         log.info(f"Saving model to {model_path}")
-        torch.save(self, model_path, pickle_protocol=pickle.HIGHEST_PROTOCOL)
+        save_atomically(self, model_path)
             # torch.save is similar to pickle.dump but handles tensors too
         log.info(f"Saved model to {model_path}")
 
@@ -247,20 +925,35 @@ class LanguageModel:
         log.info(f"Loaded model from {model_path}")
         return model
 
-    def train(self, file: Path) -> None:
+    def train(self, file: Path, token_ids: Optional[torch.Tensor] = None) -> None:
         """Create vocabulary and store n-gram counts.  In subclasses, we might
-        override this with a method that computes parameters instead of counts."""
+        override this with a method that computes parameters instead of counts.
+
+        If token_ids is given, it is the corpus already integerized against the
+        vocab (as by `TokenCache.remapped`), and the file is not read."""
 
         log.info(f"Training from corpus {file}")
 
         # Clear out any previous training.
         self.event_count   = Counter()
         self.context_count = Counter()
-
-        for trigram in read_trigrams(file, self.vocab):
-            self.count_trigram_events(trigram)
-            self.count_trigram_contexts(trigram)
-            self.show_progress()
+        self._continuations = None   # index of the old counts (see CountBasedLanguageModel.continuations)
+
+        if token_ids is not None:
+            # Count each distinct trigram once, with its number of tokens.
+            words = list(self.vocab) + [BOS]
+            trigrams = token_trigrams(token_ids.long(), eos=words.index(EOS), bos=len(words) - 1)
+            types, counts = torch.unique(trigrams, dim=0, return_counts=True)
+            for (x, y, z), count in zip(types.tolist(), counts.tolist()):
+                trigram = (words[x], words[y], words[z])
+                self.count_trigram_events(trigram, count)
+                self.count_trigram_contexts(trigram, count)
+                self.show_progress()
+        else:
+            for trigram in read_trigrams(file, self.vocab):
+                self.count_trigram_events(trigram)
+                self.count_trigram_contexts(trigram)
+                self.show_progress()
 
         sys.stderr.write("\n")  # done printing progress dots "...."
         log.info(f"Finished counting {self.event_count[()]} tokens")
@@ -274,6 +967,74 @@ class LanguageModel:
 
 ##### SPECIFIC FAMILIES OF LANGUAGE MODELS
 
+class SparseDistribution:
+    """A distribution over the vocabulary of the form
+
+        p(z) = seen[z] + rest * backoff(z)
+
+    where only the words in `seen` -- usually few -- get any probability of
+    their own, and `backoff` is another such distribution (None means the
+    uniform distribution).  This is the shape of every count-based model
+    here: for add-lambda, seen[z] = c(xyz) / (c(xy) + lambda V) and the
+    backoff is uniform; for backoff add-lambda, the backoff is the bigram
+    distribution, whose own backoff is the unigram distribution.
+
+    So we can find the most probable words, or sample a word, in time
+    proportional to the number of seen words rather than to |V|.
+    """
+
+    def __init__(self, seen: List[Tuple[Wordtype, float]], rest: float,
+                 backoff: Optional[SparseDistribution], vocab: Vocab):
+        self.seen = seen            # pairs (z, seen[z]), most probable first
+        self.own = dict(seen)
+        self.rest = rest
+        self.backoff = backoff
+        self.vocab = vocab
+        # The total probability.  This is 1 if the model is properly normalized,
+        # but we don't rely on that when sampling.
+        self.total = sum(self.own.values()) + rest * (1.0 if backoff is None else backoff.total)
+
+    def prob(self, z: Wordtype) -> float:
+        base = 1 / len(self.vocab) if self.backoff is None else self.backoff.prob(z)
+        return self.own.get(z, 0.0) + self.rest * base
+
+    def candidates(self, k: int) -> List[Wordtype]:
+        """A short list of words that includes k most probable ones."""
+        if self.backoff is None:
+            # Under a uniform backoff, the seen words come first in order, and the
+            # unseen words are all tied after them, so any of them will do.
+            words = [z for z, _ in self.seen[:k]]
+            if len(words) < k:
+                chosen = set(words)
+                words.extend(itertools.islice((z for z in self.vocab if z not in chosen), k - len(words)))
+            return words
+        # An unseen word's probability is proportional to its backoff probability, so
+        # the best unseen words are among the best k + len(seen) words of the backoff.
+        seen = [z for z, _ in self.seen]
+        return list(dict.fromkeys(seen + self.backoff.candidates(k + len(seen))))
+
+    def top_k(self, k: int) -> List[Tuple[Wordtype, float]]:
+        """The k most probable words with their probabilities, best first."""
+        scored = [(z, self.prob(z)) for z in self.candidates(k)]
+        return sorted(scored, key=lambda pair: pair[1], reverse=True)[:k]
+
+    def sample(self, rng: Optional[random.Random] = None) -> Wordtype:
+        """Draw a word z with probability p(z) / total."""
+        draw = rng or random   # the random module has the same methods as a Random
+        u = draw.random() * self.total
+        for z, p in self.seen:
+            u -= p
+            if u < 0:
+                return z
+        if self.backoff is None:
+            return draw.choice(self.vocab if isinstance(self.vocab, (list, tuple)) else list(self.vocab))
+        return self.backoff.sample(rng)
+
+    def probs(self) -> Dict[Wordtype, float]:
+        """The probability of every word in the vocabulary.  This takes time |V|."""
+        return {z: self.prob(z) for z in self.vocab}
+
+
 class CountBasedLanguageModel(LanguageModel):
 
     def log_prob(self, x: Wordtype, y: Wordtype, z: Wordtype) -> float:
@@ -296,10 +1057,41 @@ class CountBasedLanguageModel(LanguageModel):
             f"{class_name}.prob is not implemented yet (you should override CountBasedLanguageModel.prob)"
         )
 
+    def continuations(self, context: Ngram) -> List[Tuple[Wordtype, int]]:
+        """The words z seen after the context (a tuple of 0, 1 or 2 words), with
+        their counts c(context z), most frequent first.  The index of all
+        contexts is built from event_count on first use."""
+        index = getattr(self, "_continuations", None)
+        if index is None:
+            index = {}
+            for ngram, count in self.event_count.items():
+                if ngram:   # skip the zerogram, which isn't an event
+                    index.setdefault(ngram[:-1], []).append((ngram[-1], count))
+            for seen in index.values():
+                seen.sort(key=lambda pair: pair[1], reverse=True)
+            self._continuations = index
+            self._unigram = None   # any cached distribution was built from the old index
+        return index.get(tuple(context), [])
+
+    def distribution(self, x: Wordtype, y: Wordtype) -> SparseDistribution:
+        """The distribution p(z | x,y) over all z.  Subclasses whose probabilities
+        have a closed form for the unseen words override this to avoid the
+        |V| calls to prob that it takes here."""
+        return SparseDistribution(sorted(((z, self.prob(x, y, z)) for z in self.vocab),
+                                         key=lambda pair: pair[1], reverse=True),
+                                  0.0, None, self.vocab)
+
+    def top_k(self, x: Wordtype, y: Wordtype, k: int = 10,
+              normalize: bool = False) -> List[Tuple[Wordtype, float]]:
+        return [(z, math.log(p) if p > 0 else -math.inf) for z, p in self.distribution(x, y).top_k(k)]
+
 class UniformLanguageModel(CountBasedLanguageModel):
     def prob(self, x: Wordtype, y: Wordtype, z: Wordtype) -> float:
         return 1 / self.vocab_size
 
+    def distribution(self, x: Wordtype, y: Wordtype) -> SparseDistribution:
+        return SparseDistribution([], 1.0, None, self.vocab)
+
 
 class AddLambdaLanguageModel(CountBasedLanguageModel):
     def __init__(self, vocab: Vocab, lambda_: float) -> None:
@@ -318,6 +1110,17 @@ class AddLambdaLanguageModel(CountBasedLanguageModel):
         # over all values of typeZ will give 1, so sum_z p(z | ...) = 1
         # as is required for any probability function.
 
+    def smoothed(self, context: Ngram, backoff: Optional[SparseDistribution]) -> SparseDistribution:
+        """(c(context z) + lambda V backoff(z)) / (c(context) + lambda V) as a
+        SparseDistribution over z, where a backoff of None is uniform."""
+        denom = self.context_count[tuple(context)] + self.lambda_ * self.vocab_size
+        return SparseDistribution([(z, c / denom) for z, c in self.continuations(context)],
+                                  self.lambda_ * self.vocab_size / denom, backoff, self.vocab)
+
+    def distribution(self, x: Wordtype, y: Wordtype) -> SparseDistribution:
+        # Every unseen z gets the same probability lambda / (c(xy) + lambda V).
+        return self.smoothed((x, y), None)
+
 
 class BackoffAddLambdaLanguageModel(AddLambdaLanguageModel):
     def __init__(self, vocab: Vocab, lambda_: float) -> None:
@@ -349,6 +1152,17 @@ class BackoffAddLambdaLanguageModel(AddLambdaLanguageModel):
         # 1-element tuple (z,). If you're looking up counts,
         # these will have very different counts!
 
+    def distribution(self, x: Wordtype, y: Wordtype) -> SparseDistribution:
+        # The same three levels as prob.  The unigram level is the same for every
+        # context (and has nearly all of V as its seen words), so we build it once.
+        seen = self.continuations(())
+        unigram = getattr(self, "_unigram", None)
+        if unigram is None:
+            denom = self.event_count[()] + self.lambda_ * self.vocab_size
+            unigram = self._unigram = SparseDistribution(
+                [(z, c / denom) for z, c in seen], self.lambda_ / denom, None, self.vocab)
+        return self.smoothed((x, y), self.smoothed((y,), unigram))
+
 
 class EmbeddingLogLinearLanguageModel(LanguageModel, nn.Module):
     # Note the use of multiple inheritance: we are both a LanguageModel and a torch.nn.Module.
@@ -385,6 +1199,7 @@ class EmbeddingLogLinearLanguageModel(LanguageModel, nn.Module):
         self.X = nn.Parameter(torch.zeros((self.dim, self.dim)), requires_grad=True)
         self.Y = nn.Parameter(torch.zeros((self.dim, self.dim)), requires_grad=True)
         self.epochs = epochs
+
     def log_prob(self, x: Wordtype, y: Wordtype, z: Wordtype) -> float:
         """Return log p(z | xy) according to this language model."""
         # https://pytorch.org/docs/stable/generated/torch.Tensor.item.html
@@ -432,12 +1247,19 @@ class EmbeddingLogLinearLanguageModel(LanguageModel, nn.Module):
         # you can write J @ K as shorthand for torch.mul(J, K).
         # J @ K looks more like the usual math notation.
 
-        x_vec = self.E[:, self.vocab.index(x) if x in self.vocab else self.vocab.index("OOV")]
-        y_vec = self.E[:, self.vocab.index(y) if y in self.vocab else self.vocab.index("OOV")]
-        h = self.X.T @ x_vec + self.Y.T @ y_vec
-        logits = h @ self.E  # shape [|V|]
-        return logits
-        
+        if isinstance(x, str):
+            x_vec = self.embeddings(self.vocab.index(x) if x in self.vocab else self.vocab.index("OOV"))
+            y_vec = self.embeddings(self.vocab.index(y) if y in self.vocab else self.vocab.index("OOV"))
+            h = self.X.T @ x_vec + self.Y.T @ y_vec
+            logits = self.project(h)  # shape [|V|], = h @ E
+            return logits
+
+        # batch: x and y are [B] tensors of word ids (see `integerize`)
+        x_vecs = self.embeddings(x)   # [d, B]
+        y_vecs = self.embeddings(y)   # [d, B]
+        h = self.X.T @ x_vecs + self.Y.T @ y_vecs  # [d, B]
+        return self.project(h.T)      # [B, |V|], = h.T @ E
+
         # This function's return type is declared (using the jaxtyping module)
         # to be a torch.Tensor whose elements are Floats, and which has one
         # dimension of length "vocab".  This can be multiplied in a type-safe
@@ -449,28 +1271,455 @@ class EmbeddingLogLinearLanguageModel(LanguageModel, nn.Module):
         # https://www.cs.jhu.edu/~jason/465/hw-lm/code/INSTRUCTIONS.html#a-note-on-type-annotations
         raise NotImplementedError("Implement me!")
 
-    def train(self, file: Path):    # type: ignore
+    # E may be stored in reduced precision for inference (see `quantize`).
+    # These two methods are the only ways that `logits` reads it.
+    compact_dtypes = (torch.float16, torch.bfloat16, torch.int8)
+
+    def embeddings(self, ids: Union[int, torch.Tensor]) -> torch.Tensor:
+        """The columns of E for the given word id(s), in full precision."""
+        columns = self.E[:, ids]
+        if self.E.dtype not in self.compact_dtypes:
+            return columns
+        scale = getattr(self, "E_scale", None)
+        columns = columns.to(self.X.dtype)
+        return columns if scale is None else columns * scale[ids]
+
+    dequantize_block = 4096   # columns of E to convert to full precision at a time
+
+    def project(self, h: torch.Tensor) -> torch.Tensor:
+        """Return h @ E, where h is a [d] vector or a [B, d] matrix."""
+        if self.E.dtype not in self.compact_dtypes:
+            return h @ self.E
+        # Convert E to full precision a block of columns at a time, so that
+        # only the compact E is read from memory, and each converted block
+        # is used right away (while it is still in cache).  That costs a pass
+        # over E per call, which a batch of contexts shares: so fileprob.py
+        # and textcat.py score batches of tokens (see `scores_in_batches`).
+        scale = getattr(self, "E_scale", None)
+        blocks = []
+        for start in range(0, self.E.shape[1], self.dequantize_block):
+            block = h @ self.E[:, start:start + self.dequantize_block].to(h.dtype)
+            if scale is not None:   # int8: the scale of each column just scales its output
+                block = block * scale[start:start + self.dequantize_block]
+            blocks.append(block)
+        return torch.cat(blocks, dim=-1)
+
+    PRECISIONS = ("float32", "float16", "bfloat16", "int8")
+
+    @torch.no_grad()
+    def quantize(self, precision: str) -> None:
+        """Store E in the given precision, to make the model smaller and its
+        scoring less memory-bound.  This is for inference only: a quantized
+        model can't be trained.  With "int8", each column of E is stored as
+        integers times a per-column scale (its largest absolute value / 127).
+        Quantization always starts from the current E, so do it only once."""
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}")
+        E = self.embeddings(torch.arange(self.E.shape[1]))   # current E, in full precision
+        self.E_scale = None
+        if precision == "int8":
+            self.E_scale = E.abs().amax(dim=0).clamp(min=1e-12) / 127
+            self.E = torch.round(E / self.E_scale).to(torch.int8)
+        else:
+            self.E = E.to(getattr(torch, precision))
+        self.lexicon = {}   # only needed to build E, and much bigger than it
+        self._mips_index = None
+
+    def __getstate__(self) -> Dict[str, object]:
+        """What pickling (and so `save`) stores: not the index that `top_k` builds on demand."""
+        state = super().__getstate__()   # a copy of the attributes
+        state.pop("_mips_index", None)
+        return state
+
+    # The logits of `logits(x, y)` are the inner products of a query vector for
+    # xy with fixed vectors for the words z.  So the most probable words z are
+    # a maximum inner product search (see mips.py).
+
+    def mips_columns(self) -> torch.Tensor:
+        """The matrix whose columns' inner products with `mips_query` are the logits."""
+        return self.embeddings(torch.arange(len(self.vocab)))
+
+    def mips_query(self, x: int, y: int) -> torch.Tensor:
+        """The query vector for the context with word ids x and y."""
+        return self.X.T @ self.embeddings(x) + self.Y.T @ self.embeddings(y)
+
+    @torch.no_grad()
+    def top_k(self, x: Wordtype, y: Wordtype, k: int = 10,           # type: ignore[override]
+              max_clusters: Optional[int] = None, normalize: bool = False) -> List[Tuple[Wordtype, float]]:
+        """The k most probable words z after the context xy, with their logits,
+        best first.  This uses an index of the words, built on first use, to find
+        them without computing all the logits.  The answer is exact unless
+        max_clusters limits the search (see `MIPSIndex.search`).
+
+        The logits are log p(z | xy) plus the same constant log Z(xy) for every z.
+        normalize=True subtracts log Z(xy) to give log-probabilities, but Z(xy)
+        sums over the whole vocabulary: that costs all the logits, which the
+        index exists to avoid."""
+        index = getattr(self, "_mips_index", None)
+        if index is None:
+            index = self._mips_index = MIPSIndex(self.mips_columns())
+        ids = self.word_ids()
+        oov = ids[OOV]
+        scores, words = index.search(self.mips_query(ids.get(x, oov), ids.get(y, oov)), k, max_clusters)
+        if normalize:
+            scores = scores - torch.logsumexp(self.logits(x, y), dim=-1)
+        return [(self.vocab[z], score) for z, score in zip(words.tolist(), scores.tolist())]
+
+    def log_prob_batch(self, x: torch.Tensor, y: torch.Tensor, z: torch.Tensor) -> Float[torch.Tensor,"batch"]:
+        """Return the vector of log p(z[i] | x[i] y[i]) for a batch of integerized trigrams."""
+        log_probs = torch.log_softmax(self.logits(x, y), dim=-1)  # [B, |V|]
+        return log_probs.gather(1, z.unsqueeze(1)).squeeze(1)
+
+    def integerize(self, trigrams: Iterable[Trigram]) -> torch.Tensor:
+        """Convert trigrams of word types into a [n, 3] tensor of word ids (columns x, y, z).
+        As in `logits`, BOS and other words outside the vocab share the OOV column."""
+        ids = self.word_ids()
+        oov = ids[OOV]
+        rows = [(ids.get(x, oov), ids.get(y, oov), ids.get(z, oov)) for (x, y, z) in trigrams]
+        return torch.tensor(rows, dtype=torch.long).reshape(-1, 3)
+
+    def training_data(self, file: Path, by_type: bool = False, by_context: bool = False,
+                      token_ids: Optional[torch.Tensor] = None) -> Union[TrigramRows, ContextHistograms]:
+        """Return the training examples in file, integerized.
+
+        Normally there is one row per trigram token (in corpus order), with weight 1.
+        If by_type is True, there is instead one row per distinct trigram type,
+        weighted by its count.  The log-likelihood is a sum over tokens, so the
+        weighted sum over types is exactly the same objective F -- but an epoch
+        now costs time proportional to the number of types.
+
+        If by_context is True, the types are further grouped by their context (x,y),
+        so that an epoch computes each distinct context's softmax only once.
+
+        If token_ids is given, it is the file already integerized against the
+        vocab (as by `TokenCache.remapped`), and the file is not read."""
+        ids = self.word_ids()
+        if token_ids is not None:
+            trigrams = token_trigrams(token_ids.long(), eos=ids[EOS], bos=ids[OOV])
+            if not (by_type or by_context):
+                return TrigramRows(trigrams, torch.ones(len(trigrams)))
+            types, counts = torch.unique(trigrams, dim=0, return_counts=True)
+            rows = TrigramRows(types, counts.float())
+            return ContextHistograms(rows) if by_context else rows
+        if by_type or by_context:
+            types = read_trigram_types(file, self.vocab)
+            rows = TrigramRows(self.integerize(types.keys()),
+                               torch.tensor(list(types.values()), dtype=torch.float32))
+            return ContextHistograms(rows) if by_context else rows
+        # Integerize the corpus as a flat array of token ids, and only then
+        # expand it into trigrams.  As in `integerize`, BOS gets the OOV column.
+        tokens = torch.frombuffer(read_token_ids(file, ids), dtype=torch.int32).long()
+        trigrams = token_trigrams(tokens, eos=ids[EOS], bos=ids[OOV])
+        return TrigramRows(trigrams, torch.ones(len(trigrams)))
+
+    def batch_nll(self, trigrams: torch.Tensor, weights: torch.Tensor) -> TorchScalar:
+        """Weighted negative log-likelihood  sum_i weights[i] * -log p(z_i | x_i y_i)
+        of a minibatch of integerized trigrams."""
+        x, y, z = trigrams.unbind(1)
+        return -(weights * self.log_prob_batch(x, y, z)).sum()
+
+    def minibatch_nll(self, batch: Minibatch) -> TorchScalar:
+        """The weighted negative log-likelihood of a minibatch."""
+        x, y, row, z, count = batch
+        log_probs = torch.log_softmax(self.logits(x, y), dim=-1)  # one softmax per row, shared by all its outcomes
+        return -(count * log_probs[row, z]).sum()
+
+    def minibatch_backward(self, batch: Minibatch, scale: float) -> Tuple[float, float]:
+        """Accumulate into the parameters' .grad the gradient of scale * (weighted
+        negative log-likelihood of the minibatch).  Return that negative
+        log-likelihood and the number of tokens it covers."""
+        nll = self.minibatch_nll(batch)
+        (nll * scale).backward()
+        return nll.item(), batch[4].sum().item()
+
+    @torch.no_grad()
+    def analytic_backward(self, batch: Minibatch, scale: float) -> Tuple[float, float]:
+        """Same as `minibatch_backward`, but computes the gradient in closed
+        form rather than by building an autograd graph and back-propagating.
+
+        For each context xy in the minibatch, the gradient of the nll with
+        respect to the logits is the expected counts under the model minus
+        the observed counts, and `logits_backward` turns that into "expected
+        minus observed" outer products for the parameters."""
+        x, y, row, z, count = batch
+        log_probs = torch.log_softmax(self.logits(x, y), dim=-1)
+        nll = -(count * log_probs[row, z]).sum()
+        total = torch.zeros(len(x), dtype=count.dtype).index_add_(0, row, count)   # tokens per context
+        grad_logits = total.unsqueeze(1) * log_probs.exp()
+        grad_logits.index_put_((row, z), -count, accumulate=True)   # minus the observed counts
+        self.logits_backward(x, y, grad_logits * scale)
+        return nll.item(), total.sum().item()
+
+    @torch.no_grad()
+    def logits_backward(self, x: torch.Tensor, y: torch.Tensor, grad_logits: torch.Tensor) -> None:
+        """Given the gradient [B, |V|] of some objective with respect to
+        `logits(x, y)` for a batch of contexts, accumulate its gradient with
+        respect to the parameters into their .grad fields."""
+        # logits = h.T @ E where h = X.T @ x_vecs + Y.T @ y_vecs.
+        grad_h = self.E @ grad_logits.T                     # [d, B]
+        accumulate_grad(self.X, self.E[:, x] @ grad_h.T)    # [d, d]
+        accumulate_grad(self.Y, self.E[:, y] @ grad_h.T)
+
+    def regularized_parameters(self) -> List[nn.Parameter]:
+        """The parameters θ that the L2 penalty applies to."""
+        return [self.X, self.Y]
+
+    def weight_decay(self, N: int) -> float:
+        """The L2 penalty adds weight_decay · θ to the gradient of each F_i(θ).
+        Each token's share of the penalty is (C/N)·||θ||², so this is 2C/N."""
+        return 2 * self.l2 / N
+
+    @torch.no_grad()
+    def regularizer(self, N: int) -> float:
+        """Each training token's share of the L2 penalty, (weight_decay/2)·||θ||²."""
+        return (self.weight_decay(N) / 2) * sum(torch.sum(p ** 2).item() for p in self.regularized_parameters())
+
+    @torch.no_grad()
+    def regularizer_backward(self, N: int) -> None:
+        """Accumulate the gradient of `regularizer` into the parameters' .grad fields."""
+        for p in self.regularized_parameters():
+            accumulate_grad(p, self.weight_decay(N) * p)
+
+    OPTIMIZERS = ("sgd", "adam", "convergent")
+    default_optimizer = "sgd"
+
+    def make_optimizer(self, name: str, eta0: float, N: int) -> optim.Optimizer:
+        """Construct the optimizer called `name` (one of OPTIMIZERS) for training on N tokens.
+
+        Plain SGD steps on the gradient of the whole F_i(θ), including the
+        regularizer (see `train_step`).  The others apply the L2 penalty
+        themselves as weight decay (ConvergentSGD's is decoupled), so that
+        `train_step` never has to compute the penalty or its gradient."""
+        if name == "sgd":
+            return optim.SGD(self.parameters(), lr=eta0)
+        decay = self.weight_decay(N)
+        regularized = {id(p) for p in self.regularized_parameters()}
+        groups = [{"params": [p for p in self.parameters() if id(p) in regularized], "weight_decay": decay},
+                  {"params": [p for p in self.parameters() if id(p) not in regularized], "weight_decay": 0.0}]
+        groups = [group for group in groups if group["params"]]
+        if name == "adam":
+            return optim.Adam(groups, lr=eta0)
+        if name == "convergent":
+            # Bottou's learning rate schedule uses the strong convexity of the regularizer.
+            return ConvergentSGD(groups, eta0=eta0, lambda_=decay)
+        raise ValueError(f"Unknown optimizer {name}")
+
+    def prefetch_minibatches(self, data: Union[TrigramRows, ContextHistograms], batches: Iterable[torch.Tensor],
+                             depth: int = 2, workers: int = 1) -> Iterator[Minibatch]:
+        """The minibatches of data with the given rows, built in the background by `prefetch`."""
+        return prefetch(data.minibatch, batches, depth, workers)
+
+    grad_clip: Optional[float] = None   # max gradient norm in `train_step` (None = don't clip)
+
+    @staticmethod
+    def optimizer_decays(optimizer: optim.Optimizer) -> bool:
+        """Does the optimizer apply the L2 penalty itself (see `make_optimizer`)?"""
+        return any(group.get("weight_decay", 0.0) for group in optimizer.param_groups)
+
+    penalty_in_F = True   # does the F reported by `train` include the L2 penalty?
+
+    def train_step(self, optimizer: optim.Optimizer, batch: Minibatch,
+                   tokens_per_batch: float, N: int, analytic: bool = False) -> float:
+        """Take one optimizer step on a minibatch of the training data (see
+        `TrigramRows.minibatch`), and return its contribution to -N·F: its weighted negative
+        log-likelihood plus their tokens' share of the regularizer.  If the
+        optimizer applies the penalty itself as weight decay, the penalty is
+        left out here, so that the step never has to compute ||θ||²
+        (`train` adds it into F once per epoch instead).
+        If analytic is True, the gradient is computed by `analytic_backward`
+        rather than by autograd.
+
+        Each minibatch stands for `tokens_per_batch` tokens on average.  Dividing
+        its log-likelihood by that constant (rather than by its own token count)
+        keeps the sum of the minibatch objectives proportional to F, even when
+        the rows are trigram types or contexts with very different counts.
+        With one token per minibatch, this is exactly the per-token F_i(θ).
+
+        The step goes through a closure, so full-batch optimizers such as
+        optim.LBFGS, which re-evaluate the objective several times, also work."""
+        backward = self.analytic_backward if analytic else self.minibatch_backward
+        optimizer_decays = self.optimizer_decays(optimizer)
+        contribution: Optional[float] = None
+        def closure() -> float:
+            nonlocal contribution
+            optimizer.zero_grad()
+            nll, tokens = backward(batch, 1 / tokens_per_batch)
+            reg = 0.0
+            if not optimizer_decays:
+                reg = self.regularizer(N)
+                self.regularizer_backward(N)
+            if self.grad_clip is not None:
+                nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
+            if contribution is None:
+                contribution = nll + tokens * reg   # at the parameters before the step
+            return nll / tokens_per_batch + reg
+        optimizer.step(closure)
+        assert contribution is not None
+        return contribution
+
+    def gradient_check(self, batch: Minibatch, N: int, eps: float = 1e-6, samples: int = 10) -> float:
+        """Compare `analytic_backward` against central finite differences of
+        the minibatch objective  nll + (C/N)·||θ||²,  at `samples` random
+        coordinates of each parameter.  This is done in double precision on a
+        copy of the model.  Return the largest relative error found."""
+        import copy
+        model = copy.deepcopy(self).double()
+        model.E = model.E.double()   # plain tensors are not converted by .double()
+        if getattr(model, "unigram_counts", None) is not None:
+            model.unigram_counts = model.unigram_counts.double()
+        batch = tuple(t.double() if t.is_floating_point() else t for t in batch)   # type: ignore
+
+        @torch.no_grad()
+        def objective() -> float:
+            return model.minibatch_nll(batch).item() + model.regularizer(N)
+
+        model.zero_grad()
+        model.analytic_backward(batch, 1.0)
+        model.regularizer_backward(N)
+        worst = 0.0
+        for name, p in model.named_parameters():
+            values, grads = p.data.view(-1), p.grad.view(-1)
+            for i in torch.randperm(len(values))[:samples].tolist():
+                old = values[i].item()
+                values[i] = old + eps
+                plus = objective()
+                values[i] = old - eps
+                minus = objective()
+                values[i] = old
+                numeric, analytic = (plus - minus) / (2 * eps), grads[i].item()
+                error = abs(numeric - analytic) / max(1.0, abs(numeric), abs(analytic))
+                log.debug(f"gradient check {name}[{i}]: analytic {analytic:g}, numeric {numeric:g}")
+                worst = max(worst, error)
+        return worst
+
+    def check_gradient(self, batch: Minibatch, N: int, tolerance: float = 1e-4) -> None:
+        """Log the result of `gradient_check`, warning if it fails."""
+        error = self.gradient_check(batch, N)
+        if error > tolerance:
+            log.warning(f"Gradient check FAILED: relative error {error:g} > {tolerance:g}")
+        else:
+            log.info(f"Gradient check passed: relative error {error:g}")
+
+    default_batch_size = 1
+    shuffle = False                  # visit the training rows in a fresh random order each epoch?
+    patience: Optional[int] = None   # stop after this many epochs without improvement (None = never)
+    dev_patience = 1                 # same, when we are watching cross-entropy on dev data
+    min_improvement = 0.0            # how much the loss must drop to count as an improvement
+
+    def reset_parameters(self) -> None:
+        """Initialize the parameters before training."""
+        nn.init.zeros_(self.X)   # type: ignore
+        nn.init.zeros_(self.Y)   # type: ignore
+
+    def prepare(self, data: Union[TrigramRows, ContextHistograms]) -> None:
+        """Compute anything (other than the parameters) that the model gets from its training data."""
+        pass
+
+    def make_scheduler(self, optimizer: optim.Optimizer) -> Optional[optim.lr_scheduler.StepLR]:
+        """Learning rate schedule applied at the end of each epoch (None = keep it constant)."""
+        return None
+
+    scores_in_batches = True
+
+    @torch.no_grad()
+    def log_prob_token_ids(self, token_ids: torch.Tensor, batch_size: int = 256) -> float:
+        # Score the trigrams a batch at a time, rather than one by one as the parent does.
+        ids = self.word_ids()
+        trigrams = token_trigrams(token_ids.long(), eos=ids[EOS], bos=ids[OOV])
+        return sum(self.log_prob_batch(*trigrams[rows].unbind(1)).sum().item()
+                   for rows in minibatches(len(trigrams), batch_size))
+
+    @torch.no_grad()
+    def cross_entropy(self, data: TrigramRows, batch_size: int = 256) -> float:
+        """Cross-entropy, in bits per token, of the model on integerized trigrams
+        (see `training_data`).  This scores a whole batch of trigrams at a time."""
+        total = 0.0
+        for rows in minibatches(len(data), batch_size):
+            x, y, z = data.trigrams[rows].unbind(1)
+            total -= (data.weights[rows] * self.log_prob_batch(x, y, z)).sum().item()
+        return total / (math.log(2) * data.num_tokens())
+
+    def parameter_snapshot(self) -> Dict[str, torch.Tensor]:
+        """A copy of the current parameters, which `load_state_dict` can restore."""
+        return {name: value.detach().clone() for name, value in self.state_dict().items()}
+
+    def train(self, file: Path, by_type: bool = False, by_context: bool = False,    # type: ignore
+              batch_size: Optional[int] = None, learning_rate: Optional[float] = None,
+              analytic: bool = False, grad_check: bool = False,
+              optimizer: Optional[str] = None, prefetch_depth: int = 2, prefetch_workers: int = 1,
+              checkpoint: Optional[Path] = None, checkpoint_every: int = 0, resume: bool = False,
+              time_budget: Optional[float] = None, dev_file: Optional[Path] = None,
+              warm_start: bool = False, tolerance: Optional[float] = None, average_start: Optional[float] = None,
+              token_ids: Optional[torch.Tensor] = None, dev_token_ids: Optional[torch.Tensor] = None):
         
         ### Technically this method shouldn't be called `train`,
         ### because this means it overrides not only `LanguageModel.train` (as desired)
         ### but also `nn.Module.train` (which has a different type). 
         ### However, we won't be trying to use the latter method.
         ### The `type: ignore` comment above tells the type checker to ignore this inconsistency.
+
+        # If checkpoint is given, the state of training is saved there at the end 
+        # of each epoch (and every checkpoint_every steps), and with resume=True, 
+        # training picks up from the saved state.  On the CPU, the result is then
+        # exactly the same as if training had never been interrupted -- as long
+        # as there is only one prefetch worker, so that the minibatch order is fixed.
+        #
+        # If time_budget is given, training stops after that many seconds, and 
+        # (after checkpointing) keeps the parameters from the best epoch so far.
+        #
+        # If dev_file is given, we measure cross-entropy on it after each epoch.
+        # Training stops once that stops improving (see dev_patience), and 
+        # keeps the parameters from the epoch where it was best.
+        #
+        # If warm_start is True, training starts from the current parameters
+        # (e.g., those trained with a different l2) instead of reinitializing them.
+        #
+        # If tolerance is given and there is no dev_file, training stops as soon
+        # as an epoch improves the training objective F by less than tolerance
+        # (per token).  A warm start near the optimum then stops after an epoch or two.
+        #
+        # If average_start is given, then after that many epochs (which may be 
+        # fractional), we also keep a running average of the parameters after 
+        # each step.  The averaged parameters are the ones that are evaluated 
+        # at the end of each epoch and kept at the end of training.
+        #
+        # If token_ids (or dev_token_ids) is given, it is the training (or dev)
+        # corpus already integerized against the vocab, e.g. by `TokenCache.remapped`,
+        # and the file isn't read.
         
+        if self.E.dtype in self.compact_dtypes:
+            raise ValueError("Can't train a model whose embeddings have been quantized")
+        self._mips_index = None   # `top_k` will need a new one
+
         # Optimization hyperparameters.
         eta0 = 1e-2# 1e-5  # 1e-2 ID 1e-5 gen# initial learning rate
+        if learning_rate is not None:
+            eta0 = learning_rate
+
+        # One row per training token, or (by_type) one weighted row per distinct
+        # trigram, or (by_context) one row per distinct context.
+        data = self.training_data(file, by_type, by_context, token_ids)
+        N = data.num_tokens()
+        self.prepare(data)
+        # Held-out data, as weighted trigram types, since we only need the total log-probability.
+        dev = None if dev_file is None else self.training_data(dev_file, by_type=True, token_ids=dev_token_ids)
+        patience = self.patience if dev is None else self.dev_patience
+        min_improvement = self.min_improvement
+        if tolerance is not None and dev is None:
+            patience, min_improvement = 1, tolerance
 
         # This is why we needed the nn.Parameter above.
         # The optimizer needs to know the list of parameters
         # it should be trying to update.
-        optimizer = optim.SGD(self.parameters(), lr=eta0)
+        opt = self.make_optimizer(optimizer or self.default_optimizer, eta0, N)
+        decays = self.optimizer_decays(opt)
+        scheduler = self.make_scheduler(opt)
 
-        # Initialize the parameter matrices to be full of zeros.
-        nn.init.zeros_(self.X)   # type: ignore
-        nn.init.zeros_(self.Y)   # type: ignore
+        # Initialize the parameter matrices (e.g., to be full of zeros).
+        if not warm_start:
+            self.reset_parameters()
 
-        N = num_tokens(file)
-        log.info("Start optimizing on {N} training tokens...")
+        log.info(f"Start optimizing on {N} training tokens ({len(data)} rows per epoch)...")
 
         #####################
         # TODO: Implement your SGD here by taking gradient steps on a sequence
@@ -510,21 +1759,128 @@ class EmbeddingLogLinearLanguageModel(LanguageModel, nn.Module):
         # instead of iterating over
         #     read_trigrams(file)
         #####################
-        for epoch in range(self.epochs):
-            total_F = 0.0
-            count = 0
-            for (x, y, z) in tqdm(read_trigrams(file, self.vocab), total=N):
-                log_p = self.log_prob_tensor(x, y, z)
-                reg = (self.l2 / N) * (torch.sum(self.X ** 2) + torch.sum(self.Y ** 2))
-                loss = -log_p + reg
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                self.show_progress()
-                total_F -= loss.item()
-                count += 1
-            tqdm.write(f'F = {total_F/count}')
+        batch_size = self.default_batch_size if batch_size is None else batch_size
+        batch_size = batch_size if batch_size > 0 else len(data)   # 0 means full batch
+        n_batches = math.ceil(len(data) / batch_size)
+        tokens_per_batch = N / n_batches
+        if checkpoint is not None and prefetch_workers > 1:
+            log.warning("With several prefetch workers, the minibatch order varies, "
+                        "so resuming from a checkpoint won't exactly repeat an uninterrupted run")
+
+        # The state of training.  The loss is -F, summed over the epoch so far.
+        epoch, step, total_loss = 0, 0, 0.0
+        epoch_rng: Optional[torch.Tensor] = None   # random state that determined this epoch's row order
+        # The best epoch so far, judged by -F, or by dev cross-entropy if we have dev data.
+        best_loss = math.inf
+        best: Optional[Dict[str, torch.Tensor]] = None   # parameters at the end of the best epoch
+        wait = 0   # epochs since best_loss improved
+        average: Optional[ParameterAverage] = None   # created once we reach average_start
+        average_from = None if average_start is None else round(average_start * n_batches)   # in steps
+
+        def save_checkpoint() -> None:
+            assert checkpoint is not None
+            save_atomically({"model": self.state_dict(), "optimizer": opt.state_dict(),
+                             "scheduler": None if scheduler is None else scheduler.state_dict(),
+                             "rng": torch.get_rng_state(), "epoch_rng": epoch_rng,
+                             "epoch": epoch, "step": step, "total_loss": total_loss,
+                             "best_loss": best_loss, "best": best, "wait": wait,
+                             "average": None if average is None else average.state_dict()}, checkpoint)
+            log.debug(f"Saved checkpoint at epoch {epoch+1}, step {step} to {checkpoint}")
+
+        if resume and checkpoint is not None and checkpoint.exists():
+            saved = torch.load(checkpoint)
+            self.load_state_dict(saved["model"])
+            opt.load_state_dict(saved["optimizer"])
+            if scheduler is not None:
+                scheduler.load_state_dict(saved["scheduler"])
+            torch.set_rng_state(saved["rng"])
+            epoch, step, total_loss = saved["epoch"], saved["step"], saved["total_loss"]
+            epoch_rng, best_loss, best, wait = saved["epoch_rng"], saved["best_loss"], saved["best"], saved["wait"]
+            if saved["average"] is not None:
+                average = ParameterAverage(self)
+                average.load_state_dict(saved["average"])
+            log.info(f"Resuming from {checkpoint} at epoch {epoch+1}, step {step}")
+
+        start_time = time.perf_counter()
+        out_of_time = False
+        # (A checkpoint of a run that already stopped early stays stopped.)
+        while epoch < self.epochs and not (patience is not None and wait >= patience):
+            if step == 0:
+                epoch_rng = torch.get_rng_state()
+                rows = list(minibatches(len(data), batch_size, self.shuffle))
+            else:   
+                # Resuming partway through an epoch: regenerate its row order.
+                rng = torch.get_rng_state()
+                torch.set_rng_state(epoch_rng)
+                rows = list(minibatches(len(data), batch_size, self.shuffle))
+                torch.set_rng_state(rng)
+
+            epoch_start, first_step = time.perf_counter(), step
+            batches = self.prefetch_minibatches(data, rows[step:], prefetch_depth, prefetch_workers)
+            with closing(batches):   # stops the prefetching threads if we break out early
+                for batch in tqdm(batches, total=n_batches, initial=step, desc=f"Epoch {epoch+1}/{self.epochs}"):
+                    if grad_check and step == 0:
+                        self.check_gradient(batch, N)
+                    total_loss += self.train_step(opt, batch, tokens_per_batch, N, analytic)
+                    step += 1
+                    if average_from is not None and epoch * n_batches + step >= average_from:
+                        if average is None:
+                            average = ParameterAverage(self)
+                        else:
+                            average.update(self)
+                    self.show_progress()
+                    out_of_time = time_budget is not None and time.perf_counter() - start_time > time_budget
+                    if checkpoint is not None and step < n_batches and (
+                            out_of_time or (checkpoint_every and step % checkpoint_every == 0)):
+                        save_checkpoint()
+                    if out_of_time:
+                        break
+            if out_of_time and step < n_batches:
+                break
+
+            if decays and self.penalty_in_F:
+                # The steps left the penalty out of the loss; add it in at the epoch's
+                # final parameters, as one computation of ||θ||² per epoch.
+                total_loss += N * self.regularizer(N)
+            if scheduler is not None:
+                scheduler.step()
+            rate = N * (step - first_step) / n_batches / (time.perf_counter() - epoch_start)
+            if average is not None:
+                average.swap(self)   # judge (and keep a snapshot of) the averaged parameters
+            if dev is None:
+                loss = total_loss / N
+                tqdm.write(f"Epoch {epoch+1}: F = {-total_loss/N} ({rate:.0f} tokens/sec)")
+            else:
+                loss = self.cross_entropy(dev)
+                tqdm.write(f"Epoch {epoch+1}: F = {-total_loss/N}, dev cross-entropy = {loss:.5f} "
+                           f"bits per token ({rate:.0f} tokens/sec)")
 
+            if loss < best_loss - min_improvement:
+                best_loss, best, wait = loss, self.parameter_snapshot(), 0
+            else:
+                wait += 1
+            if average is not None:
+                average.swap(self)   # back to the last iterate, to continue training
+            epoch, step, total_loss = epoch + 1, 0, 0.0
+            if checkpoint is not None:
+                save_checkpoint()
+            if patience is not None and wait >= patience:
+                log.info(f"Stopping early: {'F' if dev is None else 'dev cross-entropy'} "
+                         f"has not improved for {wait} epochs")
+                break
+            if out_of_time:
+                break
+
+        self.epochs_trained = epoch   # which may be fewer than self.epochs
+        if average is not None:
+            average.swap(self)   # keep the averaged parameters
+            log.info(f"Using the parameters averaged over the last {average.count} steps")
+        if out_of_time:
+            log.warning(f"Stopped training after the time budget of {time_budget} sec")
+        if (out_of_time or dev is not None) and best is not None:
+            self.load_state_dict(best)
+            log.info(f"Keeping the parameters from the best epoch "
+                     f"({f'F = {-best_loss}' if dev is None else f'dev cross-entropy = {best_loss:.5f}'})")
 
         log.info("done optimizing.")
 
@@ -550,7 +1906,7 @@ class EmbeddingLogLinearLanguageModel(LanguageModel, nn.Module):
         # each parameter were changed slightly.
 
 
-class ImprovedLogLinearLanguageModel(LanguageModel, nn.Module):
+class ImprovedLogLinearLanguageModel(EmbeddingLogLinearLanguageModel):
     # TODO: IMPLEMENT ME!
     
     # This is where you get to come up with some features of your own, as
@@ -578,38 +1934,30 @@ class ImprovedLogLinearLanguageModel(LanguageModel, nn.Module):
     #   as `torch.optim.Adam` (https://pytorch.org/docs/stable/optim.html).
     #
     def __init__(self, vocab: Vocab, lexicon_file: Path, l2: float, epochs: int) -> None:
-        super().__init__(vocab)
-        if l2 < 0:
-            raise ValueError("Negative regularization strength {l2}")
-        self.l2: float = l2
+        # Reads the lexicon and sets up E, X and Y just like the parent class.
+        super().__init__(vocab, lexicon_file, l2, epochs)
 
-        lexicon = {}
-        match = re.search(r"(\d+)", str(lexicon_file))
-        self.dim = int(match.group(1))   # TODO: SET THIS TO THE DIMENSIONALITY OF THE VECTORS
-        
-        with open(lexicon_file, "r") as f:
-            for line in f:
-                parts = line.split()
-                word = parts[0]
-                vec = torch.tensor([float(x) for x in parts[1:]])
-                lexicon[word] = vec
-        self.lexicon = lexicon
-        self.E = torch.stack([lexicon[w] if w in lexicon else lexicon['OOL'] for w in vocab], dim=1)
-        
-
-        self.X = nn.Parameter(torch.zeros((self.dim, self.dim)), requires_grad=True)
-        self.Y = nn.Parameter(torch.zeros((self.dim, self.dim)), requires_grad=True)
         nn.init.xavier_uniform_(self.X)
         nn.init.xavier_uniform_(self.Y)
         # OOV feature
         self.x_oov = nn.Parameter(torch.zeros(self.dim))
         self.y_oov = nn.Parameter(torch.zeros(self.dim))
-        self.beta = nn.Parameter(torch.tensor(0.1))
         # Unigram
         self.unigram_counts = None  # filled in during training
         self.beta = nn.Parameter(torch.tensor(0.3))
-        
-        self.epochs = epochs
+        self.oov_feature_scored = True   # see __setstate__
+
+    def __setstate__(self, state: Dict[str, object]) -> None:
+        """Models saved before `oov_feature_scored` existed added the OOV
+        feature to every z when scoring a single context, where it cancels out
+        of the softmax.  Zeroing its weights keeps those models' scores."""
+        super().__setstate__(state)
+        if not getattr(self, "oov_feature_scored", False):
+            with torch.no_grad():
+                self.x_oov.zero_()
+                self.y_oov.zero_()
+            self.oov_feature_scored = True
+
     def logits(self, x: Wordtype, y: Wordtype) -> Float[torch.Tensor,"vocab"]:
         """Return a vector of the logs of the unnormalized probabilities f(xyz) * θ 
         for the various types z in the vocabulary.
@@ -625,12 +1973,13 @@ class ImprovedLogLinearLanguageModel(LanguageModel, nn.Module):
         # J @ K looks more like the usual math notation.
         oov_idx = self.vocab.index("OOV")
         if isinstance(x, str):
-            x_vec = self.E[:, self.vocab.index(x) if x in self.vocab else oov_idx]
-            y_vec = self.E[:, self.vocab.index(y) if y in self.vocab else oov_idx]
+            x_vec = self.embeddings(self.vocab.index(x) if x in self.vocab else oov_idx)
+            y_vec = self.embeddings(self.vocab.index(y) if y in self.vocab else oov_idx)
             # [d] vector
             h = self.X.T @ x_vec + self.Y.T @ y_vec
             oov_boost = (x_vec @ self.x_oov + y_vec @ self.y_oov)
-            logits = h @ self.E + oov_boost # [|V|]
+            logits = self.project(h) # [|V|]
+            logits[oov_idx] += oov_boost  # the OOV feature only fires for z = OOV, as in the batch case
             
             if self.unigram_counts is not None:
                 unigram_f = torch.log(self.unigram_counts + 1.0)
@@ -639,10 +1988,10 @@ class ImprovedLogLinearLanguageModel(LanguageModel, nn.Module):
             return logits
 
         # batch: [B]
-        x_vecs = self.E[:, x]   # [d, B]
-        y_vecs = self.E[:, y]   # [d, B]
+        x_vecs = self.embeddings(x)   # [d, B]
+        y_vecs = self.embeddings(y)   # [d, B]
         h = self.X.T @ x_vecs + self.Y.T @ y_vecs  # [d, B]
-        logits = (h.T @ self.E).contiguous()  # [B, |V|]
+        logits = self.project(h.T).contiguous()  # [B, |V|]
         
         # add oov boost
         oov_boost = (x_vecs.T @ self.x_oov + y_vecs.T @ self.y_oov).unsqueeze(1)  # [B,1]
@@ -671,76 +2020,231 @@ class ImprovedLogLinearLanguageModel(LanguageModel, nn.Module):
         else:
             return log_probs[torch.arange(len(z)), z]
 
-    def train(self, file: Path):  # type: ignore
-        eta0 = 1e-2
-        optimizer = optim.Adam(self.parameters(), lr=eta0, weight_decay=self.l2)
-        scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=3, gamma=0.7)
-
-        # ---- Build unigram counts ----
-        from collections import Counter
-        counter = Counter()
-        for (_, _, z) in read_trigrams(file, self.vocab):
-            counter[z] += 1
-        counts = torch.tensor([counter[w] for w in self.vocab], dtype=torch.float32)
+    grad_clip = 1.0   # Adam steps are clipped (see `train_step`)
+    penalty_in_F = False   # F is just the log-likelihood, with Adam's weight decay kept out of it
+
+    default_optimizer = "adam"
+
+    def regularized_parameters(self) -> List[nn.Parameter]:
+        return list(self.parameters())
+
+    def weight_decay(self, N: int) -> float:
+        return self.l2   # as for Adam's weight_decay, not divided by N
+
+    def mips_columns(self) -> torch.Tensor:
+        # Two extra rows, for the unigram and OOV features.
+        unigram_f = torch.zeros(len(self.vocab)) if self.unigram_counts is None else torch.log(self.unigram_counts + 1.0)
+        is_oov = torch.zeros(len(self.vocab))
+        is_oov[self.vocab.index("OOV")] = 1.0
+        return torch.cat((super().mips_columns(), unigram_f.unsqueeze(0), is_oov.unsqueeze(0)))
+
+    def mips_query(self, x: int, y: int) -> torch.Tensor:
+        oov_boost = self.embeddings(x) @ self.x_oov + self.embeddings(y) @ self.y_oov
+        return torch.cat((super().mips_query(x, y), self.beta.reshape(1), oov_boost.reshape(1)))
+
+    @torch.no_grad()
+    def logits_backward(self, x: torch.Tensor, y: torch.Tensor, grad_logits: torch.Tensor) -> None:
+        super().logits_backward(x, y, grad_logits)
+        # The OOV feature adds x_vec·x_oov + y_vec·y_oov to the OOV logit only.
+        grad_oov = grad_logits[:, self.vocab.index("OOV")]   # [B]
+        accumulate_grad(self.x_oov, self.E[:, x] @ grad_oov)
+        accumulate_grad(self.y_oov, self.E[:, y] @ grad_oov)
+        # The unigram feature adds beta * log(unigram_counts + 1) to every row.
+        if self.unigram_counts is not None:
+            unigram_f = torch.log(self.unigram_counts + 1.0)
+            accumulate_grad(self.beta, (grad_logits @ unigram_f).sum())
+
+    # Train on shuffled minibatches, with early stopping once the training
+    # objective stops improving.
+    default_batch_size = 32
+    shuffle = True
+    patience = 2
+    min_improvement = 1e-4
+
+    def reset_parameters(self) -> None:
+        pass   # keep the random initialization from __init__
+
+    def prepare(self, data: Union[TrigramRows, ContextHistograms]) -> None:
+        # The feature is the unigram distribution of the training data itself.  (Not the
+        # counts in a binary vocab file, which come from whatever corpora built the vocab.)
+        counts = data.outcome_counts(len(self.vocab))
         self.unigram_counts = counts / counts.sum()
 
-        # ---- Get infinite shuffled trigram stream ----
-        trigram_iter = draw_trigrams_forever(file, self.vocab, randomize=True)
-        N = num_tokens(file)
-        batch_size = 32
-        patience, wait = 2, 0
-        best_loss = float("inf")
-
-        print(f"Training with shuffled data, dim={self.dim}, {self.epochs} epochs")
-
-        for epoch in range(self.epochs):
-            total_loss = 0.0
-            batch = []
-            pbar = tqdm(range(N), desc=f"Epoch {epoch+1}/{self.epochs}")
-            for _ in pbar:
-                trigram = next(trigram_iter)
-                batch.append(trigram)
-
-                if len(batch) == batch_size:
-                    # --- Prepare tensors ---
-                    oov_idx = self.vocab.index("OOV")
-                    x_ids, y_ids, z_ids = [], [], []
-                    for (x, y, z) in batch:
-                        x_ids.append(self.vocab.index(x) if x in self.vocab else oov_idx)
-                        y_ids.append(self.vocab.index(y) if y in self.vocab else oov_idx)
-                        z_ids.append(self.vocab.index(z) if z in self.vocab else oov_idx)
-                    xb = torch.tensor(x_ids)
-                    yb = torch.tensor(y_ids)
-                    zb = torch.tensor(z_ids)
-
-                    # --- Compute loss ---
-                    optimizer.zero_grad()
-                    losses = []
-                    for i in range(len(batch)):
-                        losses.append(-self.log_prob_tensor(
-                            self.vocab[xb[i]], self.vocab[yb[i]], self.vocab[zb[i]]
-                        ))
-                    loss = torch.stack(losses).mean()
-
-                    # --- Backprop ---
-                    loss.backward()
-                    torch.nn.utils.clip_grad_norm_(self.parameters(), 1.0)
-                    optimizer.step()
-                    total_loss += loss.item()
-                    batch = []  # reset
-
-            scheduler.step()
-            avg_loss = total_loss / (N / batch_size)
-            print(f"Epoch {epoch+1}: F = {avg_loss:.6f}")
-
-            # ---- Early stopping ----
-            if avg_loss < best_loss - 1e-4:
-                best_loss = avg_loss
-                wait = 0
-            else:
-                wait += 1
-                if wait >= patience:
-                    print("Early stopping triggered.")
-                    break
+    def make_scheduler(self, optimizer: optim.Optimizer) -> Optional[optim.lr_scheduler.StepLR]:
+        # ConvergentSGD has its own decreasing learning rate.
+        return optim.lr_scheduler.StepLR(optimizer, step_size=3, gamma=0.7) if "lr" in optimizer.defaults else None
+
 
-        print("Finished training with shuffled mini-batch SGD.")
\ No newline at end of file
+class ClassFactoredLogLinearLanguageModel(EmbeddingLogLinearLanguageModel):
+    """A log-linear model whose softmax over the vocabulary is factored through
+    word classes:  p(z | xy) = p(class(z) | xy) · p(z | class(z), xy).
+    
+    Both factors are log-linear in the same hidden vector h = X^T x + Y^T y.
+    The class factor has a learned vector and bias per class, and the word
+    factor uses the embeddings E as before, but normalizes only over the 
+    words in the same class.  With about sqrt(|V|) classes of about sqrt(|V|) 
+    words each, the probability of one token costs O(d·sqrt(|V|)) rather than 
+    O(d·|V|).  The probabilities are still exactly normalized over the vocabulary.
+
+    The classes are built from the training data, either by binning the words
+    by frequency ("frequency"), or by k-means clustering of their embeddings ("kmeans").
+    """
+
+    CLUSTERINGS = ("frequency", "kmeans")
+
+    def __init__(self, vocab: Vocab, lexicon_file: Path, l2: float, epochs: int,
+                 num_classes: Optional[int] = None, clustering: str = "frequency") -> None:
+        super().__init__(vocab, lexicon_file, l2, epochs)
+        if clustering not in self.CLUSTERINGS:
+            raise ValueError(f"Unknown clustering method {clustering}")
+        self.clustering = clustering
+        self.num_classes = num_classes or math.ceil(math.sqrt(len(self.vocab)))
+        self.C = nn.Parameter(torch.zeros((self.dim, self.num_classes)))   # class vectors
+        self.b = nn.Parameter(torch.zeros(self.num_classes))               # class biases
+        # Until the classes are built in `prepare`, all the words are in a single class.
+        self.set_classes(torch.zeros(len(self.vocab), dtype=torch.long))
+
+    def set_classes(self, word_class: torch.Tensor) -> None:
+        """Given each word's class, build the tables that list the members of each class."""
+        _, word_class = torch.unique(word_class, return_inverse=True)   # number the (nonempty) classes 0, 1, ...
+        K = int(word_class.max().item()) + 1
+        order = torch.argsort(word_class, stable=True)
+        sizes = torch.bincount(word_class, minlength=K)
+        starts = torch.cumsum(sizes, 0) - sizes
+        position = torch.empty_like(word_class)
+        position[order] = torch.arange(len(word_class)) - starts[word_class[order]]
+        members = torch.zeros((K, int(sizes.max().item())), dtype=torch.long)   # padded with word 0 ...
+        members[word_class[order], position[order]] = order
+        mask = torch.arange(members.shape[1]) < sizes.unsqueeze(1)              # ... where this is False
+        self.word_class, self.position, self.class_members, self.class_mask = word_class, position, members, mask
+        if self.C.shape[1] != K:
+            self.C = nn.Parameter(torch.zeros((self.dim, K)))
+            self.b = nn.Parameter(torch.zeros(K))
+
+    def prepare(self, data: Union[TrigramRows, ContextHistograms]) -> None:
+        counts = data.outcome_counts(len(self.vocab))
+        # Start from the words in decreasing order of frequency, so that frequency
+        # binning puts the most frequent words together in small-cost classes.
+        order = torch.argsort(counts, descending=True, stable=True)
+        bins = torch.empty(len(self.vocab), dtype=torch.long)
+        bins[order] = torch.arange(len(self.vocab)) * self.num_classes // len(self.vocab)
+        if self.clustering == "frequency":
+            self.set_classes(bins)
+            return
+
+        # k-means on the embeddings, starting from the centroids of the frequency bins.
+        # (No random initialization, so that the classes are the same whenever
+        # we train on the same data, e.g., when resuming from a checkpoint.)
+        points = self.embeddings(torch.arange(len(self.vocab))).T   # [|V|, d]
+        word_class = bins
+        for _ in range(10):
+            sums = torch.zeros((self.num_classes, self.dim)).index_add_(0, word_class, points)
+            sizes = torch.bincount(word_class, minlength=self.num_classes).clamp(min=1)
+            word_class = torch.cdist(points, sums / sizes.unsqueeze(1)).argmin(dim=1)
+        self.set_classes(word_class)
+        log.info(f"Built {self.C.shape[1]} classes by k-means; the largest has {self.class_members.shape[1]} words")
+
+    def reset_parameters(self) -> None:
+        super().reset_parameters()
+        nn.init.zeros_(self.C)   # type: ignore
+        nn.init.zeros_(self.b)   # type: ignore
+
+    def regularized_parameters(self) -> List[nn.Parameter]:
+        return [self.X, self.Y, self.C]
+
+    def hidden(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+        """The [B, d] hidden vectors h for a batch of contexts."""
+        return (self.X.T @ self.embeddings(x) + self.Y.T @ self.embeddings(y)).T
+
+    def log_prob_batch(self, x: torch.Tensor, y: torch.Tensor, z: torch.Tensor) -> Float[torch.Tensor,"batch"]:
+        """Return the vector of log p(z[i] | x[i] y[i]), computing only the softmax 
+        over the classes and the softmax over the words in class(z[i])."""
+        h = self.hidden(x, y)                                                   # [B, d]
+        c = self.word_class[z]
+        log_p_class = torch.log_softmax(h @ self.C + self.b, dim=-1)            # [B, K]
+        members = self.class_members[c]                                         # [B, M]
+        word_logits = torch.einsum("bd,dbm->bm", h, self.embeddings(members))   # [B, M]
+        word_logits = word_logits.masked_fill(~self.class_mask[c], -math.inf)
+        log_p_word = torch.log_softmax(word_logits, dim=-1)
+        return (log_p_class.gather(1, c.unsqueeze(1)).squeeze(1) 
+                + log_p_word.gather(1, self.position[z].unsqueeze(1)).squeeze(1))
+
+    def log_prob_tensor(self, x: Wordtype, y: Wordtype, z: Wordtype) -> TorchScalar:
+        ids = self.word_ids()
+        oov = ids[OOV]
+        x_id, y_id, z_id = (torch.tensor([ids.get(w, oov)]) for w in (x, y, z))
+        return self.log_prob_batch(x_id, y_id, z_id)[0]
+
+    def logits(self, x: Wordtype, y: Wordtype) -> Float[torch.Tensor,"vocab"]:
+        """Return the log-probabilities of all the words z in the vocabulary (which
+        are valid logits, too).  Unlike `log_prob_batch`, this costs O(d·|V|)."""
+        if isinstance(x, str):
+            ids = self.word_ids()
+            oov = ids[OOV]
+            return self.logits(torch.tensor([ids.get(x, oov)]), torch.tensor([ids.get(y, oov)]))[0]
+
+        h = self.hidden(x, y)                                                   # [B, d]
+        log_p_class = torch.log_softmax(h @ self.C + self.b, dim=-1)            # [B, K]
+        word_logits = self.project(h)                                           # [B, |V|]
+        # Normalize the word logits within each class.
+        grouped = word_logits[:, self.class_members].masked_fill(~self.class_mask, -math.inf)   # [B, K, M]
+        log_Z = torch.logsumexp(grouped, dim=-1)                                # [B, K]
+        return log_p_class[:, self.word_class] + word_logits - log_Z[:, self.word_class]
+
+    # Training.  The minibatches are simply (trigrams, weights), since the
+    # training objective never looks at the other words' logits.
+
+    def prefetch_minibatches(self, data: Union[TrigramRows, ContextHistograms], batches: Iterable[torch.Tensor],
+                             depth: int = 2, workers: int = 1) -> Iterator[Minibatch]:
+        if not isinstance(data, TrigramRows):
+            raise ValueError("The class-factored model trains on trigram tokens or types, not contexts")
+        return prefetch(lambda rows: (data.trigrams[rows], data.weights[rows]), batches, depth, workers)  # type: ignore
+
+    def minibatch_nll(self, batch: Minibatch) -> TorchScalar:
+        trigrams, weights = batch   # type: ignore
+        return self.batch_nll(trigrams, weights)
+
+    def minibatch_backward(self, batch: Minibatch, scale: float) -> Tuple[float, float]:
+        nll = self.minibatch_nll(batch)
+        (nll * scale).backward()
+        return nll.item(), batch[1].sum().item()
+
+    @torch.no_grad()
+    def analytic_backward(self, batch: Minibatch, scale: float) -> Tuple[float, float]:
+        """Same as `minibatch_backward`, but in closed form.  Each of the two
+        softmaxes contributes the usual "expected minus observed": for row i
+        with weight w_i, the gradient of the nll with respect to the class
+        logits h·C + b is w_i (p(class | xy) - onehot(class(z))), and with
+        respect to the word logits within class(z) it is
+        w_i (p(word | class, xy) - onehot(z)).  Both flow back into h."""
+        trigrams, weights = batch   # type: ignore
+        x, y, z = trigrams.unbind(1)
+        rows = torch.arange(len(z))
+        h = self.hidden(x, y)                                                   # [B, d]
+        c = self.word_class[z]
+        log_p_class = torch.log_softmax(h @ self.C + self.b, dim=-1)            # [B, K]
+        member_vecs = self.embeddings(self.class_members[c])                    # [d, B, M]
+        word_logits = torch.einsum("bd,dbm->bm", h, member_vecs).masked_fill(~self.class_mask[c], -math.inf)
+        log_p_word = torch.log_softmax(word_logits, dim=-1)                     # [B, M]
+        nll = -(weights * (log_p_class[rows, c] + log_p_word[rows, self.position[z]])).sum()
+
+        w = weights * scale
+        grad_class = log_p_class.exp() * w.unsqueeze(1)                         # [B, K]
+        grad_class[rows, c] -= w
+        grad_word = log_p_word.exp() * w.unsqueeze(1)                           # [B, M], 0 at the padding
+        grad_word[rows, self.position[z]] -= w
+        grad_h = grad_class @ self.C.T + torch.einsum("bm,dbm->bd", grad_word, member_vecs)   # [B, d]
+        accumulate_grad(self.C, h.T @ grad_class)
+        accumulate_grad(self.b, grad_class.sum(dim=0))
+        accumulate_grad(self.X, self.embeddings(x) @ grad_h)   # h = X^T x_vec + Y^T y_vec
+        accumulate_grad(self.Y, self.embeddings(y) @ grad_h)
+        return nll.item(), weights.sum().item()
+
+    @torch.no_grad()
+    def top_k(self, x: Wordtype, y: Wordtype, k: int = 10,           # type: ignore[override]
+              max_clusters: Optional[int] = None, normalize: bool = False) -> List[Tuple[Wordtype, float]]:
+        # Each class is normalized separately, so the log-probabilities are not
+        # inner products with fixed word vectors, and there is no index to search.
+        # `logits` already gives log-probabilities, so normalize makes no difference.
+        scores, words = torch.topk(self.logits(x, y), min(k, len(self.vocab)))
+        return [(self.vocab[z], score) for z, score in zip(words.tolist(), scores.tolist())]
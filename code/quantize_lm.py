@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Stores the embedding matrix E of a trained log-linear model in reduced
+precision (float16, bfloat16, or int8 with a scale per column), and
+reports how that changes the size of E, the memory that the model's
+tensors take after scoring, the time to score the dev files (in batches,
+and token by token through `log_prob`), and the cross-entropy on them.  The quantized model is saved for use with
+fileprob.py, textcat.py, etc.; it can no longer be trained.
+
+Example:
+    ./quantize_lm.py en.model ../data/english_spanish/dev/english/*/* --precision int8 --output en-int8.model
+"""
+import argparse
+import itertools
+import logging
+import time
+from pathlib import Path
+from typing import List, Tuple
+import torch
+
+from probs import LanguageModel, TrigramRows, EmbeddingLogLinearLanguageModel, Trigram, read_trigrams
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", type=Path, help="Trained log-linear model")
+    parser.add_argument("dev_files", type=Path, nargs="+", help="Held-out files to compare cross-entropy on")
+    parser.add_argument("--precision", type=str, default="int8",
+                        choices=EmbeddingLogLinearLanguageModel.PRECISIONS, help="How to store E (default int8)")
+    parser.add_argument("--output", type=Path, default=None, help="Where to save the quantized model")
+    parser.add_argument("--sample", type=int, default=1000,
+                        help="How many dev tokens to score one at a time, for the token-by-token timing")
+    parser.set_defaults(logging_level=logging.WARNING)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", dest="logging_level", action="store_const", const=logging.INFO)
+    verbosity.add_argument("-q", "--quiet", dest="logging_level", action="store_const", const=logging.ERROR)
+    return parser.parse_args()
+
+
+def embedding_bytes(lm: EmbeddingLogLinearLanguageModel) -> int:
+    scale = getattr(lm, "E_scale", None)
+    return lm.E.element_size() * lm.E.nelement() + (0 if scale is None else scale.element_size() * scale.nelement())
+
+
+def tensor_bytes(lm: EmbeddingLogLinearLanguageModel) -> int:
+    """The bytes of all the tensors that the model holds, including any that it has cached."""
+    tensors = {id(t): t for t in itertools.chain(lm.state_dict(keep_vars=True).values(), vars(lm).values())
+               if isinstance(t, torch.Tensor)}
+    return sum(t.element_size() * t.nelement() for t in tensors.values())
+
+
+def score(lm: EmbeddingLogLinearLanguageModel, dev: TrigramRows,
+          sample: List[Trigram]) -> Tuple[float, float, float, int]:
+    """Cross-entropy on dev and the seconds it took to compute in batches; the
+    milliseconds per token to score the sample one token at a time; and the
+    bytes of the model's tensors after all that."""
+    start = time.perf_counter()
+    H = lm.cross_entropy(dev)
+    batched = time.perf_counter() - start
+    start = time.perf_counter()
+    with torch.no_grad():
+        for x, y, z in sample:
+            lm.log_prob(x, y, z)
+    per_token = 1000 * (time.perf_counter() - start) / max(1, len(sample))
+    return H, batched, per_token, tensor_bytes(lm)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.logging_level)
+
+    lm = LanguageModel.load(args.model)
+    if not isinstance(lm, EmbeddingLogLinearLanguageModel):
+        raise ValueError(f"{args.model} is not a log-linear model")
+    parts = [lm.training_data(file, by_type=True) for file in args.dev_files]
+    dev = TrigramRows(torch.cat([part.trigrams for part in parts]), torch.cat([part.weights for part in parts]))
+    trigrams = itertools.chain.from_iterable(read_trigrams(file, lm.vocab) for file in args.dev_files)
+    sample = list(itertools.islice(trigrams, args.sample))
+
+    before = (embedding_bytes(lm), *score(lm, dev, sample))
+    lm.quantize(args.precision)
+    after = (embedding_bytes(lm), *score(lm, dev, sample))
+
+    print("\tE bytes\ttensor bytes\tcross-entropy\tbatched seconds\tms/token one at a time")
+    for name, (size, H, seconds, per_token, resident) in ((str(args.model.name), before), (args.precision, after)):
+        print(f"{name}\t{size}\t{resident}\t{H:.5f}\t{seconds:.3f}\t{per_token:.3f}")
+    print(f"E is {before[0] / after[0]:.1f}x smaller; cross-entropy changed by {after[1] - before[1]:+.5f} bits per token")
+
+    if args.output is not None:
+        lm.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
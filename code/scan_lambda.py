@@ -2,6 +2,8 @@
 import sys, re, glob, subprocess
 from pathlib import Path
 
+from probs import open_corpus   # reads compressed files too
+
 # ========= Paths (absolute) =========
 ROOT = Path(__file__).resolve().parent.parent
 CODE = ROOT / "code"
@@ -50,7 +52,7 @@ def count_tokens_word(files: list[Path]) -> int:
     """Approximate num_tokens(): sum of (len(words)+1 EOS) per nonempty line."""
     total = 0
     for fp in files:
-        with fp.open("r", encoding="utf-8", errors="ignore") as f:
+        with open_corpus(fp, encoding="utf-8", errors="ignore") as f:
             for line in f:
                 line = line.strip()
                 if line == "":
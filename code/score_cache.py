@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+An on-disk cache of the scores of documents under language models, shared
+by the scripts that score documents (fileprob.py, textcat.py), so that
+scoring the same dev files with the same models again -- for another prior,
+another plot, another curve -- is a lookup rather than a recomputation.
+
+The cache is an SQLite database.  A score is keyed by a fingerprint of the
+model (a hash of its file's contents) and a hash of the document's contents,
+so a retrained model or an edited document simply misses.  Each entry holds
+the document's total log-probability (natural log) and its number of
+tokens.  When the cache has more than max_entries entries, the least
+recently used ones are evicted.
+
+Hashing a document means reading it, so the cache also remembers the hash
+of each document file it has seen, under the file's path, size and
+modification time.  A hit on a file seen before then costs no read of
+the file at all.
+
+The scripts take --score_cache PATH, which defaults to the environment
+variable LM_SCORE_CACHE; setting that variable makes every script -- and
+every script that runs them, like curve.py -- share one cache.
+
+This script reports statistics on a cache, or trims or clears it:
+    ./score_cache.py scores.db --stats
+    ./score_cache.py scores.db --max_entries 10000
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+ENVIRONMENT_VARIABLE = "LM_SCORE_CACHE"
+DEFAULT_MAX_ENTRIES = 1_000_000
+USE_BATCH = 1000   # write the times of use of this many hits at a time
+
+Score = Tuple[float, int]   # total log-probability and number of tokens
+
+
+def content_hash(data: Union[bytes, memoryview]) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(file: Path, chunk_bytes: int = 1 << 20) -> str:
+    """A hash of the contents of file, read a chunk at a time (a model file may be large)."""
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(chunk_bytes):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ScoreCache:
+    """A cache of document scores, keyed by (model fingerprint, document hash).
+
+    Each new score is committed as soon as it is stored, so that an interrupted
+    run keeps the scores it has computed, and other processes aren't locked
+    out of the database while this one runs.  The times of use of hits are
+    written in batches.  Use it as a context manager, so that the last batch
+    is written and the cache is trimmed at the end:
+
+        with ScoreCache(path) as cache:
+            model = cache.model_key(model_path)
+            log_prob, tokens = cache.score(model, doc, lambda: file_log_prob_and_tokens(doc, lm))
+    """
+
+    def __init__(self, path: Path, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(self.path, timeout=60)   # other processes may be using it too
+        self.db.execute("CREATE TABLE IF NOT EXISTS scores (model TEXT, doc TEXT, log_prob REAL, tokens INTEGER, "
+                        "used REAL, PRIMARY KEY (model, doc)) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS scores_by_use ON scores (used)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS documents (path TEXT PRIMARY KEY, size INTEGER, "
+                        "mtime INTEGER, hash TEXT) WITHOUT ROWID")
+        self.hits = 0
+        self.misses = 0
+        self._model_keys: Dict[Tuple[str, int, int], str] = {}
+        self._used: List[Tuple[float, str, str]] = []   # hits whose time of use isn't written yet
+
+    def __enter__(self) -> "ScoreCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.record_use()
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+    def model_key(self, model_path: Path) -> str:
+        """The fingerprint of a model file: a hash of its contents."""
+        stat = Path(model_path).stat()
+        key = (str(Path(model_path).resolve()), stat.st_size, stat.st_mtime_ns)
+        if key not in self._model_keys:
+            self._model_keys[key] = file_hash(model_path)
+        return self._model_keys[key]
+
+    def document_key(self, document) -> str:
+        """A hash of a document's contents: a file, or a document of an archive (see archive.py).
+        A file's hash is looked up by its path, size and modification time if possible."""
+        raw = getattr(document, "raw", None)
+        if raw is not None:
+            return content_hash(raw())   # already in memory (the archive is memory-mapped)
+        path = str(Path(document).resolve())
+        stat = Path(document).stat()
+        row = self.db.execute("SELECT hash FROM documents WHERE path = ? AND size = ? AND mtime = ?",
+                              (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+        doc = file_hash(Path(document))
+        self.db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                        (path, stat.st_size, stat.st_mtime_ns, doc))
+        return doc
+
+    def lookup(self, model: str, doc: str) -> Optional[Score]:
+        row = self.db.execute("SELECT log_prob, tokens FROM scores WHERE model = ? AND doc = ?",
+                              (model, doc)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.append((time.time(), model, doc))   # written all together by `record_use`
+        return row[0], row[1]
+
+    def record_use(self) -> None:
+        """Write the times of the hits so far, for the LRU order, in one batch."""
+        self.db.executemany("UPDATE scores SET used = ? WHERE model = ? AND doc = ?", self._used)
+        self._used = []
+
+    def store(self, model: str, doc: str, score: Score) -> None:
+        self.db.execute("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", (model, doc, *score, time.time()))
+
+    def score(self, model: str, document, compute: Callable[[], Score]) -> Score:
+        """The cached score of the document under the model, or else compute() it and cache it."""
+        doc = self.document_key(document)
+        score = self.lookup(model, doc)
+        if score is None:
+            score = compute()
+            self.store(model, doc, score)
+        if len(self._used) >= USE_BATCH:
+            self.record_use()
+        if self.db.in_transaction:
+            self.db.commit()
+        return score
+
+    def evict(self) -> int:
+        """Remove the least recently used entries beyond max_entries.  Return how many."""
+        self.record_use()
+        (entries,) = self.db.execute("SELECT COUNT(*) FROM scores").fetchone()
+        excess = entries - self.max_entries
+        if excess <= 0:
+            return 0
+        self.db.execute("DELETE FROM scores WHERE (model, doc) IN "
+                        "(SELECT model, doc FROM scores ORDER BY used LIMIT ?)", (excess,))
+        # Forget the files whose scores are all gone.
+        self.db.execute("DELETE FROM documents WHERE hash NOT IN (SELECT doc FROM scores)")
+        return excess
+
+    def stats(self) -> Dict[str, object]:
+        (entries,) = self.db.execute("SELECT COUNT(*) FROM scores").fetchone()
+        (models,) = self.db.execute("SELECT COUNT(DISTINCT model) FROM scores").fetchone()
+        lookups = self.hits + self.misses
+        return {"entries": entries, "models": models, "bytes": self.path.stat().st_size,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else float("nan")}
+
+
+def open_score_cache(path: Optional[Path]) -> Optional[ScoreCache]:
+    """The cache at path, or at $LM_SCORE_CACHE if path is None, or None if neither is given."""
+    if path is None and os.environ.get(ENVIRONMENT_VARIABLE):
+        path = Path(os.environ[ENVIRONMENT_VARIABLE])
+    return None if path is None else ScoreCache(path)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cache", type=Path, help="The score cache database")
+    parser.add_argument("--stats", action="store_true", help="Report the number of entries, models, and bytes")
+    parser.add_argument("--max_entries", type=int, default=None,
+                        help="Evict the least recently used entries beyond this many")
+    parser.add_argument("--clear", action="store_true", help="Remove every entry")
+    parser.set_defaults(logging_level=logging.INFO)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", dest="logging_level", action="store_const", const=logging.DEBUG)
+    verbosity.add_argument("-q", "--quiet", dest="logging_level", action="store_const", const=logging.WARNING)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.logging_level)
+    with ScoreCache(args.cache, max_entries=args.max_entries or DEFAULT_MAX_ENTRIES) as cache:
+        if args.clear:
+            cache.db.execute("DELETE FROM scores")
+            cache.db.execute("DELETE FROM documents")
+            log.info(f"Cleared {args.cache}")
+        if args.max_entries is not None:
+            log.info(f"Evicted {cache.evict()} entries")
+        if args.stats:
+            stats = cache.stats()
+            print(f"{stats['entries']} entries for {stats['models']} models in {stats['bytes']} bytes")
+    if args.clear:
+        with sqlite3.connect(args.cache) as db:
+            db.execute("VACUUM")   # give the space back
+
+
+if __name__ == "__main__":
+    main()
@@ -13,14 +13,14 @@ Output (match assignment format):
     0.037   easy034
     0.057   OVERALL
 """
-from glob import glob
 import argparse
 from pathlib import Path
 import math
 import sys
 from typing import List
 
-from probs import LanguageModel, Wordtype, OOV, BOS, EOS  # use your existing utilities
+from probs import LanguageModel, Wordtype, OOV, BOS, EOS, open_corpus  # use your existing utilities
+from archive import expand_documents
 
 # LM scoring of a single candidate sentence
 def lm_log2prob_sentence(lm: LanguageModel, tokens: List[str]) -> float:
@@ -73,7 +73,8 @@ def parse_candidate_line(line: str):
 def main():
     ap = argparse.ArgumentParser(description=__doc__)
     ap.add_argument("lm_model", type=Path, help="trained LM model (e.g., swsmall_backoff_add0.1.model)")
-    ap.add_argument("utt_files", type=Path, nargs="+", help="utterance files (e.g., data/speech/dev/easy/easy025)")
+    ap.add_argument("utt_files", type=Path, nargs="+",
+                    help="utterance files (e.g., data/speech/dev/easy/easy025), directories, or archives")
     args = ap.parse_args()
 
     lm = LanguageModel.load(args.lm_model, device="cpu")
@@ -81,17 +82,11 @@ def main():
     total_ref_words = 0.0
     total_err_words = 0.0
 
-    utt_list = []
-    for p in args.utt_files:
-        s = str(p)
-        if any(ch in s for ch in "*?[]"):
-            utt_list.extend(Path(x) for x in glob(s))
-        else:
-            utt_list.append(Path(s))
-    
+    utt_list = expand_documents(args.utt_files)   # (globs, directories, and archives too)
 
     for utt in utt_list:
-        lines = utt.read_text(encoding="utf-8").splitlines()
+        with open_corpus(utt, encoding="utf-8") as f:   # the file may be compressed
+            lines = f.read().splitlines()
         if len(lines) < 10:
             print(f"WARNING: {utt} has fewer than 10 lines; skipping.", file=sys.stderr)
             continue
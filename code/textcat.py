@@ -13,12 +13,15 @@ import argparse
 import logging
 import math
 import sys
+from contextlib import nullcontext
 from pathlib import Path
+from typing import Tuple
 import torch
-import glob
 import math
 
-from probs import Wordtype, LanguageModel, read_trigrams  # starter code APIs
+from probs import Wordtype, LanguageModel, read_token_ids, read_trigrams  # starter code APIs
+from archive import Document, expand_documents
+from score_cache import open_score_cache
 
 log = logging.getLogger(Path(__file__).stem)
 
@@ -28,7 +31,11 @@ def parse_args() -> argparse.Namespace:
     p.add_argument("model2", type=Path, help="path to model #2 (e.g., spam.model)")
     p.add_argument("prior", type=float,
                    help="prior probability for the FIRST model (e.g., 0.7 for gen)")
-    p.add_argument("test_files", type=Path, nargs="+", help="files to classify")
+    p.add_argument("test_files", type=Path, nargs="+",
+                   help="files to classify (or directories, or archives made by archive.py)")
+    p.add_argument("--score_cache", type=Path, default=None,
+                   help="database of cached document scores to consult and update "
+                        "(default: $LM_SCORE_CACHE, if set)")
     p.add_argument("--device", type=str, default="cpu",
                    choices=["cpu", "cuda", "mps"],
                    help="device for PyTorch tensors")
@@ -43,16 +50,24 @@ def parse_args() -> argparse.Namespace:
                    action="store_const", const=logging.WARNING)
     return p.parse_args()
 
-def file_log_prob(file: Path, lm: LanguageModel) -> float:
-    """Natural-log total probability of a file (one sentence per line)."""
+def file_log_prob_and_tokens(file: Path, lm: LanguageModel) -> Tuple[float, int]:
+    """Natural-log total probability of a file (one sentence per line),
+    and its number of tokens (including EOS), from one pass over the file."""
+    if isinstance(file, Document):
+        token_ids = file.token_ids(lm.vocab)   # already integerized in the archive?
+        if token_ids is not None:
+            return lm.log_prob_token_ids(token_ids), len(token_ids)
+    if lm.scores_in_batches:           # integerize the whole file and score it in batches
+        ids = read_token_ids(file, lm.word_ids())
+        return (lm.log_prob_token_ids(torch.frombuffer(ids, dtype=torch.int32)) if ids else 0.0), len(ids)
     log_prob = 0.0
+    tokens = 0
     x: Wordtype; y: Wordtype; z: Wordtype
     for (x, y, z) in read_trigrams(file, lm.vocab):
-        lp = lm.log_prob(x, y, z)    # ln p(z | xy)
-        log_prob += lp
-        if log_prob == -math.inf:
-            break
-    return log_prob
+        tokens += 1
+        if log_prob > -math.inf:     # once it is -inf, just count the remaining tokens
+            log_prob += lm.log_prob(x, y, z)    # ln p(z | xy)
+    return log_prob, tokens
 
 def posterior_gen_from_scores(s_gen: float, s_spam: float) -> float:
     # log-sum-exp / logistic：p(gen|d) = 1 / (1 + exp(s_spam - s_gen))
@@ -103,20 +118,8 @@ def main():
     log_prior_gen  = math.log(args.prior)
     log_prior_spam = math.log(1.0 - args.prior)
 
-    # gather test files (expand globs, recurse into dirs)
-    test_paths: list[Path] = []
-    for pat in args.test_files:
-        # glob first (PowerShell/Windows may not expand * on its own)
-        matches = glob.glob(str(pat))
-        if not matches:
-            matches = [str(pat)]
-        for m in matches:
-            p = Path(m)
-            if p.is_dir():
-                # collect all regular files under this dir (recursive)
-                test_paths.extend([q for q in p.rglob("*") if q.is_file()])
-            else:
-                test_paths.append(p)
+    # gather test files (expand globs, recurse into dirs, open archives)
+    test_paths = expand_documents(args.test_files)
 
     # classify each file
     gen_name  = str(args.model1)
@@ -134,54 +137,68 @@ def main():
 
     EPS = 1e-12
 
-    for f in test_paths:
-        lp_gen  = file_log_prob(f, lm_gen)  + log_prior_gen
-        lp_spam = file_log_prob(f, lm_spam) + log_prior_spam
-
-        if lp_gen >= lp_spam:
-            print(f"{gen_name} {f}")
-            gen_count += 1
-        else:
-            print(f"{spam_name} {f}")
-            spam_count += 1
-        total += 1
-        # 0/1 errors, expected error and logloss
-        true_label = true_label_from_path(f)
-        pred = "gen" if lp_gen >= lp_spam else "spam"
-        if pred != true_label and true_label:
-            zero_one_errors += 1
-        if true_label:
-            if true_label == "gen":
-                true_gen_count+=1
-            else: true_spam_count+=1
-            # posterior p(gen|d) via logistic: 1 / (1 + exp(Δ))
-            delta = lp_spam - lp_gen
-            if delta > 100:   # avoid overflow in exp()
-                p_gen = 0.0
-            elif delta < -100:
-                p_gen = 1.0
-            else:
-                p_gen = 1.0 / (1.0 + math.exp(delta))
-            p_true = p_gen if true_label == "gen" else (1.0 - p_gen)
-            if p_true < EPS:
-                p_true = EPS   # avoid log(0)   
-            elif p_true > 1.0 - EPS:
-                p_true = 1.0 - EPS  # avoid log(1)
-            expected_error_sum += (1.0 - p_true)
-            # log-loss in bits/doc
-            logloss_sum += (-math.log(p_true, 2))
-            e1_count += 1
-
-            # Q3 (c): pi_star
-            delta = lp_gen - lp_spam
-            if delta > 100:   # avoid overflow in exp()
-                thr = 1.0 / (1.0+math.exp(100)) 
-            elif delta < -100:
-                thr = 1.0 / (1.0+math.exp(-100)) 
+    # Scores don't depend on the prior, so rerunning with another prior can use cached ones.
+    # (The cache also records the token count, which fileprob.py needs from it.)
+    with open_score_cache(args.score_cache) or nullcontext() as scores:   # (None if there is no cache)
+        model_keys = {} if scores is None else {id(lm_gen): scores.model_key(args.model1),
+                                                id(lm_spam): scores.model_key(args.model2)}
+        def score(f, lm: LanguageModel) -> float:
+            if scores is None:
+                return file_log_prob_and_tokens(f, lm)[0]
+            log_prob, _ = scores.score(model_keys[id(lm)], f, lambda: file_log_prob_and_tokens(f, lm))
+            return log_prob
+
+        for f in test_paths:
+            lp_gen  = score(f, lm_gen)  + log_prior_gen
+            lp_spam = score(f, lm_spam) + log_prior_spam
+
+            if lp_gen >= lp_spam:
+                print(f"{gen_name} {f}")
+                gen_count += 1
             else:
-                thr = 1.0 / (1.0 + math.exp(delta))
-            if thr < pi_star:
-                pi_star = thr
+                print(f"{spam_name} {f}")
+                spam_count += 1
+            total += 1
+            # 0/1 errors, expected error and logloss
+            true_label = true_label_from_path(f)
+            pred = "gen" if lp_gen >= lp_spam else "spam"
+            if pred != true_label and true_label:
+                zero_one_errors += 1
+            if true_label:
+                if true_label == "gen":
+                    true_gen_count+=1
+                else: true_spam_count+=1
+                # posterior p(gen|d) via logistic: 1 / (1 + exp(Δ))
+                delta = lp_spam - lp_gen
+                if delta > 100:   # avoid overflow in exp()
+                    p_gen = 0.0
+                elif delta < -100:
+                    p_gen = 1.0
+                else:
+                    p_gen = 1.0 / (1.0 + math.exp(delta))
+                p_true = p_gen if true_label == "gen" else (1.0 - p_gen)
+                if p_true < EPS:
+                    p_true = EPS   # avoid log(0)   
+                elif p_true > 1.0 - EPS:
+                    p_true = 1.0 - EPS  # avoid log(1)
+                expected_error_sum += (1.0 - p_true)
+                # log-loss in bits/doc
+                logloss_sum += (-math.log(p_true, 2))
+                e1_count += 1
+
+                # Q3 (c): pi_star
+                delta = lp_gen - lp_spam
+                if delta > 100:   # avoid overflow in exp()
+                    thr = 1.0 / (1.0+math.exp(100)) 
+                elif delta < -100:
+                    thr = 1.0 / (1.0+math.exp(-100)) 
+                else:
+                    thr = 1.0 / (1.0 + math.exp(delta))
+                if thr < pi_star:
+                    pi_star = thr
+
+        if scores is not None:
+            log.info(f"Score cache: {scores.stats()}")
 
     # summary
     if total == 0:
@@ -6,11 +6,13 @@ Depending on the smoother, you need to supply hyperparameters and additional fil
 import argparse
 import logging
 import sys
+import time
 from pathlib import Path
 import torch
 
 from probs import read_vocab, UniformLanguageModel, AddLambdaLanguageModel, \
-    BackoffAddLambdaLanguageModel, EmbeddingLogLinearLanguageModel, ImprovedLogLinearLanguageModel
+    BackoffAddLambdaLanguageModel, EmbeddingLogLinearLanguageModel, ImprovedLogLinearLanguageModel, \
+    ClassFactoredLogLinearLanguageModel, TokenCache
 
 log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
 
@@ -19,7 +21,9 @@ ADDLAMBDA = "add_lambda"
 BACKOFF   = "add_lambda_backoff"
 LOGLINEAR = "log_linear"
 IMPROVED  = "log_linear_improved"
-SMOOTHERS = (UNIFORM, ADDLAMBDA, BACKOFF, LOGLINEAR, IMPROVED)
+CLASSES   = "log_linear_classes"
+SMOOTHERS = (UNIFORM, ADDLAMBDA, BACKOFF, LOGLINEAR, IMPROVED, CLASSES)
+LOGLINEARS = (LOGLINEAR, IMPROVED, CLASSES)
 
 
 def get_model_filename(args: argparse.Namespace) -> Path:
@@ -30,9 +34,19 @@ def get_model_filename(args: argparse.Namespace) -> Path:
         return Path(f"{prefix}~lambda={args.lambda_}.model")
     elif args.smoother in (LOGLINEAR, IMPROVED):
         return Path(f"{prefix}~lexicon={args.lexicon.name}~l2={args.l2_regularization}~epochs={args.epochs}.model")
+    elif args.smoother == CLASSES:
+        return Path(f"{prefix}~lexicon={args.lexicon.name}~l2={args.l2_regularization}~epochs={args.epochs}"
+                    f"~classes={args.num_classes}~{args.clustering}.model")
     else:   
         raise NotImplementedError(f"Don't know how to construct filename for smoother {args.smoother}")
 
+def get_output_filename(args: argparse.Namespace) -> Path:
+    if args.output is None:
+        return get_model_filename(args)
+    if args.l2_sweep is not None:   # one model per l2 strength
+        return args.output.with_name(f"{args.output.stem}~l2={args.l2_regularization}{args.output.suffix}")
+    return args.output
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description=__doc__)
 
@@ -76,18 +90,155 @@ def parse_args() -> argparse.Namespace:
         default=None,
         help="File of word embeddings (needed for our log-linear models)",
     )
+    parser.add_argument(
+        "--num_classes",
+        type=int,
+        default=None,
+        help=f"Number of word classes for {CLASSES} (default sqrt of the vocab size)",
+    )
+    parser.add_argument(
+        "--clustering",
+        type=str,
+        default="frequency",
+        choices=ClassFactoredLogLinearLanguageModel.CLUSTERINGS,
+        help=f"How {CLASSES} builds its word classes: frequency bins or k-means on the embeddings (default frequency)",
+    )
     parser.add_argument(
         "--l2_regularization",
         type=float,
         default=0.0,
         help="Strength of L2 regularization in log-linear models (default 0)",
     )
+    parser.add_argument(
+        "--l2_sweep",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Train a log-linear model for each of these L2 strengths (instead of --l2_regularization), "
+             "from the strongest to the weakest, each starting from the previous one's parameters; "
+             "saves one model per strength and reports each one's cross-entropy on --dev_file",
+    )
+    parser.add_argument(
+        "--sweep_tolerance",
+        type=float,
+        default=1e-4,
+        help="Without --dev_file, stop each --l2_sweep run once an epoch improves F by less than this "
+             "(default 1e-4)",
+    )
     parser.add_argument(
         "--epochs",
         type=int,
         default=10,
         help="Number of training epochs for log-linear models (default 10)",
     )
+    parser.add_argument(
+        "--by_type",
+        action="store_true",
+        help="Train log-linear models on the distinct trigram types weighted by their counts, "
+             "rather than on every trigram token (same objective, cheaper epochs)",
+    )
+    parser.add_argument(
+        "--by_context",
+        action="store_true",
+        help="Train log-linear models on the distinct contexts (x,y), each with a histogram of its "
+             "observed z's, so that each context's softmax is computed once per step",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="Minibatch size (tokens, types or contexts) for log-linear training; 0 means full batch "
+             "(default 1 for log_linear, 32 for log_linear_improved)",
+    )
+    parser.add_argument(
+        "--learning_rate",
+        type=float,
+        default=None,
+        help="Initial learning rate for log-linear models (default 0.01)",
+    )
+    parser.add_argument(
+        "--optimizer",
+        type=str,
+        default=None,
+        choices=EmbeddingLogLinearLanguageModel.OPTIMIZERS,
+        help="Optimizer for log-linear models; adam and convergent apply the L2 penalty as weight decay "
+             "(default sgd for log_linear, adam for log_linear_improved)",
+    )
+    parser.add_argument(
+        "--analytic",
+        action="store_true",
+        help="Compute log-linear gradients in closed form instead of with PyTorch autograd",
+    )
+    parser.add_argument(
+        "--grad_check",
+        action="store_true",
+        help="Check the closed-form gradient against finite differences on the first minibatch of each epoch",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Number of log-linear minibatches to build ahead of training in background threads; "
+             "0 builds each one when it is needed (default 2)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of background threads building log-linear minibatches (default 1)",
+    )
+    parser.add_argument(
+        "--dev_file",
+        type=Path,
+        default=None,
+        help="Held-out corpus for log-linear training: stop once its cross-entropy stops improving, "
+             "and keep the best parameters",
+    )
+    parser.add_argument(
+        "--average_start",
+        type=float,
+        default=None,
+        help="Average the log-linear parameters over all SGD steps after this many epochs (e.g. 1 or 0.5), "
+             "and keep the averaged parameters (default: no averaging)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        default=None,
+        help="Where to save the state of log-linear training, so that it can be resumed "
+             "(default: the model filename plus .ckpt, if --resume or --time_budget is given)",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=0,
+        help="Also checkpoint every this many minibatches, not just at the end of each epoch",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume log-linear training from the checkpoint, if it exists",
+    )
+    parser.add_argument(
+        "--time_budget",
+        type=float,
+        default=None,
+        help="Stop log-linear training after this many seconds, keeping the parameters from the best epoch",
+    )
+    parser.add_argument(
+        "--token_cache",
+        type=Path,
+        default=None,
+        help="Directory in which to cache the tokenized training and dev files, "
+             "so that later runs with other vocabularies needn't retokenize them",
+    )
+    parser.add_argument(
+        "--master_vocab",
+        type=Path,
+        default=None,
+        help="With --token_cache, the vocabulary to cache the tokens against (default: the vocab_file); "
+             "use one that contains every smaller vocabulary you will train with",
+    )
     parser.add_argument(
         "--device",
         type=str,
@@ -148,20 +299,76 @@ def main():
         if args.lexicon is None:
             parser.error(f"{args.smoother} requires a lexicon")
         lm = ImprovedLogLinearLanguageModel(vocab, args.lexicon, args.l2_regularization, args.epochs)
+    elif args.smoother == CLASSES:
+        if args.lexicon is None:
+            parser.error(f"{args.smoother} requires a lexicon")
+        lm = ClassFactoredLogLinearLanguageModel(vocab, args.lexicon, args.l2_regularization, args.epochs,
+                                                 args.num_classes, args.clustering)
     else:
         log.critical(f"Initialization code for smoother {args.smoother} is missing")
         sys.exit(1)
 
-    log.info("Training...")
-    lm.train(args.train_file)
+    cache = None
+    if args.token_cache is not None:
+        cache = TokenCache(read_vocab(args.master_vocab or args.vocab_file), args.token_cache)
+    token_ids = None if cache is None else cache.remapped(args.train_file, vocab)
+    dev_token_ids = None if cache is None or args.dev_file is None else cache.remapped(args.dev_file, vocab)
 
-    # Save the model to a file.
-    
-    if args.output is None:
-        model_path = get_model_filename(args)
-    else:
-        model_path = args.output
-    lm.save(model_path)
+    if args.smoother not in LOGLINEARS:
+        if args.l2_sweep is not None:
+            log.critical("--l2_sweep only applies to log-linear models")
+            sys.exit(1)
+        log.info("Training...")
+        lm.train(args.train_file, token_ids=token_ids)
+        # Save the model to a file.
+        lm.save(get_output_filename(args))
+        return
+
+    train_options = {"by_type": args.by_type, "by_context": args.by_context,
+                     "analytic": args.analytic, "grad_check": args.grad_check,
+                     "optimizer": args.optimizer,
+                     "prefetch_depth": args.prefetch, "prefetch_workers": args.workers,
+                     "checkpoint_every": args.checkpoint_every,
+                     "resume": args.resume, "time_budget": args.time_budget,
+                     "dev_file": args.dev_file, "average_start": args.average_start,
+                     "token_ids": token_ids, "dev_token_ids": dev_token_ids}
+    if args.batch_size is not None:
+        train_options["batch_size"] = args.batch_size
+    if args.learning_rate is not None:
+        train_options["learning_rate"] = args.learning_rate
+
+    def train_and_save(warm_start: bool) -> None:
+        model_path = get_output_filename(args)
+        checkpoint = args.checkpoint
+        if args.l2_sweep is not None and checkpoint is not None:
+            checkpoint = checkpoint.with_name(f"{checkpoint.stem}~l2={args.l2_regularization}{checkpoint.suffix}")
+        if checkpoint is None and (args.resume or args.time_budget is not None):
+            checkpoint = model_path.with_name(model_path.name + ".ckpt")
+        log.info("Training...")
+        lm.train(args.train_file, checkpoint=checkpoint, warm_start=warm_start, **train_options)
+        # Save the model to a file.
+        lm.save(model_path)
+
+    if args.l2_sweep is None:
+        train_and_save(warm_start=False)
+        return
+
+    # Follow the "regularization path" from the strongest L2 penalty to the weakest.
+    # Each optimum is a good starting point for the next, slightly less regularized
+    # problem, so the later runs have less far to go, and stop early: on dev
+    # cross-entropy with --dev_file, or else once F stops improving by --sweep_tolerance.
+    if args.dev_file is None:
+        train_options["tolerance"] = args.sweep_tolerance
+    dev = None if args.dev_file is None else lm.training_data(args.dev_file, by_type=True, token_ids=dev_token_ids)
+    results = []
+    for i, l2 in enumerate(sorted(set(args.l2_sweep), reverse=True)):
+        args.l2_regularization = lm.l2 = l2
+        start = time.perf_counter()
+        train_and_save(warm_start=i > 0)
+        seconds = time.perf_counter() - start
+        results.append((l2, seconds, None if dev is None else lm.cross_entropy(dev)))
+    for l2, seconds, H in results:
+        print(f"l2 = {l2}:\t{seconds:.1f} sec" + ("" if H is None else f"\tdev cross-entropy {H:.5f} bits per token"))
 
 if __name__ == "__main__":
     main()
@@ -54,6 +54,9 @@ def sample_from_dist(tokens, probs):
 
 def next_token_distribution(lm, vocab_list, prev2, prev1):
     """Return list of P(w | prev2, prev1) over vocab_list (robust to different APIs)."""
+    if hasattr(lm, "distribution"):
+        dist = lm.distribution(prev2, prev1)
+        return [dist.prob(w) for w in vocab_list]
     out = []
     for w in vocab_list:
         p = None
@@ -96,8 +99,12 @@ def sample_one(lm, vocab_list, max_length=50):
     end_flag = False
     while len(seq) < max_length+2:
         w2, w1 = seq[-2], seq[-1]
-        probs = renorm(next_token_distribution(lm, vocab_list, w2, w1))
-        nxt = sample_from_dist(vocab_list, probs)
+        if hasattr(lm, "distribution"):
+            # Count-based models can sample from their seen continuations without scoring all of V.
+            nxt = lm.distribution(w2, w1).sample()
+        else:
+            probs = renorm(next_token_distribution(lm, vocab_list, w2, w1))
+            nxt = sample_from_dist(vocab_list, probs)
         if nxt == end_token:
             end_flag = True
             break
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Searches over hyperparameters of a log-linear language model (lexicon,
+L2 strength, learning rate, batch size) by successive halving.
+
+Every configuration is first trained for a few epochs and scored by its
+cross-entropy on the dev files.  Only the better half (see --reduction)
+goes on to train for twice as many epochs, and so on, so most of the
+training time goes to the promising configurations.  Configurations are
+trained in parallel in a pool of processes.  Each one continues from its
+own checkpoint (see `EmbeddingLogLinearLanguageModel.train`), rather than
+starting over, when it is promoted.  A configuration that stopped early
+(for lack of improvement) stays stopped, and the leaderboard shows the
+epochs it actually trained for.  The checkpoints belong to one search, so
+OUTPUT_DIR must not hold checkpoints from an earlier one.
+
+The leaderboard is rewritten to OUTPUT_DIR/leaderboard.tsv after every round,
+and the best model is copied to OUTPUT_DIR/best.model.
+
+Example:
+    ./tune_loglinear.py ../vocab-genspam.txt log_linear_improved ../data/gen_spam/train/gen \\
+        --dev ../data/gen_spam/dev/gen/* \\
+        --lexicon ../lexicons/words-gs-only-10.txt ../lexicons/words-gs-only-20.txt \\
+        --l2_regularization 0 0.1 1 --learning_rate 1e-2 3e-3 --jobs 4
+"""
+import argparse
+import itertools
+import logging
+import math
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+import torch
+
+from probs import read_vocab, TrigramRows, EmbeddingLogLinearLanguageModel, ImprovedLogLinearLanguageModel, \
+    ClassFactoredLogLinearLanguageModel
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+MODELS = {"log_linear": EmbeddingLogLinearLanguageModel,
+          "log_linear_improved": ImprovedLogLinearLanguageModel,
+          "log_linear_classes": ClassFactoredLogLinearLanguageModel}
+
+Config = Dict[str, object]   # keyword arguments for the model and its `train` method
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("vocab_file", type=Path, help="Vocabulary file")
+    parser.add_argument("smoother", type=str, choices=MODELS.keys(), help="Log-linear model to tune")
+    parser.add_argument("train_file", type=Path, help="Training corpus (as a single file)")
+    parser.add_argument("--dev", type=Path, nargs="+", required=True, help="Held-out files to score configurations on")
+    parser.add_argument("--output_dir", type=Path, default=Path("tune_out"), help="Where to save models and the leaderboard")
+
+    # The search space: every combination of these is a configuration.
+    parser.add_argument("--lexicon", type=Path, nargs="+", required=True, help="Files of word embeddings")
+    parser.add_argument("--l2_regularization", type=float, nargs="+", default=[0.0], help="L2 strengths")
+    parser.add_argument("--learning_rate", type=float, nargs="+", default=[None], help="Initial learning rates")
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[None], help="Minibatch sizes")
+
+    # Options passed on to every training run, as in train_lm.py.
+    parser.add_argument("--optimizer", type=str, default=None, choices=EmbeddingLogLinearLanguageModel.OPTIMIZERS)
+    parser.add_argument("--by_type", action="store_true", help="Train on weighted trigram types")
+    parser.add_argument("--by_context", action="store_true", help="Train on contexts with outcome histograms")
+
+    # The schedule.
+    parser.add_argument("--min_epochs", type=int, default=1, help="Epochs for every configuration in the first round (default 1)")
+    parser.add_argument("--max_epochs", type=int, default=16, help="Most epochs for any configuration (default 16)")
+    parser.add_argument("--reduction", type=int, default=2,
+                        help="Keep the best 1/reduction of the configurations each round, "
+                             "and multiply their epochs by reduction (default 2)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of configurations to train at once (default 1)")
+
+    parser.set_defaults(logging_level=logging.INFO)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", dest="logging_level", action="store_const", const=logging.DEBUG)
+    verbosity.add_argument("-q", "--quiet", dest="logging_level", action="store_const", const=logging.WARNING)
+    return parser.parse_args()
+
+
+def read_dev(lm: EmbeddingLogLinearLanguageModel, files: List[Path]) -> TrigramRows:
+    """The trigram types of all the dev files together, integerized for lm."""
+    parts = [lm.training_data(file, by_type=True) for file in files]
+    return TrigramRows(torch.cat([part.trigrams for part in parts]), torch.cat([part.weights for part in parts]))
+
+
+def run_trial(args: argparse.Namespace, name: str, config: Config, epochs: int) -> Tuple[str, int, float]:
+    """Train configuration `name` up to a total of `epochs` epochs, continuing from
+    its checkpoint if any, and save the model.  Return the number of epochs it
+    has actually trained for (fewer if it stopped early) and its dev cross-entropy."""
+    torch.set_num_threads(1)   # the parallelism comes from the process pool
+    logging.basicConfig(level=args.logging_level)
+    vocab = read_vocab(args.vocab_file)
+    lm = MODELS[args.smoother](vocab, config["lexicon"], config["l2_regularization"], epochs)
+    train_options = {"by_type": args.by_type, "by_context": args.by_context, "optimizer": args.optimizer,
+                     "learning_rate": config["learning_rate"], "batch_size": config["batch_size"]}
+    lm.train(args.train_file, checkpoint=args.output_dir / f"{name}.ckpt", resume=True,
+             **{key: value for key, value in train_options.items() if value is not None})
+    lm.save(args.output_dir / f"{name}.model")
+    return name, lm.epochs_trained, lm.cross_entropy(read_dev(lm, args.dev))
+
+
+def write_leaderboard(path: Path, configs: Dict[str, Config], results: Dict[str, Tuple[int, float]]) -> None:
+    """Write the configurations, best first, with how many epochs each got and its last dev cross-entropy."""
+    ranked = sorted(results, key=lambda name: results[name][1])
+    temp = path.with_name(path.name + ".tmp")
+    with open(temp, "w") as f:
+        f.write("name\tepochs\tdev_cross_entropy\t" + "\t".join(next(iter(configs.values())).keys()) + "\n")
+        for name in ranked:
+            epochs, H = results[name]
+            f.write(f"{name}\t{epochs}\t{H:.5f}\t" + "\t".join(str(v) for v in configs[name].values()) + "\n")
+    temp.replace(path)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.logging_level)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    if any(args.output_dir.glob("*.ckpt")):
+        # They would be resumed as if they were this search's, whatever configurations made them.
+        log.critical(f"{args.output_dir} already holds checkpoints from an earlier search; "
+                     f"remove them or choose another --output_dir")
+        sys.exit(1)
+
+    configs: Dict[str, Config] = {}
+    for i, (lexicon, l2, lr, batch_size) in enumerate(itertools.product(
+            args.lexicon, args.l2_regularization, args.learning_rate, args.batch_size)):
+        configs[f"config{i}"] = {"lexicon": lexicon, "l2_regularization": l2,
+                                 "learning_rate": lr, "batch_size": batch_size}
+    log.info(f"Searching over {len(configs)} configurations")
+
+    results: Dict[str, Tuple[int, float]] = {}   # each configuration's epochs so far, and dev cross-entropy
+    alive = list(configs)
+    epochs = args.min_epochs
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        while True:
+            log.info(f"Training {len(alive)} configurations for {epochs} epochs")
+            futures = [pool.submit(run_trial, args, name, configs[name], epochs) for name in alive]
+            for future in futures:
+                name, trained, H = future.result()
+                results[name] = (trained, H)
+                log.info(f"{name} {configs[name]}: {H:.5f} bits per token after {trained} epochs")
+            write_leaderboard(args.output_dir / "leaderboard.tsv", configs, results)
+
+            if len(alive) == 1 or epochs >= args.max_epochs:
+                break
+            # Successive halving: only the best configurations get more epochs.
+            alive = sorted(alive, key=lambda name: results[name][1])[:math.ceil(len(alive) / args.reduction)]
+            epochs = min(epochs * args.reduction, args.max_epochs)
+
+    best = min(alive, key=lambda name: results[name][1])
+    shutil.copyfile(args.output_dir / f"{best}.model", args.output_dir / "best.model")
+    print(f"Best: {best} {configs[best]}: {results[best][1]:.5f} bits per token after {results[best][0]} epochs")
+    print(f"Saved to {args.output_dir / 'best.model'}; leaderboard in {args.output_dir / 'leaderboard.tsv'}")
+
+
+if __name__ == "__main__":
+    main()